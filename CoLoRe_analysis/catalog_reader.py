@@ -0,0 +1,611 @@
+'''
+    Module built to read the source catalogs (out_srcs_s{ source }_{ i }.fits) written by CoLoRe.
+
+    Only the requested columns are read from the files (memory mapped) and they are converted into native byte order.
+
+    The HEALPix pixel of each object can be stored in a .npy sidecar file (NESTED ordering at a maximum nside) in the analysis folder, so the angular conversion is done only once per catalog file.
+
+    The catalogs can also be compacted into a columnar store (one .npy file per column plus a manifest.json). When the store is newer than a catalog file it is used instead of the FITS file.
+
+    An index with the number of rows, the range of Z_COSMO, RA and DEC and a coarse redshift histogram of each file allows to count objects and to skip files without objects in a redshift range. It is stored in a cache folder given by the caller, outside of the simulation.
+'''
+
+import json
+import logging
+import os
+import re
+
+import healpy as hp
+
+import numpy as np
+from astropy.io import fits
+
+log = logging.getLogger(__name__)
+
+class CatalogReader:
+    '''Class made to read the source catalogs of a CoLoRe simulation'''
+
+    columns = ('RA', 'DEC', 'Z_COSMO', 'E1', 'E2')
+
+    def __init__(self, sim_location, source=1, cache_dir=None):
+        '''Inits the class with a sim path
+
+        Args:
+            sim_location (str): Path to the simulation
+            source (int, optional): Source of the catalogs to read (default: 1)
+            cache_dir (str, optional): Folder where the CatalogIndex is stored, outside of the simulation (default: None, the index is not stored and files are never skipped)
+        '''
+        self.sim_location = sim_location
+        self.source = source
+        self.cache_dir = cache_dir
+
+    def get_index(self):
+        '''Get the CatalogIndex of the catalogs (stored in cache_dir if given)'''
+        location = self.cache_dir + f'/index_s{ self.source }.json' if self.cache_dir is not None else None
+        return CatalogIndex(self.sim_location, self.source, location)
+
+    def get_filename(self, ifile):
+        '''Get the path of a catalog file
+
+        Args:
+            ifile (int): Index of the file (one file is written per CoLoRe node)
+        '''
+        return self.sim_location + f'/out_srcs_s{ self.source }_{ ifile }.fits'
+
+    def get_files(self, max_files=None):
+        '''Get the list of catalog files of the simulation
+
+        Args:
+            max_files (int, optional): Index of the last file to consider (default: None, consider all the files)
+
+        Returns:
+            List of paths to the catalog files.
+        '''
+        files = []
+        ifile = 0
+        while os.path.isfile(self.get_filename(ifile)) and (max_files is None or ifile <= max_files):
+            files.append(self.get_filename(ifile))
+            ifile += 1
+        return files
+
+    @classmethod
+    def read_file(cls, filename, columns=None):
+        '''Read some columns of a catalog file
+
+        Args:
+            filename (str): Path to the catalog file
+            columns (list of str, optional): Columns to read (default: cls.columns)
+
+        Returns:
+            Dict with an array in native byte order for each column.
+        '''
+        return next(cls.read_file_chunks(filename, columns))
+
+    @classmethod
+    def read_file_chunks(cls, filename, columns=None, chunk_rows=None, pixel_cache=None, nside=None, compact=True):
+        '''Read some columns of a catalog file in chunks of rows, so the memory needed does not grow with the size of the file
+
+        Args:
+            filename (str): Path to the catalog file
+            columns (list of str, optional): Columns to read (default: cls.columns)
+            chunk_rows (int, optional): Number of rows of each chunk (default: None, read the full file at once)
+            pixel_cache (PixelIndexCache, optional): Cache of the pixel of each object. If given, a 'PIX' entry with the RING pixel at nside is added to each chunk (computed from RA, DEC if the cache can not give pixels at nside) (default: None)
+            nside (int, optional): nside of the 'PIX' entry (default: None)
+            compact (bool, optional): Read the data from the compacted store of the simulation if it is up to date (default: True)
+
+        Yields:
+            Dict with an array in native byte order for each column (at least one chunk is given, even for empty files).
+        '''
+        columns = cls.columns if columns is None else columns
+        from_angles = pixel_cache is not None and not pixel_cache.can_degrade(nside)
+        if from_angles:
+            columns = tuple(dict.fromkeys((*columns, 'RA', 'DEC')))
+            pixel_cache = None
+        pixels = pixel_cache.load(filename, chunk_rows) if pixel_cache is not None else None
+
+        store = CompactStore.for_file(filename, columns) if compact else None
+        if store is not None:
+            chunks = store.read_file_chunks(filename, columns, chunk_rows)
+        else:
+            chunks = cls._read_fits_chunks(filename, columns, chunk_rows)
+
+        start = 0
+        for values in chunks:
+            if pixels is not None:
+                stop = start + len(values[columns[0]])
+                values['PIX'] = pixel_cache.degrade(pixels[start:stop], nside)
+                start = stop
+            elif from_angles:
+                values['PIX'] = hp.ang2pix(nside, np.radians(90-values['DEC']), np.radians(values['RA']))
+            yield values
+
+    @staticmethod
+    def _read_fits_chunks(filename, columns, chunk_rows=None):
+        with fits.open(filename, memmap=True) as hdulist:
+            data = hdulist[1].data
+            nrows = max(len(data), 1)
+            chunk_rows = nrows if chunk_rows is None else chunk_rows
+
+            for start in range(0, nrows, chunk_rows):
+                values = dict()
+                for column in columns:
+                    field = data.field(column)[start:start+chunk_rows]
+                    # astype copies only this piece of column out of the memmap (and fixes the FITS big-endianness)
+                    values[column] = field.astype(field.dtype.newbyteorder('='))
+                yield values
+
+    def get_files_in_range(self, minz, maxz, max_files=None):
+        '''Get the catalog files that may contain objects with minz <= Z_COSMO < maxz (using the CatalogIndex of the simulation)
+
+        Args:
+            minz (float): Min redshift
+            maxz (float): Max redshift
+            max_files (int, optional): Index of the last file to consider (default: None, consider all the files)
+
+        Returns:
+            List of paths to the catalog files.
+        '''
+        files = self.get_files(max_files)
+        index = self.get_index()
+        selected = [filename for filename, entry in zip(files, index.get_entries(files)) if index.count(entry, minz, maxz) > 0]
+        if len(selected) < len(files):
+            log.info(f'Skipping { len(files) - len(selected) } files without objects in redshift range [{ minz }, { maxz })')
+        return selected
+
+    def count_objects(self, max_files=None, minz=None, maxz=None):
+        '''Count the objects in the catalogs from the CatalogIndex of the simulation (without reading the catalogs if the index is up to date)
+
+        Args:
+            max_files (int, optional): Index of the last file to consider (default: None, consider all the files)
+            minz (float, optional): Min redshift (default: None, no limit)
+            maxz (float, optional): Max redshift (default: None, no limit)
+
+        Returns:
+            Number of objects (an upper bound if a redshift range is given, as only the coarse histograms are used).
+        '''
+        files = self.get_files(max_files)
+        index = self.get_index()
+        return sum(index.count(entry, minz, maxz) for entry in index.get_entries(files))
+
+    def read(self, max_files=None, columns=None, chunk_rows=None, zrange=None):
+        '''Iterate over the catalog files of the simulation
+
+        Args:
+            max_files (int, optional): Index of the last file to consider (default: None, consider all the files)
+            columns (list of str, optional): Columns to read (default: self.columns)
+            chunk_rows (int, optional): Number of rows of each chunk (default: None, one chunk per file)
+            zrange (tuple, optional): (minz, maxz) range of Z_COSMO that will be used. Files without objects in it are skipped if there is a cache_dir to store the index (default: None, read all the files)
+
+        Yields:
+            Dict with an array for each column (one per chunk).
+        '''
+        # Without a stored index, building it would be an extra pass over the files in every run
+        if zrange is None or self.cache_dir is None:
+            files = self.get_files(max_files)
+        else:
+            files = self.get_files_in_range(*zrange, max_files=max_files)
+        for filename in files:
+            log.debug(f'Reading file: { filename }')
+            yield from self.read_file_chunks(filename, columns, chunk_rows)
+
+class CompactStore:
+    '''Class made to handle the columnar store of the source catalogs of a simulation.
+
+    Each column of all the catalog files is stored as a single contiguous native-endian .npy array that can be memory mapped. Columns keep the precision of the catalogs unless another dtype is given for them. The manifest.json file records the rows and offset of each catalog file. The store is only used for catalog files older than the manifest.
+    '''
+
+    # Parsed manifests, by path, with the modification time they were read at
+    _manifests = dict()
+
+    def __init__(self, sim_location, source=1, location=None):
+        '''Inits the class with a sim path
+
+        Args:
+            sim_location (str): Path to the simulation
+            source (int, optional): Source of the catalogs (default: 1)
+            location (str, optional): Path of the store (default: { sim_location }/catalog_cache/compact_s{ source })
+        '''
+        self.sim_location = sim_location
+        self.source = source
+        self.location = location if location is not None else sim_location + f'/catalog_cache/compact_s{ source }'
+        self.manifest_path = self.location + '/manifest.json'
+
+    @classmethod
+    def for_file(cls, filename, columns=CatalogReader.columns):
+        '''Get the store that contains a catalog file
+
+        Args:
+            filename (str): Path to the catalog file
+            columns (list of str, optional): Columns that have to be in the store (default: CatalogReader.columns)
+
+        Returns:
+            CompactStore if there is an up to date store with the file and columns, None otherwise.
+        '''
+        match = re.fullmatch(r'out_srcs_s(\d+)_\d+\.fits', os.path.basename(filename))
+        if match is None:
+            return None
+
+        store = cls(os.path.dirname(filename), int(match.group(1)))
+        manifest = store.load_manifest()
+        if manifest is None or os.path.basename(filename) not in manifest['files'] or not set(columns) <= set(manifest['columns']):
+            return None
+        if os.path.getmtime(filename) >= os.path.getmtime(store.manifest_path):
+            log.info(f'Compact store { store.location } is older than { filename }, reading the FITS file')
+            return None
+        return store
+
+    def load_manifest(self):
+        '''Load the manifest of the store. It is only parsed again if the file has changed since the last time it was loaded.
+
+        Returns:
+            Dict with the manifest (None if the store does not exist).
+        '''
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+            cached = self._manifests.get(self.manifest_path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            with open(self.manifest_path) as json_file:
+                manifest = json.load(json_file)
+        except FileNotFoundError:
+            self._manifests.pop(self.manifest_path, None)
+            return None
+        self._manifests[self.manifest_path] = (mtime, manifest)
+        return manifest
+
+    def write(self, files, columns=CatalogReader.columns, chunk_rows=None, dtypes=None):
+        '''Write the store from a list of catalog files
+
+        Args:
+            files (list of str): Paths to the catalog files
+            columns (list of str, optional): Columns to store (default: CatalogReader.columns)
+            chunk_rows (int, optional): Number of rows copied at once (default: None, set from the available memory)
+            dtypes (dict, optional): dtype used to store some columns, e.g. {'E1': 'f4'} to keep float64 ellipticities as float32 (default: None, keep the dtype of the catalogs)
+        '''
+        dtypes = {column: np.dtype(dtype).newbyteorder('=') for column, dtype in (dtypes or dict()).items()}
+        unknown = set(dtypes) - set(columns)
+        if unknown:
+            raise ValueError(f'dtypes given for columns not stored: { sorted(unknown) }')
+
+        os.makedirs(self.location, exist_ok=True)
+        # Without manifest the store is not used, so it is removed until all the columns are written
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
+
+        chunk_rows = get_chunk_rows(bytes_per_row=16*len(columns)) if chunk_rows is None else chunk_rows
+
+        manifest_files = dict()
+        offset = 0
+        for filename in files:
+            with fits.open(filename, memmap=True) as hdulist:
+                data = hdulist[1].data
+                rows = len(data)
+                for column in columns:
+                    if column not in dtypes:
+                        dtypes[column] = data.field(column).dtype.newbyteorder('=')
+            manifest_files[os.path.basename(filename)] = {'offset': offset, 'rows': rows}
+            offset += rows
+
+        arrays = {column: np.lib.format.open_memmap(self.location + f'/{ column }.npy', mode='w+', dtype=dtypes.get(column, np.float32), shape=(offset,)) for column in columns}
+        for filename in files:
+            log.info(f'Compacting file: { filename }')
+            start = manifest_files[os.path.basename(filename)]['offset']
+            for values in CatalogReader.read_file_chunks(filename, columns, chunk_rows, compact=False):
+                stop = start + len(values[columns[0]])
+                for column in columns:
+                    arrays[column][start:stop] = values[column]
+                start = stop
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        manifest = {
+            'source'    : self.source,
+            'rows'      : offset,
+            'columns'   : {column: dtype.str for column, dtype in dtypes.items()},
+            'files'     : manifest_files
+        }
+        with open(self.manifest_path, 'w') as json_file:
+            json.dump(manifest, json_file, indent=4)
+        self._manifests.pop(self.manifest_path, None)
+
+    def read_file_chunks(self, filename, columns=None, chunk_rows=None):
+        '''Read the rows of a catalog file from the store
+
+        Args:
+            filename (str): Path to the catalog file
+            columns (list of str, optional): Columns to read (default: CatalogReader.columns)
+            chunk_rows (int, optional): Number of rows of each chunk (default: None, read the full file at once)
+
+        Yields:
+            Dict with an array for each column (at least one chunk is given, even for empty files).
+        '''
+        columns = CatalogReader.columns if columns is None else columns
+        # The parsed manifest is shared by all the files of the store
+        entry = self.load_manifest()['files'][os.path.basename(filename)]
+        arrays = {column: np.load(self.location + f'/{ column }.npy', mmap_mode='r') for column in columns}
+
+        nrows = max(entry['rows'], 1)
+        chunk_rows = nrows if chunk_rows is None else chunk_rows
+        for start in range(0, nrows, chunk_rows):
+            stop = entry['offset'] + min(start + chunk_rows, entry['rows'])
+            yield {column: np.array(array[entry['offset']+start:stop]) for column, array in arrays.items()}
+
+class CatalogIndex:
+    '''Class made to handle the index of the catalog files of a simulation.
+
+    For each file the index (a json file) stores the number of rows, the min and max of Z_COSMO, RA and DEC and a coarse histogram of Z_COSMO (z_hist, with bins of width z_width starting at z_first*z_width), so it is built in a single pass over the file. Entries are identified by the size and modification time of the file and they are computed again when the file changes.
+    '''
+
+    columns = ('Z_COSMO', 'RA', 'DEC')
+    z_width = 0.01
+
+    def __init__(self, sim_location, source=1, location=None):
+        '''Inits the class with a sim path
+
+        Args:
+            sim_location (str): Path to the simulation
+            source (int, optional): Source of the catalogs (default: 1)
+            location (str, optional): Path of the index file, outside of the simulation (default: None, the index is not stored)
+        '''
+        self.sim_location = sim_location
+        self.source = source
+        self.location = location
+
+    def load(self):
+        '''Load the index
+
+        Returns:
+            Dict with the entry of each file (by file name).
+        '''
+        if self.location is None:
+            return dict()
+        try:
+            with open(self.location) as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return dict()
+
+    def get_entries(self, files, chunk_rows=None):
+        '''Get the index entries of a list of catalog files, computing (and storing) the ones missing or outdated
+
+        Args:
+            files (list of str): Paths to the catalog files
+            chunk_rows (int, optional): Number of rows read at once when a file is indexed (default: None, set from the available memory)
+
+        Returns:
+            List with the entry of each file.
+        '''
+        index = self.load()
+        updated = False
+        entries = []
+        for filename in files:
+            stat = os.stat(filename)
+            entry = index.get(os.path.basename(filename))
+            # Entries written with another histogram binning are also computed again
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns or entry.get('z_width') != self.z_width:
+                entry = self.build_entry(filename, chunk_rows)
+                index[os.path.basename(filename)] = entry
+                updated = True
+            entries.append(entry)
+
+        if updated and self.location is not None:
+            try:
+                os.makedirs(os.path.dirname(self.location), exist_ok=True)
+                tmp_location = self.location + f'.{ os.getpid() }.tmp'
+                with open(tmp_location, 'w') as json_file:
+                    json.dump(index, json_file)
+                os.replace(tmp_location, self.location)
+            except OSError:
+                log.warning(f'Catalog index could not be stored in { self.location }')
+        return entries
+
+    @classmethod
+    def build_entry(cls, filename, chunk_rows=None):
+        '''Compute the index entry of a catalog file, reading it once in chunks of rows
+
+        Args:
+            filename (str): Path to the catalog file
+            chunk_rows (int, optional): Number of rows read at once (default: None, set from the available memory)
+
+        Returns:
+            Dict with the entry.
+        '''
+        log.info(f'Indexing file: { filename }')
+        stat = os.stat(filename)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'rows': 0, 'z_width': cls.z_width}
+        for column in cls.columns:
+            entry[column] = [None, None]
+
+        chunk_rows = get_chunk_rows(bytes_per_row=16*len(cls.columns)) if chunk_rows is None else chunk_rows
+        z_first, z_hist = 0, np.zeros(0, dtype=np.int64)
+        for values in CatalogReader.read_file_chunks(filename, cls.columns, chunk_rows):
+            if len(values['Z_COSMO']) == 0:
+                continue
+            entry['rows'] += len(values['Z_COSMO'])
+            for column in cls.columns:
+                minimum, maximum = float(values[column].min()), float(values[column].max())
+                old_min, old_max = entry[column]
+                entry[column] = [minimum if old_min is None else min(old_min, minimum), maximum if old_max is None else max(old_max, maximum)]
+
+            # The bins are fixed, so the histograms of the chunks are added after aligning their first bin
+            ibin = np.floor(values['Z_COSMO'] / cls.z_width).astype(np.int64)
+            first = int(ibin.min())
+            counts = np.bincount(ibin - first)
+            if len(z_hist) == 0:
+                z_first, z_hist = first, counts
+            else:
+                new_first = min(z_first, first)
+                merged = np.zeros(max(z_first + len(z_hist), first + len(counts)) - new_first, dtype=np.int64)
+                merged[z_first-new_first:z_first-new_first+len(z_hist)] += z_hist
+                merged[first-new_first:first-new_first+len(counts)] += counts
+                z_first, z_hist = new_first, merged
+
+        entry['z_first'] = z_first
+        entry['z_hist'] = z_hist.tolist()
+        return entry
+
+    @classmethod
+    def count(cls, entry, minz=None, maxz=None):
+        '''Count the objects of a file in a redshift range
+
+        Args:
+            entry (dict): Index entry of the file
+            minz (float, optional): Min redshift (default: None, no limit)
+            maxz (float, optional): Max redshift (default: None, no limit)
+
+        Returns:
+            Number of objects. With a redshift range it is the number of objects in the histogram bins overlapping with the range, so it is only 0 if there are no objects in it.
+        '''
+        if (minz is None and maxz is None) or entry['rows'] == 0:
+            return entry['rows']
+
+        # Small margin so objects at the edges are never missed because of float32 rounding
+        minz = -np.inf if minz is None else minz - 1e-6*(1 + abs(minz))
+        maxz = np.inf if maxz is None else maxz + 1e-6*(1 + abs(maxz))
+        edges = (entry['z_first'] + np.arange(len(entry['z_hist']) + 1)) * entry['z_width']
+        overlap = (edges[1:] >= minz) & (edges[:-1] < maxz)
+        return int(np.sum(np.asarray(entry['z_hist'])[overlap]))
+
+def compact_catalogs(sim_location, source=1, chunk_rows=None, dtypes=None):
+    '''Convert the source catalogs of a simulation into a CompactStore (it is then used automatically by CatalogReader)
+
+    Args:
+        sim_location (str): Path to the simulation
+        source (int, optional): Source of the catalogs (default: 1)
+        chunk_rows (int, optional): Number of rows copied at once (default: None, set from the available memory)
+        dtypes (dict, optional): dtype used to store some columns (default: None, keep the dtype of the catalogs)
+
+    Returns:
+        The CompactStore written.
+    '''
+    files = CatalogReader(sim_location, source).get_files()
+    if len(files) == 0:
+        raise FileNotFoundError(f'No catalogs found for source { source } in { sim_location }')
+
+    store = CompactStore(sim_location, source)
+    store.write(files, chunk_rows=chunk_rows, dtypes=dtypes)
+    return store
+
+def get_chunk_rows(bytes_per_row=128, memory_fraction=0.25, max_rows=2**27):
+    '''Get the number of rows of each chunk so that a chunk uses a fraction of the available memory
+
+    Args:
+        bytes_per_row (int, optional): Memory needed to process a single row (default: 128)
+        memory_fraction (float, optional): Fraction of the available memory to use for each chunk (default: 0.25)
+        max_rows (int, optional): Upper limit for the number of rows (default: 2**27)
+
+    Returns:
+        Number of rows of each chunk.
+    '''
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError): #pragma: no cover
+        log.warning('Available memory could not be obtained, using the default chunk size')
+        return max_rows
+
+    return int(max(1, min(max_rows, memory_fraction*available // bytes_per_row)))
+
+class PixelIndexCache:
+    '''Class made to store the HEALPix pixel of each object of the catalog files.
+
+    The pixels are stored in NESTED ordering at max_nside as a .npy sidecar of each catalog file in cache_dir (outside of the simulation, which may be shared or read-only). The name of the sidecar includes the size and modification time of the catalog file, so it is rebuilt when the catalog changes. Pixels at lower nside are obtained with a bit shift of the stored ones.
+    '''
+
+    def __init__(self, cache_dir, max_nside=4096):
+        '''Inits the cache
+
+        Args:
+            cache_dir (str): Folder for the sidecar files (e.g. the catalog_cache folder of the analysis of the simulation)
+            max_nside (int, optional): nside of the stored pixels (default: 4096)
+        '''
+        self.max_nside = max_nside
+        self.cache_dir = cache_dir
+        self.dtype = np.uint32 if hp.nside2npix(max_nside) <= np.iinfo(np.uint32).max else np.int64
+
+    def get_path(self, filename):
+        '''Get the path of the sidecar file of a catalog
+
+        Args:
+            filename (str): Path to the catalog file
+        '''
+        stat = os.stat(filename)
+        return self.cache_dir + f'/{ os.path.basename(filename) }.{ stat.st_size }_{ stat.st_mtime_ns }.nest{ self.max_nside }.npy'
+
+    def load(self, filename, chunk_rows=None):
+        '''Get the NESTED pixels at max_nside of the objects of a catalog file, computing (and storing) them if they are not in the cache
+
+        Args:
+            filename (str): Path to the catalog file
+            chunk_rows (int, optional): Number of rows converted at once when building the sidecar (default: None, the full file at once)
+
+        Returns:
+            Memory mapped array with the pixel of each object.
+        '''
+        path = self.get_path(filename)
+        if os.path.isfile(path):
+            return np.load(path, mmap_mode='r')
+
+        log.info(f'Computing pixel index of file: { filename }')
+        with fits.open(filename, memmap=True) as hdulist:
+            nrows = len(hdulist[1].data)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written to a temporary file first so other processes never find a partial sidecar
+            tmp_path = path + f'.{ os.getpid() }.tmp'
+            pixels = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=(nrows,))
+        except OSError:
+            log.warning(f'Pixel index of file { filename } could not be stored in { os.path.dirname(path) }')
+            pixels = np.empty(nrows, dtype=self.dtype)
+            self._fill(filename, pixels, chunk_rows)
+            return pixels
+
+        self._fill(filename, pixels, chunk_rows)
+        pixels.flush()
+        del pixels
+        os.replace(tmp_path, path)
+
+        # Remove sidecars of previous versions of the catalog
+        prefix = os.path.basename(filename) + '.'
+        suffix = f'.nest{ self.max_nside }.npy'
+        for old in os.listdir(os.path.dirname(path)):
+            if old.startswith(prefix) and old.endswith(suffix) and old != os.path.basename(path):
+                os.remove(os.path.dirname(path) + '/' + old)
+
+        return np.load(path, mmap_mode='r')
+
+    def _fill(self, filename, pixels, chunk_rows=None):
+        start = 0
+        for values in CatalogReader.read_file_chunks(filename, columns=['RA', 'DEC'], chunk_rows=chunk_rows):
+            stop = start + len(values['RA'])
+            pixels[start:stop] = hp.ang2pix(self.max_nside, np.radians(90-values['DEC']), np.radians(values['RA']), nest=True)
+            start = stop
+
+    def can_degrade(self, nside):
+        '''Check if the pixels at an nside can be obtained from the stored ones
+
+        Args:
+            nside (int): nside of the pixels
+
+        Returns:
+            True if nside is a power of 2 not larger than max_nside.
+        '''
+        return nside <= self.max_nside and hp.isnsideok(nside, nest=True)
+
+    def degrade(self, pixels, nside):
+        '''Get the RING pixels at a lower nside from the NESTED pixels at max_nside
+
+        Args:
+            pixels (array): NESTED pixels at max_nside
+            nside (int): Output nside (it must be a power of 2 lower or equal than max_nside)
+
+        Returns:
+            Array with the RING pixels at nside.
+        '''
+        if not self.can_degrade(nside):
+            raise ValueError(f'nside { nside } can not be obtained from the pixel cache (nside { self.max_nside })')
+        # Each NESTED pixel is split in 4 children when nside is doubled
+        shift = 2*(int(np.log2(self.max_nside)) - int(np.log2(nside)))
+        return hp.nest2ring(nside, np.asarray(pixels, dtype=np.int64) >> shift)
@@ -1,17 +1,19 @@
-import json
 import logging
 import os
 from shutil import rmtree
 
-import numpy as np
 
 from CoLoRe_analysis import compute_data_CCL
+from CoLoRe_analysis.output_backend import load_array, load_info
 
 log = logging.getLogger(__name__)
 
 class CCLReader:
     '''Class made to handle QA tests using CCL theoretical values'''
 
+    # Options that change how the data is computed but not the data itself (they are not used to match outputs)
+    execution_options = ('n_workers', 'chunk_rows', 'max_pixel_nside', 'workspace_cache_dir', 'threads', 'output_format', 'map_storage', 'resume', 'checkpoint')
+
     def __init__(self, sim_location, analysis_location):
         '''Inits the class with a sim path
 
@@ -21,17 +23,55 @@ class CCLReader:
         '''
         self.sim_location = sim_location
         self.analysis_location = analysis_location
+        # Fingerprint of the catalogs of each source, used to get the ids of the runs
+        self.fingerprints = {}
 
-    def do_data_computations(self, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, **kwargs):
+    def do_data_computations(self, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, n_workers=1, chunk_rows=None, max_pixel_nside=4096, **kwargs):
         '''Computes the Cls from CCL and for the sim.
 
         Args:
             source (int, optional): CoLoRe output source to use as input (default: 1)
+            nside (int or list of int, optional): nside to use. A list computes the data for all of them reading the catalogs once (default: 128)
             output_path (str, optional): Set the output path (default: { analysis_path }/ccl_data/{datetime}/
+            n_workers (int, optional): Number of processes used to read the catalog files (and the P(k) files) (default: 1)
+            chunk_rows (int, optional): Number of catalog rows processed at once (default: None, set from the available memory)
+            max_pixel_nside (int, optional): nside of the pixel index stored for each catalog file (default: 4096, 0 to disable it)
+            seed (int, optional): Seed for the photo-z scatter and the downsampling, it is recorded in INFO.json (default: None, use the global numpy random state)
+            workspace_cache_dir (str, optional): Folder where the NaMaster workspaces are cached, it can be shared by several simulations (default: None, use { analysis_location }/namaster_workspaces)
+            threads (int, optional): Number of OpenMP/BLAS threads used by healpy, NaMaster and CCL, the threads of each stage are recorded in INFO.json (default: None, use the library defaults)
+            lmax (int, optional): Maximum multipole of the power spectra (default: None, 3*nside-1)
+            ell_edges (list of int, optional): Edges of the bandpowers of the power spectra (default: None, one bandpower per multipole)
+            theory_ell_per_decade (int, optional): Compute the theory power spectra only at this number of log-spaced multipoles per decade and interpolate the rest (default: None, compute all the multipoles)
+            output_format (str, optional): Format of the output arrays: 'dat' (text), 'npy' (binary), 'npy32' (binary with floats in single precision), 'h5' (one HDF5 file per output) or 'h5gz' (h5 with gzip compression) (default: 'dat')
+            map_storage (str, optional): Storage of the nmap/e1map/e2map outputs: 'full', 'compact' (counts as integers and the rest in single precision) or 'partial' (compact, as (pixel index, value) pairs when most of the pixels are empty). Needs a binary output_format (default: 'full')
+            resume (bool, optional): Continue the last run with the same options that stopped while reading the catalogs, from its last checkpoint (default: False)
+            checkpoint (bool, optional): Checkpoint the reading of the catalogs, so the run can be resumed (default: False)
+            shear_weight (str, optional): Weight of the ellipticity fields, only checked against the one of the code as it is given by it (default: None)
         '''
         log.info(f'Computing data for source: { source }')
 
-        compute_data_CCL.compute_data(self.sim_location, self.analysis_location, source, nside, None, downsampling, zbins, nz_h, nz_min, nz_max, **kwargs)
+        shear_weight = kwargs.pop('shear_weight', None)
+        if shear_weight is not None and shear_weight != compute_data_CCL.shear_weights.get(kwargs.get('code')):
+            raise ValueError(f'The code { kwargs.get("code") } does not use the shear weight { shear_weight }')
+
+        compute_data_CCL.compute_data(self.sim_location, self.analysis_location, source, nside, None, downsampling, zbins, nz_h, nz_min, nz_max, n_workers=n_workers, chunk_rows=chunk_rows, max_pixel_nside=max_pixel_nside, **kwargs)
+
+    def compute_missing_nsides(self, nsides, **kwargs):
+        '''Compute the data for the nsides that are not computed yet, reading the catalogs only once for all of them.
+
+        Args:
+            nsides (list of int): nsides to compute
+            kwargs (): Rest of parameters for the ccl script. The full list is given at help(do_data_computations)
+
+        Returns:
+            List with the nsides that have been computed.
+        '''
+        missing = [nside for nside in nsides if len(self.search_output(nside=nside, **kwargs)) == 0]
+        if len(missing) == 1:
+            self.do_data_computations(nside=missing[0], **kwargs)
+        elif len(missing) > 1:
+            self.do_data_computations(nside=missing, **kwargs)
+        return missing
 
     def get_values(self, value, **kwargs):
         '''Obtain values for Cls (CCL or sim)
@@ -65,7 +105,8 @@ class CCLReader:
 
         elif len(matched_sims) == 1: 
             id_ = matched_sims[0]['id']
-            return np.loadtxt(self.analysis_location + f'/ccl_data/{id_}/{ value }.dat')
+            # The format is detected from the files, maps saved as (pixel, value) pairs are expanded
+            return load_array(self.analysis_location + f'/ccl_data/{id_}', value)
 
         elif len(matched_sims) > 1:
             print('Multiple simulations does exist with the given parameters:')
@@ -79,6 +120,8 @@ class CCLReader:
         Args:
             **kwargs: Parameters of the simulations that we want to match (they should be parameters given in the self.do_data_computations function).
 
+        If all the options in compute_data_CCL.run_options are given, the run is first looked up directly from its id. Otherwise, or if it is not found (outputs named by date by older versions, or computed before the catalogs of the simulation were moved or compacted, which changes the fingerprint in the id), the info of all the outputs is read to find the ones matching. The weight of the ellipticity fields (shear_weight, 'unit' or 'nmap', see compute_data_CCL.shear_weights) can also be given, so the spin-2 spectra of different codes are not mixed.
+
         Returns:
             List of dicts with the info of each run.
         '''
@@ -86,7 +129,27 @@ class CCLReader:
         if not os.path.isdir(self.analysis_location + f'/ccl_data'): 
             return []
 
-        ids = [f.name for f in os.scandir(self.analysis_location + f'/ccl_data') if f.is_dir()]
+        def matches(data):
+            # Outputs computed before shear_weight was saved get it from their code
+            options = dict({'shear_weight': compute_data_CCL.shear_weights.get(data.get('code'))}, **data)
+            for key in kwargs.keys():
+                if key in self.execution_options:
+                    continue
+                # Options added after the output was computed (e.g. seed) are read as None
+                if kwargs[key] != options.get(key):
+                    return False
+            return True
+
+        if all(key in kwargs for key in compute_data_CCL.run_options) and not isinstance(kwargs['nside'], (list, tuple)):
+            id_ = compute_data_CCL.get_run_id(self.get_fingerprint(kwargs['source']), **{key: kwargs[key] for key in compute_data_CCL.run_options})
+            try:
+                data = load_info(f'{self.analysis_location}/ccl_data/{id_}')
+                return [data] if matches(data) else []
+            except FileNotFoundError:
+                pass
+
+        # Hidden folders are outputs being written and checkpoints
+        ids = [f.name for f in os.scandir(self.analysis_location + f'/ccl_data') if f.is_dir() and not f.name.startswith('.')]
 
         if len(ids) == 0: 
             return []
@@ -94,19 +157,29 @@ class CCLReader:
         compatible = []
         for id_ in sorted(ids):
             try:
-                with open(f'{self.analysis_location}/ccl_data/{id_}/INFO.json') as json_file:
-                    data = json.load(json_file)
-                    for key in kwargs.keys():
-                        if kwargs[key] != data[key]:
-                            break
-                    else: 
-                        compatible.append(data)
+                # INFO.json or the attributes of the HDF5 file
+                data = load_info(f'{self.analysis_location}/ccl_data/{id_}')
+                if matches(data):
+                    compatible.append(data)
 
             except FileNotFoundError:
                 pass
         
         return compatible
 
+    def get_fingerprint(self, source=1):
+        '''Get the fingerprint of the catalogs of a source (computed once for each reader)
+
+        Args:
+            source (int, optional): Source of the catalogs (default: 1)
+
+        Returns:
+            Fingerprint as given by compute_data_CCL.get_sim_fingerprint.
+        '''
+        if source not in self.fingerprints:
+            self.fingerprints[source] = compute_data_CCL.get_sim_fingerprint(self.sim_location, source)
+        return self.fingerprints[source]
+
     def remove_computed_data(self):
         while True:
             confirmation = input(f'Remove all computed ccl data from sim {self.sim_location}? (y/n)')
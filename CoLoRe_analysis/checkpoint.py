@@ -0,0 +1,98 @@
+'''
+    Module built to checkpoint the reading of the catalog files, so a computation that stops (walltime, memory, node failure) can continue from the last file saved instead of reading all the catalogs again.
+'''
+
+import logging
+import os
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+class IngestionCheckpoint:
+    '''Class made to save and restore the state of the catalog reading: the partial maps and N(z), the number of files already processed and the state of the global numpy random generator.
+
+    The checkpoint is only restored if it was saved with the same key (hash of the inputs of the reading).
+
+    Attributes:
+        interval (float): Minimum time in seconds between two checkpoints (checkpoints are only saved between files)
+    '''
+
+    interval = 600
+
+    def __init__(self, path, key):
+        '''Inits the checkpoint
+
+        Args:
+            path (str): File of the checkpoint
+            key (str): Hash of the inputs of the reading
+        '''
+        self.path = path
+        self.key = key
+        self.last_save = time.time()
+
+    def exists(self):
+        '''Check if there is a checkpoint saved with the same key
+
+        Returns:
+            True if the checkpoint can be restored.
+        '''
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with np.load(self.path) as checkpoint:
+                return str(checkpoint['key']) == self.key
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def load(self, accumulator):
+        '''Restore the checkpoint into accumulator and the global random generator
+
+        Args:
+            accumulator (MapAccumulator): Accumulator where the partial maps and N(z) are restored
+
+        Returns:
+            Number of files already processed (0 if there is no checkpoint to restore).
+        '''
+        if not self.exists():
+            if os.path.isfile(self.path):
+                log.warning(f'Checkpoint { self.path } was saved with different inputs, starting from the first file')
+            return 0
+
+        with np.load(self.path) as checkpoint:
+            accumulator.nmap = checkpoint['nmap']
+            accumulator.e1map = checkpoint['e1map']
+            accumulator.e2map = checkpoint['e2map']
+            if accumulator.nz is not None:
+                accumulator.nz = checkpoint['nz']
+            np.random.set_state(('MT19937', checkpoint['rng_keys'], int(checkpoint['rng_pos']), int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian'])))
+            nfiles = int(checkpoint['nfiles'])
+
+        log.info(f'Resuming from checkpoint { self.path } after { nfiles } files')
+        return nfiles
+
+    def save(self, accumulator, nfiles, force=False):
+        '''Save the checkpoint if more than interval seconds have passed since the last one
+
+        Args:
+            accumulator (MapAccumulator): Accumulator with the partial maps and N(z)
+            nfiles (int): Number of files already processed
+            force (bool, optional): Save the checkpoint even if interval has not passed (default: False)
+        '''
+        if not force and time.time() - self.last_save < self.interval:
+            return
+
+        _, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        values = dict(nmap=accumulator.nmap, e1map=accumulator.e1map, e2map=accumulator.e2map, nfiles=nfiles, key=self.key,
+                      rng_keys=rng_keys, rng_pos=rng_pos, rng_has_gauss=rng_has_gauss, rng_cached_gaussian=rng_cached_gaussian)
+        if accumulator.nz is not None:
+            values['nz'] = accumulator.nz
+
+        # Written to a temporary file first, so a failure while saving does not break the previous checkpoint
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + f'.{ os.getpid() }.tmp.npz'
+        np.savez(tmp_path, **values)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+        log.debug(f'Checkpoint saved in { self.path } after { nfiles } files')
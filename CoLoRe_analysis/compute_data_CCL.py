@@ -5,43 +5,77 @@
 '''
 
 import argparse
+import glob
 import io
 import json
 import logging
 import os
+import re
 import sys
 import warnings
+import zlib
 from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from itertools import combinations_with_replacement
+from multiprocessing import Pool
+from shutil import rmtree
 
 import healpy as hp
 import numpy as np
-import pyccl as ccl
-from astropy.io import fits
 
-from CoLoRe_analysis import sims_reader
+from CoLoRe_analysis import ccl_reader, sims_reader, theory
+from CoLoRe_analysis.catalog_reader import CatalogReader, PixelIndexCache, get_chunk_rows
+from CoLoRe_analysis.checkpoint import IngestionCheckpoint
 from CoLoRe_analysis.debug_tools import Stopwatch
+from CoLoRe_analysis.map_accumulator import MapAccumulator, degrade_maps
+from CoLoRe_analysis.output_backend import check_output_options, map_storages, output_formats, save_array, save_info, save_map
+from CoLoRe_analysis.thread_control import limit_threads
 
 log = logging.getLogger(__name__)
 
+# Rows sharing a random generator when a seed is given
+random_block_rows = 2**16
+
+# Outputs saved with the map storage option
+map_names = ('nmap', 'e1map', 'e2map')
+
+# Options that define the output of a run (the rest only change how it is computed), the id of the run is a hash of them
+run_options = ('source', 'nside', 'max_files', 'downsampling', 'zbins', 'nz_h', 'nz_min', 'nz_max', 'code', 'seed', 'theory_ell_per_decade', 'lmax', 'ell_edges')
+
+# Weight of the ellipticity fields of each code, saved as shear_weight in the info of the outputs (the spin-2 spectra of codes with different weights are not comparable)
+shear_weights = {'anafast': 'unit', 'namaster': 'nmap', 'fullsky': 'unit'}
+
 
 
 def getArgs(): #pragma: no cover
-    parser = argparse.ArgumentParser(description="Save values to compute CCL test into .dat files")
+    parser = argparse.ArgumentParser(description="Save values to compute CCL test into .dat/.npy files")
     parser.add_argument("--input", required=True, type=str, help="Path of ColoRe run")
     parser.add_argument("--output", required=True, type=str, default=None, help="Path for output files")
     parser.add_argument("--param", required=True, type=str, help="Path of ColoRe param.cfg file")
     
     parser.add_argument("--source",       required=False, type=int, default=1, help="Sources to be computed")
-    parser.add_argument("--nside",        required=False, type=int , default=128 , help="nside to use ")
+    parser.add_argument("--nside",        required=False, type=int , nargs='+', default=[128] , help="nside to use. If several are given, the catalogs are read once and one output is saved for each nside")
     parser.add_argument("--max_files",    required=False, type=int, default=None , help="number of srcs files to consider (default: None, consider all the files)")
     parser.add_argument("--downsampling", required=False, type=float , default=1 , help="downsampling to apply to the data")
     parser.add_argument("--zbins",        required=False, type=float, nargs='+', default=[0,0.15,1] , help="defines the binning in redshift of the analysis")
     parser.add_argument("--nz_h",         required=False, type=int , default=50 , help="pixelization of the redshift analysis ")
     parser.add_argument("--nz_min",       required=False, type=float , default=0 , help="min redshift for the redshfit analysis")
     parser.add_argument("--nz_max",       required=False, type=float , default=None , help="max redshift for the redshfit analysis")
-    parser.add_argument('--code',         required=False, choices=['anafast','namaster'], default='namaster', help='Which code use to compute the cls')
+    parser.add_argument('--code',         required=False, choices=['anafast','namaster','fullsky'], default='namaster', help='Which code use to compute the cls (fullsky computes the spectra without mode-coupling matrices, only valid for maps without empty pixels, and its ellipticity fields have a unit weight as in anafast instead of the number of objects as in namaster)')
+    parser.add_argument('--n_workers',    required=False, type=int, default=1, help='Number of processes used to read the catalog files')
+    parser.add_argument('--chunk_rows',   required=False, type=int, default=None, help='Number of catalog rows processed at once (default: set from the available memory)')
+    parser.add_argument('--seed',         required=False, type=int, default=None, help='Seed for the photo-z scatter and the downsampling (results do not depend on n_workers or chunk_rows when it is given)')
+    parser.add_argument('--lmax',         required=False, type=int, default=None, help='Maximum multipole of the power spectra (default: 3*nside-1)')
+    parser.add_argument('--ell_edges',    required=False, type=int, nargs='+', default=None, help='Edges of the bandpowers of the power spectra (default: one bandpower per multipole)')
+    parser.add_argument('--theory_ell_per_decade', required=False, type=int, default=None, help='Compute the theory power spectra at this number of log-spaced multipoles per decade and interpolate the rest (default: compute all the multipoles)')
+    parser.add_argument('--workspace_cache_dir', required=False, type=str, default=None, help='Folder where the NaMaster workspaces are cached, it can be shared by several simulations (default: { output }/namaster_workspaces)')
+    parser.add_argument('--threads',      required=False, type=int, default=None, help='Number of OpenMP/BLAS threads used by healpy, NaMaster and CCL in each process (default: library defaults)')
+    parser.add_argument('--output_format', required=False, choices=output_formats, default='dat', help='Format of the output arrays: dat (text), npy (binary), npy32 (binary, floats in single precision), h5 (one HDF5 file per output, with the info as attributes) or h5gz (h5 compressed)')
+    parser.add_argument('--map_storage',  required=False, choices=map_storages, default='full', help='Storage of the nmap/e1map/e2map outputs: full (as the rest of arrays), compact (nmap as integers, the rest in single precision) or partial (compact, as (pixel, value) pairs when most pixels are empty). compact and partial need a binary output_format')
+    parser.add_argument('--checkpoint',   required=False, action='store_true', help='Checkpoint the reading of the catalogs, so the run can be resumed if it stops')
+    parser.add_argument('--resume',       required=False, action='store_true', help='Continue the run with the same options that stopped while reading the catalogs from its last checkpoint')
+    parser.add_argument('--max_pixel_nside', required=False, type=int, default=4096, help='nside of the pixel index stored for each catalog file (in the catalog_cache folder of the output), lower nside are derived from it (0 to disable the cache)')
 
     parser.add_argument('--log',          required=False, default=None, help='Setup logging, use levelname as string  (Set to INFO to see script timings)')
 
@@ -60,6 +94,9 @@ def main(args=None):
     options.pop('output')
     options.pop('param')
     options.pop('log')
+    execution_options = {key: options.pop(key) for key in ccl_reader.CCLReader.execution_options}
+    nsides = options.pop('nside')
+    nsides = [nsides] if np.isscalar(nsides) else nsides
 
     if args.log is not None:
         level = logging.getLevelName(args.log)
@@ -76,11 +113,7 @@ def main(args=None):
         else:
             sim = sims_reader.Sim0404(output)
             sim.set_ccl_reader()
-            f1 = sys.stdin 
-            f = io.StringIO('y') # "mocking" input to force a yes
-            sys.stdin = f
-            _ = sim.ccl_reader.get_values('cl_mm_t', **options)
-            sys.stdin = f1
+            sim.ccl_reader.compute_missing_nsides(nsides, **execution_options, **options)
     else:
         os.makedirs(output)
         info = {
@@ -102,15 +135,17 @@ def main(args=None):
         sys.stdin = f
         sim = sims_reader.Sim0404(output)
 
-        sim.set_ccl_reader()
-        f = io.StringIO('y')
-        sys.stdin = f
-        sim.ccl_reader.get_values('cl_mm_t', **options)
         sys.stdin = f1
 
-def savetofile(location,variables,variables_names):
+        sim.set_ccl_reader()
+        sim.ccl_reader.compute_missing_nsides(nsides, **execution_options, **options)
+
+def savetofile(location,variables,variables_names,output_format='dat',map_storage=None):
     for i,variable in enumerate(variables):
-        np.savetxt( location + '/' + variables_names[i] + '.dat', variable)
+        if map_storage is not None:
+            save_map(location, variables_names[i], variable, output_format, map_storage)
+        else:
+            save_array(location, variables_names[i], variable, output_format)
     return
     
 @contextmanager   # Code to avoid output temporarily
@@ -126,49 +161,139 @@ def suppress_stdout():
 def fxn():
     warnings.warn("deprecrated", DeprecationWarning)
 
-def compute_data(sim_path, analysis_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, code=None):
+def compute_data(sim_path, analysis_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, code=None, n_workers=1, chunk_rows=None, max_pixel_nside=4096, seed=None, theory_ell_per_decade=None, workspace_cache_dir=None, threads=None, lmax=None, ell_edges=None, output_format='dat', map_storage='full', resume=False, checkpoint=False):
     ''' Method to compute the values needed for CCL test plots.
     
     Args:
         sim_path (str): Path where the CoLoRe simulation is located.
         source (int, optional): Source of which to compute data (default: 1)
+        nside (int or list of int, optional): nside to use. If a list is given, the catalogs are read once at the highest nside and the maps for the rest are obtained by summing child pixels. One output is saved for each nside (default: 128)
         output_path (str, optional): Output where to save the data (default: { sim_path }/ccl_data/{ datetime.now() }/)
+        n_workers (int, optional): number of processes used to read the catalog files (and the P(k) files) (default: 1)
+        chunk_rows (int, optional): number of rows of the catalogs processed at once (default: None, set from the available memory)
+        max_pixel_nside (int, optional): nside of the pixel index stored for each catalog file, stored in the catalog_cache folder of analysis_path (the simulation is never written), lower nside are derived from it. Set to 0/None to compute the pixels from the angles in each run (default: 4096)
+        seed (int, optional): seed for the photo-z scatter and the downsampling. Each catalog file (and block of rows) gets an independent random stream, so the result does not depend on the number of workers or the chunk size (default: None, use the global numpy random state in file order)
+        theory_ell_per_decade (int, optional): compute the theory power spectra at this number of log-spaced multipoles per decade and interpolate the rest. The maximum relative error of the interpolation is saved in INFO.json (default: None, compute all the multipoles)
+        workspace_cache_dir (str, optional): folder where the NaMaster workspaces are cached. It can be shared by several simulations (default: None, use { analysis_path }/namaster_workspaces)
+        threads (int, optional): number of OpenMP/BLAS threads used by healpy, NaMaster and CCL. The threads used in each stage are saved in INFO.json (default: None, use the library defaults)
+        lmax (int, optional): maximum multipole of the power spectra (default: None, 3*nside-1 or the last bandpower given by ell_edges)
+        ell_edges (list of int, optional): edges of the bandpowers, each one averages the multipoles ell_edges[i] <= ell < ell_edges[i+1]. The edges used are saved as ell_edges (default: None, one bandpower per multipole)
+        output_format (str, optional): format of the output arrays: 'dat' (text), 'npy' (binary), 'npy32' (binary with floats in single precision), 'h5' (one HDF5 file per output, with the info saved as attributes instead of INFO.json) or 'h5gz' (h5 with gzip compression). CCLReader reads any of them (default: 'dat')
+        map_storage (str, optional): storage of the nmap/e1map/e2map outputs: 'full' (as the rest of arrays), 'compact' (nmap as integers and the rest in single precision) or 'partial' (compact, saved as (pixel index, value) pairs when most of the pixels are empty). compact and partial need a binary output_format. CCLReader expands the maps when reading them (default: 'full')
+        resume (bool, optional): continue a run with the same options that did not finish, from the last checkpoint of the reading of the catalogs. The result is the same as the one of an uninterrupted run. The resumed run is also checkpointed (default: False, remove the checkpoints and start from the first file)
+        checkpoint (bool, optional): checkpoint the reading of the catalogs (the partial maps are saved in ccl_data/.checkpoints every IngestionCheckpoint.interval seconds and after the last file, until the run is complete), so the run can be resumed (default: False, no checkpoints)
     '''
-    id_ = datetime.today().strftime('%Y%m%d_%H%M%S')
-    output_path = analysis_path + f"/ccl_data/{ id_ }"
-    os.makedirs(output_path, exist_ok = True)
-    
-    log.debug(f'Computing data for:\nsim_path: { sim_path }\nsource: { source }\noutput_path: { output_path }')
-
-
     if code == 'anafast':
-        values = compute_all_cls_anafast(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max)
+        compute_all_cls = compute_all_cls_anafast
     elif code == 'namaster':
-        values = compute_all_cls_namaster(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max)
+        compute_all_cls = compute_all_cls_namaster
+    elif code == 'fullsky':
+        compute_all_cls = compute_all_cls_fullsky
     else:
-        raise ValueError('Not a valid code name enter namaster/anafast')
-
-    for name, value in values.items():
-        savetofile(output_path, (value,), (name,) )
-
-    info = {
-        'id'            : id_,
-        'source'        : source,
-        'nside'         : nside,
-        'max_files'     : max_files,
-        'downsampling'  : downsampling,
-        'zbins'         : zbins,
-        'nz_h'          : nz_h,
-        'nz_min'        : nz_min,
-        'nz_max'        : nz_max,
-        'code'          : code
-    }
+        raise ValueError('Not a valid code name enter namaster/anafast/fullsky')
+
+    check_output_options(output_format, map_storage)
+
+    if workspace_cache_dir is None:
+        workspace_cache_dir = analysis_path + '/namaster_workspaces'
+    # Stored with the analysis, the simulation may be shared or read-only
+    pixel_cache_dir = analysis_path + '/catalog_cache'
+
+    nsides = [nside] if np.isscalar(nside) else sorted(set(nside), reverse=True)
+
+    # Each output is named by the hash of its options, so the same run always gets the same folder
+    fingerprint = get_sim_fingerprint(sim_path, source)
+    run_ids = {nside: get_run_id(fingerprint, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, code, seed, theory_ell_per_decade, lmax, ell_edges) for nside in nsides}
+
+    # The reading of the catalogs can be checkpointed in a folder of the run of the highest nside, kept until the run is complete
+    run_checkpoint_dir = analysis_path + f'/ccl_data/.checkpoints/{ run_ids[nsides[0]] }'
+    checkpoints = glob.glob(run_checkpoint_dir + '/checkpoint_*.npz')
+    if resume and len(checkpoints) == 0:
+        log.warning('No checkpoint found to resume, starting from the first file')
+    elif not resume:
+        for path in checkpoints:
+            os.remove(path)
+    # Each checkpoint writes the full maps, so runs that will not be resumed are not checkpointed
+    checkpoint_dir = run_checkpoint_dir if checkpoint or resume else None
+
+    maps = None
+    if len(nsides) > 1:
+        log.info(f'Reading catalogs once for nsides: { nsides }')
+        maps = read_catalogs(sim_path, source, nsides[0], max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, checkpoint_dir, pixel_cache_dir)
+
+    for nside in nsides:
+        # Each nside of a sweep gets its own output
+        output_id = run_ids[nside]
+        output_path = analysis_path + f"/ccl_data/{ output_id }"
+        # Written into a temporary folder that replaces the output once complete, so a run with the same options (finished or running at the same time) never sees a partial output
+        tmp_path = analysis_path + f"/ccl_data/.{ output_id }.{ os.getpid() }.tmp"
+        os.makedirs(tmp_path)
+
+        log.debug(f'Computing data for:\nsim_path: { sim_path }\nsource: { source }\nnside: { nside }\noutput_path: { output_path }')
+
+        if maps is not None:
+            nmap, e1map, e2map, nz_tot, z_nz = maps
+            nside_maps = (*degrade_maps([nmap, e1map, e2map], nside), nz_tot, z_nz)
+        else:
+            nside_maps = None
+
+        try:
+            values = compute_all_cls(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, maps=nside_maps, theory_cache_dir=analysis_path + '/theory_cache', theory_ell_per_decade=theory_ell_per_decade, workspace_cache_dir=workspace_cache_dir, threads=threads, lmax=lmax, ell_edges=ell_edges, checkpoint_dir=checkpoint_dir, pixel_cache_dir=pixel_cache_dir)
+            # Values saved in INFO.json instead of .dat files
+            extra_info = values.pop('info', {})
+
+            for name, value in values.items():
+                savetofile(tmp_path, (value,), (name,), output_format, map_storage if name in map_names else None)
+
+            info = {
+                'id'            : output_id,
+                'source'        : source,
+                'nside'         : nside,
+                'max_files'     : max_files,
+                'downsampling'  : downsampling,
+                'zbins'         : zbins,
+                'nz_h'          : nz_h,
+                'nz_min'        : nz_min,
+                'nz_max'        : nz_max,
+                'code'          : code,
+                'shear_weight'  : shear_weights[code],
+                'seed'          : seed,
+                'theory_ell_per_decade' : theory_ell_per_decade,
+                'lmax'          : lmax,
+                'ell_edges'     : [int(ell) for ell in ell_edges] if ell_edges is not None else None,
+                'date'          : datetime.today().strftime('%Y%m%d_%H%M%S')
+            }
+            info.update(extra_info)
+
+            save_info(tmp_path, info, output_format)
+            replace_output(tmp_path, output_path)
+        finally:
+            if os.path.isdir(tmp_path):
+                rmtree(tmp_path)
 
-    with open(output_path + '/INFO.json','w') as outfile:
-        json.dump(info, outfile)
+    # The run is complete, the checkpoints are not needed anymore
+    rmtree(run_checkpoint_dir, ignore_errors=True)
 
-def compute_all_cls_anafast(sim_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None):
-    '''Method to compute all cls from the anafast function using output from CoLoRe.
+def replace_output(tmp_path, output_path):
+    '''Move a complete output into its folder, replacing the output of a previous run with the same options
+
+    Args:
+        tmp_path (str): Folder where the output was written.
+        output_path (str): Folder of the output.
+    '''
+    if os.path.isdir(output_path):
+        log.info(f'Replacing the previous output in { output_path }')
+        rmtree(output_path, ignore_errors=True)
+    try:
+        os.replace(tmp_path, output_path)
+    except OSError:
+        if not os.path.isdir(output_path):
+            raise
+        # Another run with the same options finished in the meantime, its output is kept
+        log.warning(f'Output { output_path } was written by another run, keeping it')
+
+def read_catalogs(sim_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, n_workers=1, chunk_rows=None, max_pixel_nside=4096, seed=None, checkpoint_dir=None, pixel_cache_dir=None):
+    '''Method to build the number and ellipticity maps and the N(z) of each redshift bin from the CoLoRe source catalogs.
 
     Args:
         sim_path (str): Path where the CoLoRe simulation is located.
@@ -180,203 +305,405 @@ def compute_all_cls_anafast(sim_path, source=1, nside=128, max_files=None, downs
         nz_h (int, optional): pixelization of the redshift analysis (default: 50)
         nz_min (float, optional): min redshift for the N(z) histogram (default: 0)
         nz_max (float, optional): max redshift for the N(z) histogram (default: None (set to the max value in zbins))
-    
-    Returns: 
-        Tuple given by (shotnoise, pairs, nz_tot, z_nz, d_values, cl_dd_t, cl_dm_t, cl_mm_t):
-            d_values: Array of shape (3,6,384) with all the pairs in [(0,0),(0,1),(1,1)] for all the combinations TT, TE, TB, EE, EB, BB for the anafast function. 
+        n_workers (int, optional): number of processes reading the catalog files. Each one builds partial maps for a subset of the files and they are summed at the end (default: 1)
+        chunk_rows (int, optional): number of rows of the catalogs processed at once (default: None, set from the available memory)
+        max_pixel_nside (int, optional): nside of the pixel index stored for each catalog file, lower nside are derived from it. Set to 0/None to compute the pixels from the angles in each run (default: 4096)
+        seed (int, optional): seed for the photo-z scatter and the downsampling. Each catalog file (and block of rows) gets an independent random stream, so the result does not depend on the number of workers or the chunk size (default: None, use the global numpy random state in file order. With several workers, each one gets its own stream derived from the global state)
+        checkpoint_dir (str, optional): folder where the partial maps and N(z) of each worker are checkpointed every IngestionCheckpoint.interval seconds. If it has a checkpoint saved with the same inputs, the reading continues from it. Without a seed and with downsampling, the result of a resumed run is only the same if chunk_rows is the same (default: None, no checkpoints)
+        pixel_cache_dir (str, optional): folder where the pixel index of each catalog file is stored, it should be outside of the simulation (default: None, compute the pixels from the angles)
+
+    Returns:
+        Tuple given by (nmap, e1map, e2map, nz_tot, z_nz):
+            nmap, e1map, e2map: Arrays of shape (nbins, npix) with the number of sources and the sum of ellipticities in each pixel.
+            nz_tot: Array of shape (nbins, nz_h) with the N(z) of each bin.
+            z_nz: Midpoint of the N(z) histogram.
     '''
+    nz_max = nz_max if nz_max is not None else zbins[-1]
 
-    # Hubble constant
-    h = 0.7
+    files = CatalogReader(sim_path, source).get_files(max_files)
+    if chunk_rows is None:
+        chunk_rows = get_chunk_rows(bytes_per_row=128 + 2*len(zbins), memory_fraction=0.25/n_workers)
+    log.info(f'Reading catalogs in chunks of { chunk_rows } rows')
+    pixel_cache = PixelIndexCache(pixel_cache_dir, max_pixel_nside) if pixel_cache_dir is not None and max_pixel_nside else None
+    if pixel_cache is not None and not pixel_cache.can_degrade(nside):
+        # Only power of 2 nside up to max_pixel_nside are derived from the cache, the rest are computed from the angles
+        pixel_cache = None
+    args = (nside, downsampling, zbins, nz_h, nz_min, nz_max, chunk_rows, pixel_cache, seed)
+
+    # One checkpoint for each worker
+    checkpoints = n_workers*[None]
+    if checkpoint_dir is not None:
+        key = get_checkpoint_key(files, nside, downsampling, zbins, nz_h, nz_min, nz_max, seed, n_workers)
+        checkpoints = [IngestionCheckpoint(checkpoint_dir + f'/checkpoint_{ i }.npz', key) for i in range(n_workers)]
+
+    if n_workers == 1:
+        nmap, e1map, e2map, nz_tot = read_catalog_files(files, *args, checkpoints[0])
+    else:
+        # Files are interleaved between workers to balance the load 
+        subsets = [files[i::n_workers] for i in range(n_workers)]
+        # Forked workers inherit the same global random state, so without a seed each one is given its own stream (derived from the global state to keep np.random.seed reproducible)
+        worker_seeds = n_workers*[None]
+        if seed is None:
+            worker_seeds = [int(sequence.generate_state(1)[0]) for sequence in np.random.SeedSequence(np.random.randint(2**31)).spawn(n_workers)]
+        with Pool(processes=n_workers) as pool:
+            partials = pool.starmap(read_catalog_files, [(subset, *args, checkpoint, worker_seed) for subset, checkpoint, worker_seed in zip(subsets, checkpoints, worker_seeds)])
+        nmap, e1map, e2map, nz_tot = [np.sum(partial, axis=0) for partial in zip(*partials)]
+
+    # Midpoint of N(z) histogram (same edges, and dtype, as the ones given by np.histogram for the Z_COSMO column)
+    z_edges = np.histogram_bin_edges(np.zeros(0, dtype=np.float32), bins=nz_h, range=[nz_min, nz_max])
+    z_nz = 0.5*(z_edges[1:] + z_edges[:-1])
 
-    nside = nside
-    npix = hp.nside2npix(nside)
+    return nmap, e1map, e2map, nz_tot, z_nz
 
-    nbins   = len(zbins) - 1
-    pairs   = list(combinations_with_replacement(range(nbins), r=2))
+def read_catalog_files(files, nside, downsampling, zbins, nz_h, nz_min, nz_max, chunk_rows=None, pixel_cache=None, seed=None, checkpoint=None, worker_seed=None):
+    '''Method to build the number and ellipticity maps and the N(z) of each redshift bin for a list of catalog files.
 
+    Args:
+        files (list of str): Catalog files to read.
+        pixel_cache (PixelIndexCache, optional): Cache with the pixel of each object, if None the pixels are computed from RA, DEC (default: None)
+        checkpoint (IngestionCheckpoint, optional): Checkpoint to resume from and to save the progress after the files (default: None)
+        worker_seed (int, optional): Seed of the global numpy random state, set before reading when seed is None (default: None, keep the current state)
+        Rest of the arguments as in read_catalogs (nz_max should be already set).
+
+    Returns:
+        Tuple given by (nmap, e1map, e2map, nz_tot).
+    '''
+    sigz = 0.03
+
+    accumulator = MapAccumulator(nside, zbins, nz_h, nz_min, nz_max)
+    # With the pixel cache the angles are not needed
+    columns = ('Z_COSMO', 'E1', 'E2') if pixel_cache is not None else CatalogReader.columns
+
+    if seed is None and worker_seed is not None:
+        np.random.seed(worker_seed)
+    first_file = checkpoint.load(accumulator) if checkpoint is not None else 0
+    for i, filename in enumerate(files[first_file:], first_file):
+        file_watch = Stopwatch()
+        log.info(f'Reading file: { filename }')
+        start = 0
+        # Maps and N(z) are accumulated chunk by chunk, so the memory needed does not depend on the file size
+        for d in CatalogReader.read_file_chunks(filename, columns, chunk_rows, pixel_cache, nside):
+            n_g = len(d['Z_COSMO'])
+
+            if seed is None:
+                noise = np.random.randn(n_g)
+                uniform = np.random.random(n_g) if downsampling != 1 else None #pylint: disable=no-member
+            else:
+                noise, uniform = get_random_values(seed, filename, start, n_g, downsampling != 1)
+            start += n_g
+
+            # Generate random photo-z
+            z_photo = d['Z_COSMO'] + sigz*(1+d['Z_COSMO'])*noise
+
+            if downsampling != 1: 
+                d_mask = uniform < downsampling
+            else:
+                d_mask = None
+
+            # Bins are given by the photo-z, the N(z) by the true redshift
+            accumulator.add(d.get('RA'), d.get('DEC'), z_photo, d['E1'], d['E2'], z_nz=d['Z_COSMO'], mask=d_mask, pix=d.get('PIX'))
+        log.info(f'File { filename } processed. Time ellapsed: {file_watch.full()} s')
+        if checkpoint is not None:
+            # Always saved after the last file, so a failure computing the cls does not need to read the catalogs again
+            checkpoint.save(accumulator, i + 1, force=(i + 1 == len(files)))
+
+    return accumulator.nmap, accumulator.e1map, accumulator.e2map, accumulator.nz
+
+def get_checkpoint_key(files, nside, downsampling, zbins, nz_h, nz_min, nz_max, seed, n_workers):
+    '''Get the key identifying the checkpoints of the reading of a set of catalog files
+
+    Args:
+        files (list of str): Catalog files to read (their names and sizes are part of the key)
+        Rest of the arguments as in read_catalogs (nz_max should be already set).
 
-    # This will contain the N(z) of the different bins
-    nz_tot = np.zeros([nbins, nz_h])
+    Returns:
+        Hexadecimal hash of the inputs.
+    '''
+    catalogs = [(os.path.basename(filename), os.path.getsize(filename)) for filename in files]
+    return theory.TheoryCache.get_key(files=catalogs, nside=nside, downsampling=downsampling, zbins=list(zbins), nz_h=nz_h, nz_min=nz_min, nz_max=nz_max, seed=seed, n_workers=n_workers)
+
+def get_sim_fingerprint(sim_path, source=1):
+    '''Get the fingerprint of the catalogs of a simulation
+
+    Args:
+        sim_path (str): Path where the CoLoRe simulation is located.
+        source (int, optional): Source of the catalogs (default: 1)
+
+    Returns:
+        Hexadecimal hash of the names and sizes of the catalog files.
+    '''
+    files = CatalogReader(sim_path, source).get_files()
+    return theory.TheoryCache.get_key(files=[(os.path.basename(filename), os.path.getsize(filename)) for filename in files])
+
+def get_run_id(fingerprint, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h=50, nz_min=0, nz_max=None, code=None, seed=None, theory_ell_per_decade=None, lmax=None, ell_edges=None):
+    '''Get the id of a run from the options that define its output (run_options) and the fingerprint of the simulation
+
+    Defaults are applied and numbers are converted to a canonical type first, so e.g. zbins=[0, 1] and zbins=[0., 1.], or nz_max=None and nz_max=zbins[-1], give the same id.
+
+    Args:
+        fingerprint (str): Fingerprint of the simulation, as given by get_sim_fingerprint
+        Rest of the arguments as in compute_data (nside should be a single value).
+
+    Returns:
+        Id of the run (16 hexadecimal characters).
+    '''
     nz_max = nz_max if nz_max is not None else zbins[-1]
+    to_int = lambda value: None if value is None else int(value)
+    to_float = lambda value: None if value is None else float(value)
+    key = theory.TheoryCache.get_key(fingerprint=fingerprint, source=to_int(source), nside=to_int(nside), max_files=to_int(max_files), downsampling=to_float(downsampling),
+                                     zbins=[float(z) for z in zbins], nz_h=to_int(nz_h), nz_min=to_float(nz_min), nz_max=to_float(nz_max), code=code, seed=to_int(seed),
+                                     theory_ell_per_decade=to_int(theory_ell_per_decade), lmax=to_int(lmax), ell_edges=None if ell_edges is None else [int(ell) for ell in ell_edges])
+    return key[:16]
+
+def get_random_values(seed, filename, start, nrows, uniform=False):
+    '''Method to get the random values for some rows of a catalog file. 
     
-    sigz = 0.03
+    Values are generated in blocks of random_block_rows rows, each one with its own generator derived from a SeedSequence (seed, file, block), so they do not depend on the order in which files and chunks are processed. Chunks do not need to be aligned with the blocks: the last blocks are kept, so reading a file in consecutive chunks generates each block once.
 
-    # These will be the density and ellipticity maps
-    dmap = np.zeros([nbins, npix])
-    e1map = np.zeros([nbins, npix])
-    e2map = np.zeros([nbins, npix])
+    Args:
+        seed (int): Seed of the run.
+        filename (str): Catalog file.
+        start (int): First row.
+        nrows (int): Number of rows.
+        uniform (bool, optional): Also give uniform values (default: False)
+
+    Returns:
+        Tuple (normal, uniform) with standard normal and uniform values for each row (uniform is None if not requested).
+    '''
+    match = re.search(r'_s(\d+)_(\d+)\.fits$', filename)
+    file_key = tuple(int(x) for x in match.groups()) if match else (zlib.crc32(os.path.basename(filename).encode()),)
 
-    # Now we loop over all source files
-    if max_files is None:
-        file_limit = False
-    else:
-        file_limit = True
+    normal = np.empty(nrows)
+    uniforms = np.empty(nrows) if uniform else None
+    first_block = start // random_block_rows
+    for block in range(first_block, -(-(start + nrows) // random_block_rows)):
+        block_start = block*random_block_rows
+        lo, hi = max(start, block_start), min(start + nrows, block_start + random_block_rows)
 
-    ifile = 0
+        block_normal, block_uniform = get_random_block(seed, file_key, block, uniform)
+        normal[lo-start:hi-start] = block_normal[lo-block_start:hi-block_start]
+        if uniform:
+            uniforms[lo-start:hi-start] = block_uniform[lo-block_start:hi-block_start]
 
-    timer = Stopwatch()
-    log.info('Reading output files...')
-    while os.path.isfile(sim_path + '/out_srcs_s1_%d.fits' % ifile) and ( (not file_limit) or ifile <= max_files):
-        file_watch = Stopwatch()
-        log.info('Reading file: ' + ifile)
-        hdulist = fits.open(sim_path + '/out_srcs_s1_%d.fits' % ifile)
-        d = hdulist[1].data
-        n_g = len(d)
+    return normal, uniforms
 
-        # Generate random photo-z
-        z_photo = d['Z_COSMO'] + sigz*(1+d['Z_COSMO'])*np.random.randn(n_g)
+@lru_cache(maxsize=2)
+def get_random_block(seed, file_key, block, uniform=False):
+    '''Method to generate the random values of a block of rows of a catalog file (see get_random_values).
 
-        if downsampling != 1: 
-            d_mask = np.random.random(len(z_photo)) < downsampling #pylint: disable=no-member
-        else:
-            d_mask = np.full(len(z_photo), True, dtype=bool)
+    Args:
+        seed (int): Seed of the run.
+        file_key (tuple of int): Key of the catalog file.
+        block (int): Index of the block.
+        uniform (bool, optional): Also give uniform values (default: False)
 
-        masks = []
-        for i in range(nbins):
-            masks.append( (zbins[i] <= z_photo) & (z_photo < zbins[i+1]) )
-        
-        masks = [(mask & d_mask) for mask in masks]  # applying downsampling here
-
-        # For each bin, add to the number and ellipticity maps
-        for ibin, msk in enumerate( masks ):
-            dd = d[msk]
-
-            pix = hp.ang2pix(nside,
-                            np.radians(90-dd['DEC']),
-                            np.radians(dd['RA']))
-            n = np.bincount(pix, minlength=npix)
-            e1 = np.bincount(pix, minlength=npix, weights=dd['E1'])
-            e2 = np.bincount(pix, minlength=npix, weights=dd['E2'])
-            dmap[ibin, :] += n
-            e1map[ibin, :] += e1
-            e2map[ibin, :] += e2
-
-            # Add also to N(z)
-            nz, z_edges = np.histogram(dd['Z_COSMO'], bins=nz_h,
-                                    range=[nz_min, nz_max])
-            nz_tot[ibin, :] += nz
-        ifile += 1
-        log.info(f'File {ifile} processed. Time ellapsed: {file_watch.full()} s')
-
-    # Midpoint of N(z) histogram
-    z_nz = 0.5*(z_edges[1:] + z_edges[:-1])
-    log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Computing maps...')
-    # Compute <e> map and overdensity map
-    # Compute also shot noise level
-    shotnoise = np.zeros(nbins)
-    for ib in range(nbins):
-        ndens = (np.sum(dmap[ib])+0.0)/(4*np.pi)
-        shotnoise[ib] = 1./ndens
-        e1map[ib, :] = e1map[ib]/dmap[ib]
-        e1map[ib, dmap[ib] <= 0] = 0
-        e2map[ib, :] = e2map[ib]/dmap[ib]
-        e2map[ib, dmap[ib] <= 0] = 0
-        dmap[ib, :] = (dmap[ib, :] + 0.0) / np.mean(dmap[ib] + 0.0) - 1
+    Returns:
+        Tuple (normal, uniform) with random_block_rows values each (uniform is None if not requested).
+    '''
+    # Independent streams for normal and uniform values, so the normal ones do not depend on the downsampling
+    sequence = np.random.SeedSequence(seed, spawn_key=(*file_key, block))
+    normal_stream, uniform_stream = [np.random.default_rng(child) for child in sequence.spawn(2)]
+    normal = normal_stream.standard_normal(random_block_rows)
+    return normal, uniform_stream.random(random_block_rows) if uniform else None
 
-    # Read P(k) theory prediction
-    zs = []
-    pks_dd = []
-    pks_dm = []
-    pks_mm = []
-    z_pk = 0.
-    
-    log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Reading pk files...')
-    while os.path.isfile(sim_path + "/out_pk_srcs_pop0_z%.3lf.txt" % z_pk):
-        ks, pdd, pdm, pmm = np.loadtxt(sim_path + "/out_pk_srcs_pop0_z%.3lf.txt" % z_pk, unpack=True)
-        # The delta-delta prediction involves some Fourier transforms that make it unstable
-        # at high-k, so we just set it to zero.
-        pdd[pmm<1E-30] = 0
-        pks_dd.append(pdd)
-        pks_dm.append(pdm)
-        pks_mm.append(pmm)
-        zs.append(z_pk)
-        z_pk += 0.1
-    # Reverse order (because CCL needs increasing scale factor - not redshift).
-    # Also, CCL uses non-h units.
-    zs = np.array(zs)[::-1]
-    ks = np.array(ks) * h
-    pks_dd = np.array(pks_dd)[::-1, :] / h**3
-    pks_dm = np.array(pks_dm)[::-1, :] / h**3
-    pks_mm = np.array(pks_mm)[::-1, :] / h**3
+def get_namaster_workspace(field1, field2, bins, key, cache_dir=None):
+    '''Get the NaMaster workspace (mode-coupling matrix) of a pair of fields.
 
+    The coupling matrix only depends on the masks and spins of the fields, the nside and the binning. Workspaces are stored in cache_dir named by a hash of them (key), so they are reused by other runs and simulations sharing the folder.
 
-    log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Creating CCLd structures...')
-    # Create CCL P(k) structures
-    cosmo = ccl.Cosmology(Omega_c=0.25, Omega_b=0.05, h=h, n_s=0.96, sigma8=0.8)
-    pk2d_dd = ccl.Pk2D(a_arr=1./(1+zs), lk_arr=np.log(ks), pk_arr=pks_dd,
-                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
-    pk2d_dm = ccl.Pk2D(a_arr=1./(1+zs), lk_arr=np.log(ks), pk_arr=pks_dm,
-                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
-    pk2d_mm = ccl.Pk2D(a_arr=1./(1+zs), lk_arr=np.log(ks), pk_arr=pks_mm,
-                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
-    # These can be evaluated as follows:
-    pk2d_dd.eval(k=0.1, a=1/(1+0.2), cosmo=cosmo) # This was printed by David!
-
-    # Create a number counts and a weak lensing tracer for each of the bins
-    tr_d = [ccl.NumberCountsTracer(cosmo, False, (z_nz, nz_tot[i]), bias=(z_nz, np.ones_like(z_nz)))
-            for i in range(nbins)]
-    tr_l = [ccl.WeakLensingTracer(cosmo, (z_nz, nz_tot[i])) for i in range(nbins)]
+    Args:
+        field1 (NmtField): First field
+        field2 (NmtField): Second field
+        bins (NmtBin): Binning of the power spectra
+        key (str): Hash of the masks, spins, nside and binning
+        cache_dir (str, optional): Folder of the cached workspaces (default: None, compute the workspace)
+
+    Returns:
+        NmtWorkspace with the coupling matrix computed.
+    '''
+    import pymaster as nmt
 
+    workspace = nmt.NmtWorkspace()
+    path = cache_dir + f'/{ key }.fits' if cache_dir is not None else None
 
-    log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Computing CCL power spectra...')
-    # Compute power spectra. I'm only doing delta-delta here.
-    larr = np.arange(3*nside)
-    cl_dd_t = np.array([ccl.angular_cl(cosmo, tr_d[p1], tr_d[p2], larr, p_of_k_a=pk2d_dd)
-                        for p1, p2 in pairs])
-    cl_dm_t = np.array([ccl.angular_cl(cosmo, tr_d[p1], tr_l[p2], larr, p_of_k_a=pk2d_dm)
-                        for p1, p2 in pairs])
-    cl_mm_t = np.array([ccl.angular_cl(cosmo, tr_l[p1], tr_l[p2], larr, p_of_k_a=pk2d_mm)
-                        for p1, p2 in pairs])
-    cl_md_t = np.array([ccl.angular_cl(cosmo, tr_d[p1], tr_l[p2], larr, p_of_k_a=pk2d_dm)
-                        for p2, p1 in pairs])
+    if path is not None and os.path.isfile(path):
+        try:
+            workspace.read_from(path)
+            log.debug(f'NaMaster workspace read from { path }')
+            return workspace
+        except Exception:
+            log.warning(f'NaMaster workspace { path } could not be read, computing it again')
 
+    workspace.compute_coupling_matrix(field1, field2, bins)
 
-    log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Computing values from data...')
-    d_values = np.array([hp.anafast(np.asarray([dmap[p1],e1map[p1],e2map[p1]]),np.asarray([dmap[p2],e1map[p2],e2map[p2]]), pol=True) for p1,p2 in pairs])
+    if path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_dir + f'/{ key }.{ os.getpid() }.tmp.fits'
+            workspace.write_to(tmp_path)
+            os.replace(tmp_path, path)
+        except (OSError, RuntimeError):
+            log.warning(f'NaMaster workspace could not be cached in { cache_dir }')
+    return workspace
+
+def get_ell_edges(nside, lmax=None, ell_edges=None):
+    '''Get the edges of the bandpowers of the power spectra
+
+    Args:
+        nside (int): nside of the maps
+        lmax (int, optional): Maximum multipole (default: None, 3*nside-1 or the last bandpower given by ell_edges)
+        ell_edges (array of int, optional): Edges of the bandpowers, each one includes the multipoles ell_edges[i] <= ell < ell_edges[i+1] (default: None, one bandpower per multipole)
+
+    Returns:
+        Array of int with the edges.
+    '''
+    if ell_edges is None:
+        lmax = 3*nside - 1 if lmax is None else lmax
+        return np.arange(lmax + 2)
+
+    ell_edges = np.asarray(ell_edges, dtype=int)
+    if lmax is not None:
+        ell_edges = ell_edges[ell_edges <= lmax + 1]
+    if len(ell_edges) < 2 or np.any(np.diff(ell_edges) <= 0) or ell_edges[0] < 0:
+        raise ValueError(f'Not valid bandpower edges: { ell_edges }')
+    return ell_edges
+
+def bin_cls(cls, ell_edges):
+    '''Average power spectra into bandpowers (with the same uniform weights as NmtBin.from_edges)
+
+    Args:
+        cls (array): Power spectra starting at ell=0, with shape (..., nell)
+        ell_edges (array of int): Edges of the bandpowers as given by get_ell_edges
 
-    cl_md_d = np.copy(d_values[:,3])
+    Returns:
+        Array with shape (..., len(ell_edges)-1).
+    '''
+    ell_edges = np.asarray(ell_edges)
+    cls = np.asarray(cls)[..., ell_edges[0]:ell_edges[-1]]
+    return np.add.reduceat(cls, ell_edges[:-1] - ell_edges[0], axis=-1) / np.diff(ell_edges)
+
+def compute_alms(dmap, e1map, e2map, iter=0, lmax=None):
+    '''Compute the harmonic coefficients of the maps of each bin
+
+    Args:
+        dmap (array): Overdensity maps, shape (nbins, npix)
+        e1map (array): E1 ellipticity maps, shape (nbins, npix)
+        e2map (array): E2 ellipticity maps, shape (nbins, npix)
+        iter (int, optional): Number of iterations of map2alm (default: 0)
+        lmax (int, optional): Maximum multipole (default: None, 3*nside-1)
+
+    Returns:
+        Array with shape (nbins, 3, nalm) with the T, E and B alms of each bin.
+    '''
+    return np.array([hp.map2alm([d, e1, e2], pol=True, iter=iter, lmax=lmax) for d, e1, e2 in zip(dmap, e1map, e2map)])
+
+def normalize_maps(nmap, e1map, e2map):
+    '''Compute the overdensity maps and the shot noise of each bin, and turn the ellipticity maps into mean ellipticities
+
+    Args:
+        nmap (array): Number of objects in each pixel, shape (nbins, npix)
+        e1map (array): Sum of the E1 ellipticities in each pixel, shape (nbins, npix). It is divided by nmap in place (0 in empty pixels)
+        e2map (array): Sum of the E2 ellipticities in each pixel, shape (nbins, npix). It is divided by nmap in place (0 in empty pixels)
+
+    Returns:
+        Tuple given by (dmap, shotnoise), with the overdensity maps and the shot noise level of each bin.
+    '''
+    nbins = len(nmap)
+    dmap = np.zeros(np.shape(nmap))
+    shotnoise = np.zeros(nbins)
+    for ib in range(nbins):
+        ndens = (np.sum(nmap[ib])+0.0)/(4*np.pi)
+        shotnoise[ib] = 1./ndens
+        e1map[ib, :] = e1map[ib]/nmap[ib]
+        e1map[ib, nmap[ib] <= 0] = 0
+        e2map[ib, :] = e2map[ib]/nmap[ib]
+        e2map[ib, nmap[ib] <= 0] = 0
+        dmap[ib, :] = (nmap[ib, :] + 0.0) / np.mean(nmap[ib] + 0.0) - 1
+    return dmap, shotnoise
+
+def compute_binned_theory(sim_path, nz_tot, z_nz, pairs, ell_edges, n_workers=1, theory_cache_dir=None, theory_ell_per_decade=None, threads=None, stage_threads=None, timer=None):
+    '''Compute the CCL power spectra of the pairs of bins, averaged in the bandpowers
+
+    Args:
+        sim_path (str): Path where the CoLoRe simulation is located.
+        nz_tot (array): N(z) of each bin
+        z_nz (array): Redshifts of the N(z)
+        pairs (list): Pairs of bins
+        ell_edges (array of int): Edges of the bandpowers
+        n_workers (int, optional): Number of processes reading the P(k) files (default: 1)
+        theory_cache_dir (str, optional): Folder where the grid of P(k) predictions and the theory power spectra are cached (default: None)
+        theory_ell_per_decade (int, optional): Number of log-spaced multipoles per decade actually computed (default: None, all of them)
+        threads (int, optional): Number of OpenMP/BLAS threads (default: None, use the library defaults)
+        stage_threads (dict, optional): Dict where the number of threads used is recorded (default: None)
+        timer (Stopwatch, optional): Timer used to log the time of each step (default: None)
+
+    Returns:
+        Dict with the binned cl_dd_t, cl_dm_t, cl_mm_t and cl_md_t (and max_rel_error if the multipoles were interpolated)
+    '''
+    # Hubble constant
+    h = 0.7
+
+    log.info('Reading pk files...')
+    # Read P(k) theory prediction
+    zs, ks, pks_dd, pks_dm, pks_mm = theory.read_pk_grid(sim_path, theory_cache_dir, n_workers)
 
-    for i, (p1,p2) in enumerate(pairs):
-        if p1 != p2:
-            cl_md_d[i] = np.array(hp.anafast(np.asarray([dmap[p2],e1map[p2],e2map[p2]]), np.asarray([dmap[p1],e1map[p1],e2map[p1]])))[3]
+    if timer is not None:
+        log.info(f'\t Relative time: {timer.lap()}\n')
+    log.info('Computing CCL power spectra...')
+    larr = np.arange(ell_edges[-1])
+    with limit_threads(threads, 'theory', stage_threads):
+        cls_t = theory.compute_theory_cls(zs, ks, pks_dd, pks_dm, pks_mm, nz_tot, z_nz, larr, pairs, h=h,
+                                          cache_dir=theory_cache_dir + '/cls' if theory_cache_dir is not None else None,
+                                          ell_per_decade=theory_ell_per_decade)
+    values = {key: bin_cls(cls_t[key], ell_edges) for key in ('cl_dd_t', 'cl_dm_t', 'cl_mm_t', 'cl_md_t')}
+    if 'max_rel_error' in cls_t:
+        values['max_rel_error'] = cls_t['max_rel_error']
+    return values
 
-    cl_dd_d = d_values[:,0]
-    cl_mm_d = d_values[:,1]
-    cl_bb_d = d_values[:,2]
-    cl_dm_d = d_values[:,3]
-    cl_mb_d = d_values[:,4]
-    cl_db_d = d_values[:,5]
+def get_cls_values(pairs, ell_edges, shotnoise, nz_tot, z_nz, cls_d, cls_t, stage_threads, maps=None):
+    '''Collect the outputs of the compute_all_cls functions
 
+    Args:
+        pairs (list): Pairs of bins
+        ell_edges (array of int): Edges of the bandpowers
+        shotnoise (array): Shot noise level of each bin
+        nz_tot (array): N(z) of each bin
+        z_nz (array): Redshifts of the N(z)
+        cls_d (dict): Data power spectra (cl_dd_d, cl_dm_d, cl_md_d, cl_mm_d, cl_bb_d, cl_mb_d, cl_db_d)
+        cls_t (dict): Theory power spectra, as given by compute_binned_theory
+        stage_threads (dict): Number of threads used in each stage
+        maps (tuple, optional): Maps (nmap, e1map, e2map) to include in the output (default: None)
+
+    Returns:
+        Dict with the values to save, and the key info with the values stored in INFO.json
+    '''
     values = {
         'pairs':        pairs,
+        'ell_edges':    ell_edges,
         'shotnoise':    shotnoise,
         'nz_tot':       nz_tot,
         'z_nz':         z_nz,
-        'cl_dd_d':      cl_dd_d,
-        'cl_dd_t':      cl_dd_t,
-        'cl_dm_d':      cl_dm_d,
-        'cl_dm_t':      cl_dm_t,
-        'cl_md_d':      cl_md_d,
-        'cl_md_t':      cl_md_t,
-        'cl_mm_d':      cl_mm_d,
-        'cl_mm_t':      cl_mm_t,
-        'cl_bb_d':      cl_bb_d,
-        'cl_mb_d':      cl_mb_d,
-        'cl_db_d':      cl_db_d
+        'cl_dd_d':      cls_d['cl_dd_d'],
+        'cl_dd_t':      cls_t['cl_dd_t'],
+        'cl_dm_d':      cls_d['cl_dm_d'],
+        'cl_dm_t':      cls_t['cl_dm_t'],
+        'cl_md_d':      cls_d['cl_md_d'],
+        'cl_md_t':      cls_t['cl_md_t'],
+        'cl_mm_d':      cls_d['cl_mm_d'],
+        'cl_mm_t':      cls_t['cl_mm_t'],
+        'cl_bb_d':      cls_d['cl_bb_d'],
+        'cl_mb_d':      cls_d['cl_mb_d'],
+        'cl_db_d':      cls_d['cl_db_d']
     }
-
-    
-    log.info(f'\t Relative time: {timer.lap()}\n\n')
-    log.info(f'\t Total time: {timer.full()}')
+    if maps is not None:
+        values['nmap'], values['e1map'], values['e2map'] = maps
+    # Not saved as .dat files, compute_data stores them in INFO.json
+    values['info'] = {'threads': stage_threads}
+    if 'max_rel_error' in cls_t:
+        values['info']['theory_max_rel_error'] = float(cls_t['max_rel_error'])
     return values
 
-def compute_all_cls_namaster(sim_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None):
+def compute_all_cls_anafast(sim_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, n_workers=1, chunk_rows=None, max_pixel_nside=4096, seed=None, maps=None, theory_cache_dir=None, theory_ell_per_decade=None, workspace_cache_dir=None, threads=None, lmax=None, ell_edges=None, checkpoint_dir=None, pixel_cache_dir=None):
     '''Method to compute all cls from the anafast function using output from CoLoRe.
 
     Args:
@@ -389,200 +716,172 @@ def compute_all_cls_namaster(sim_path, source=1, nside=128, max_files=None, down
         nz_h (int, optional): pixelization of the redshift analysis (default: 50)
         nz_min (float, optional): min redshift for the N(z) histogram (default: 0)
         nz_max (float, optional): max redshift for the N(z) histogram (default: None (set to the max value in zbins))
+        n_workers (int, optional): number of processes used to read the catalog files (and the P(k) files) (default: 1)
+        chunk_rows (int, optional): number of rows of the catalogs processed at once (default: None, set from the available memory)
+        max_pixel_nside (int, optional): nside of the pixel index stored for each catalog file, lower nside are derived from it. Set to 0/None to compute the pixels from the angles in each run (default: 4096)
+        seed (int, optional): seed for the photo-z scatter and the downsampling. Each catalog file (and block of rows) gets an independent random stream, so the result does not depend on the number of workers or the chunk size (default: None, use the global numpy random state in file order)
+        maps (tuple, optional): Maps and N(z) already computed at nside, as given by read_catalogs. If given, the catalogs are not read (default: None)
+        theory_cache_dir (str, optional): Folder where the grid of P(k) predictions and the theory power spectra are cached (default: None, compute them each time)
+        theory_ell_per_decade (int, optional): Compute the theory power spectra at this number of log-spaced multipoles per decade and interpolate the rest (default: None, compute all the multipoles)
+        workspace_cache_dir (str, optional): Not used (the argument is kept to share the signature with compute_all_cls_namaster)
+        threads (int, optional): Number of OpenMP/BLAS threads used to compute the theory and the data power spectra (default: None, use the library defaults)
+        lmax (int, optional): Maximum multipole of the power spectra (default: None, 3*nside-1 or the last bandpower given by ell_edges)
+        ell_edges (array of int, optional): Edges of the bandpowers, each one averages the multipoles ell_edges[i] <= ell < ell_edges[i+1] (default: None, one bandpower per multipole)
+        checkpoint_dir (str, optional): Folder where the reading of the catalogs is checkpointed, it is resumed from the checkpoint if there is one (default: None, no checkpoints)
+        pixel_cache_dir (str, optional): Folder where the pixel index of each catalog file is stored (default: None, compute the pixels from the angles)
     
     Returns: 
-        Tuple given by (shotnoise, pairs, nz_tot, z_nz, d_values, cl_dd_t, cl_dm_t, cl_mm_t):
-            d_values: Array of shape (3,6,384) with all the pairs in [(0,0),(0,1),(1,1)] for all the combinations TT, TE, TB, EE, EB, BB for the anafast function. 
+        Dict with the pairs of bins, ell_edges, shotnoise, nz_tot, z_nz and the data (cl_*_d) and theory (cl_*_t) power spectra of each pair, with shape (npairs, nbandpowers). The key info has the values stored in INFO.json.
     '''
-
-    # Hubble constant
-    h = 0.7
-
-    nside = nside
-    npix = hp.nside2npix(nside)
-
     nbins   = len(zbins) - 1
     pairs   = list(combinations_with_replacement(range(nbins), r=2))
 
+    # Bandpowers of the power spectra (data and theory)
+    ell_edges = get_ell_edges(nside, lmax, ell_edges)
+    lmax = ell_edges[-1] - 1
 
-    # This will contain the N(z) of the different bins
-    nz_tot = np.zeros([nbins, nz_h])
-    nz_max = nz_max if nz_max is not None else zbins[-1]
-    
-    sigz = 0.03
-
-    # These will be the density and ellipticity maps
-    nmap = np.zeros([nbins, npix])
-    dmap = np.zeros([nbins, npix])
-    e1map = np.zeros([nbins, npix])
-    e2map = np.zeros([nbins, npix])
-
-    # Now we loop over all source files
-    if max_files is None:
-        file_limit = False
-    else:
-        file_limit = True
-
-    ifile = 0
 
     timer = Stopwatch()
-    log.info(f'\t Relative time: {timer.lap()}\n')
+    # Number of threads used in each stage (saved in INFO.json)
+    stage_threads = {}
     log.info('Reading output files...')
-    while os.path.isfile(sim_path + '/out_srcs_s1_%d.fits' % ifile) and ( (not file_limit) or ifile <= max_files):
-        hdulist = fits.open(sim_path + '/out_srcs_s1_%d.fits' % ifile)
-        d = hdulist[1].data
-        n_g = len(d)
+    # These will be the density and ellipticity maps and the N(z) of the different bins
+    if maps is None:
+        maps = read_catalogs(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, checkpoint_dir, pixel_cache_dir)
+    nmap, e1map, e2map, nz_tot, z_nz = maps
 
-        # Generate random photo-z
-        z_photo = d['Z_COSMO'] + sigz*(1+d['Z_COSMO'])*np.random.randn(n_g)
+    log.info(f'\t Relative time: {timer.lap()}\n')
+    log.info('Computing maps...')
+    dmap, shotnoise = normalize_maps(nmap, e1map, e2map)
 
-        if downsampling != 1: 
-            d_mask = np.random.random(len(z_photo)) < downsampling #pylint: disable=no-member
-        else:
-            d_mask = np.full(len(z_photo), True, dtype=bool)
+    log.info(f'\t Relative time: {timer.lap()}\n')
+    cls_t = compute_binned_theory(sim_path, nz_tot, z_nz, pairs, ell_edges, n_workers, theory_cache_dir, theory_ell_per_decade, threads, stage_threads, timer)
 
-        masks = []
-        for i in range(nbins):
-            masks.append( (zbins[i] <= z_photo) & (z_photo < zbins[i+1]) )
-        
-        masks = [(mask & d_mask) for mask in masks]  # applying downsampling here
-
-        # For each bin, add to the number and ellipticity maps
-        for ibin, msk in enumerate( masks ):
-            dd = d[msk]
-
-            pix = hp.ang2pix(nside,
-                            np.radians(90-dd['DEC']),
-                            np.radians(dd['RA']))
-            n = np.bincount(pix, minlength=npix)
-            e1 = np.bincount(pix, minlength=npix, weights=dd['E1'])
-            e2 = np.bincount(pix, minlength=npix, weights=dd['E2'])
-            nmap[ibin, :] += n
-            e1map[ibin, :] += e1
-            e2map[ibin, :] += e2
-
-            # Add also to N(z)
-            nz, z_edges = np.histogram(dd['Z_COSMO'], bins=nz_h,
-                                    range=[nz_min, nz_max])
-            nz_tot[ibin, :] += nz
-        ifile += 1
-
-    # Midpoint of N(z) histogram
-    z_nz = 0.5*(z_edges[1:] + z_edges[:-1])
 
     log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Computing maps...')
-    # Compute <e> map and overdensity map
-    # Compute also shot noise level
-    shotnoise = np.zeros(nbins)
-    for ib in range(nbins):
-        ndens = (np.sum(nmap[ib])+0.0)/(4*np.pi)
-        shotnoise[ib] = 1./ndens
-        e1map[ib, :] = e1map[ib]/nmap[ib]
-        e1map[ib, nmap[ib] <= 0] = 0
-        e2map[ib, :] = e2map[ib]/nmap[ib]
-        e2map[ib, nmap[ib] <= 0] = 0
-        dmap[ib, :] = (nmap[ib, :] + 0.0) / np.mean(nmap[ib] + 0.0) - 1
+    log.info('Computing values from data...')
+    # Each bin is transformed once (same iterations as anafast) and all the pairs are obtained from the alms
+    with limit_threads(threads, 'spectra', stage_threads):
+        alms = compute_alms(dmap, e1map, e2map, iter=3, lmax=lmax)
+    d_values = bin_cls([hp.alm2cl(alms[p1], alms[p2]) for p1,p2 in pairs], ell_edges)
+
+    cls_d = {
+        'cl_dd_d':      d_values[:,0],
+        'cl_mm_d':      d_values[:,1],
+        'cl_bb_d':      d_values[:,2],
+        'cl_dm_d':      d_values[:,3],
+        'cl_mb_d':      d_values[:,4],
+        'cl_db_d':      d_values[:,5],
+        'cl_md_d':      bin_cls([hp.alm2cl(alms[p2][0], alms[p1][1]) for p1,p2 in pairs], ell_edges)
+    }
+    values = get_cls_values(pairs, ell_edges, shotnoise, nz_tot, z_nz, cls_d, cls_t, stage_threads)
 
-    # Read P(k) theory prediction
-    zs = []
-    pks_dd = []
-    pks_dm = []
-    pks_mm = []
-    z_pk = 0.
     
-    log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Reading pk files...')
-    while os.path.isfile(sim_path + "/out_pk_srcs_pop0_z%.3lf.txt" % z_pk):
-        ks, pdd, pdm, pmm = np.loadtxt(sim_path + "/out_pk_srcs_pop0_z%.3lf.txt" % z_pk, unpack=True)
-        # The delta-delta prediction involves some Fourier transforms that make it unstable
-        # at high-k, so we just set it to zero.
-        pdd[pmm<1E-30] = 0
-        pks_dd.append(pdd)
-        pks_dm.append(pdm)
-        pks_mm.append(pmm)
-        zs.append(z_pk)
-        z_pk += 0.1
-    # Reverse order (because CCL needs increasing scale factor - not redshift).
-    # Also, CCL uses non-h units.
-    zs = np.array(zs)[::-1]
-    ks = np.array(ks) * h
-    pks_dd = np.array(pks_dd)[::-1, :] / h**3
-    pks_dm = np.array(pks_dm)[::-1, :] / h**3
-    pks_mm = np.array(pks_mm)[::-1, :] / h**3
+    log.info(f'\t Relative time: {timer.lap()}\n\n')
+    log.info(f'\t Total time: {timer.full()}')
+    return values
+
+def compute_all_cls_namaster(sim_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, n_workers=1, chunk_rows=None, max_pixel_nside=4096, seed=None, maps=None, theory_cache_dir=None, theory_ell_per_decade=None, workspace_cache_dir=None, threads=None, lmax=None, ell_edges=None, checkpoint_dir=None, pixel_cache_dir=None):
+    '''Method to compute all cls with NaMaster using output from CoLoRe. The ellipticity fields are weighted by the number of objects in each pixel.
+
+    Args:
+        sim_path (str): Path where the CoLoRe simulation is located.
+        source (int, optional): Source from which to compute data (default: 1)
+        nside (int, optional): nside to use (default:128)
+        max_files (int, optional): number of srcs files to consider (default: None, consider all the files) 
+        downsampling (float, optional): downsampling to apply to the data (from 0 to 1) (default: 1)
+        zbins (array of floats, optional): defines the binning in redshift of the data analysis (default: [0,0.15,0.5])
+        nz_h (int, optional): pixelization of the redshift analysis (default: 50)
+        nz_min (float, optional): min redshift for the N(z) histogram (default: 0)
+        nz_max (float, optional): max redshift for the N(z) histogram (default: None (set to the max value in zbins))
+        n_workers (int, optional): number of processes used to read the catalog files (and the P(k) files) (default: 1)
+        chunk_rows (int, optional): number of rows of the catalogs processed at once (default: None, set from the available memory)
+        max_pixel_nside (int, optional): nside of the pixel index stored for each catalog file, lower nside are derived from it. Set to 0/None to compute the pixels from the angles in each run (default: 4096)
+        seed (int, optional): seed for the photo-z scatter and the downsampling. Each catalog file (and block of rows) gets an independent random stream, so the result does not depend on the number of workers or the chunk size (default: None, use the global numpy random state in file order)
+        maps (tuple, optional): Maps and N(z) already computed at nside, as given by read_catalogs. If given, the catalogs are not read (default: None)
+        theory_cache_dir (str, optional): Folder where the grid of P(k) predictions and the theory power spectra are cached (default: None, compute them each time)
+        theory_ell_per_decade (int, optional): Compute the theory power spectra at this number of log-spaced multipoles per decade and interpolate the rest (default: None, compute all the multipoles)
+        workspace_cache_dir (str, optional): Folder where the NaMaster workspaces are cached (default: None, compute them each time)
+        threads (int, optional): Number of OpenMP/BLAS threads used to compute the theory and the data power spectra (default: None, use the library defaults)
+        lmax (int, optional): Maximum multipole of the power spectra (default: None, 3*nside-1 or the last bandpower given by ell_edges)
+        ell_edges (array of int, optional): Edges of the bandpowers, each one averages the multipoles ell_edges[i] <= ell < ell_edges[i+1] (default: None, one bandpower per multipole)
+        checkpoint_dir (str, optional): Folder where the reading of the catalogs is checkpointed, it is resumed from the checkpoint if there is one (default: None, no checkpoints)
+        pixel_cache_dir (str, optional): Folder where the pixel index of each catalog file is stored (default: None, compute the pixels from the angles)
+    
+    Returns: 
+        Dict with the pairs of bins, ell_edges, shotnoise, nz_tot, z_nz, the data (cl_*_d) and theory (cl_*_t) power spectra of each pair, with shape (npairs, nbandpowers), and the maps (nmap, e1map, e2map). The key info has the values stored in INFO.json.
+    '''
+    nside = nside
+    npix = hp.nside2npix(nside)
+
+    nbins   = len(zbins) - 1
+    pairs   = list(combinations_with_replacement(range(nbins), r=2))
+
+    # Bandpowers of the power spectra (data and theory)
+    ell_edges = get_ell_edges(nside, lmax, ell_edges)
+    lmax = ell_edges[-1] - 1
+
+
+    timer = Stopwatch()
+    # Number of threads used in each stage (saved in INFO.json)
+    stage_threads = {}
+    log.info('Reading output files...')
+    # These will be the density and ellipticity maps and the N(z) of the different bins
+    if maps is None:
+        maps = read_catalogs(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, checkpoint_dir, pixel_cache_dir)
+    nmap, e1map, e2map, nz_tot, z_nz = maps
 
     log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Creating CCL structures...')
-    # Create CCL P(k) structures
-    cosmo = ccl.Cosmology(Omega_c=0.25, Omega_b=0.05, h=h, n_s=0.96, sigma8=0.8)
-    pk2d_dd = ccl.Pk2D(a_arr=1./(1+zs), lk_arr=np.log(ks), pk_arr=pks_dd,
-                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
-    pk2d_dm = ccl.Pk2D(a_arr=1./(1+zs), lk_arr=np.log(ks), pk_arr=pks_dm,
-                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
-    pk2d_mm = ccl.Pk2D(a_arr=1./(1+zs), lk_arr=np.log(ks), pk_arr=pks_mm,
-                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
-    # These can be evaluated as follows:
-    pk2d_dd.eval(k=0.1, a=1/(1+0.2), cosmo=cosmo) # This was printed by David!
-
-    # Create a number counts and a weak lensing tracer for each of the bins
-    tr_d = [ccl.NumberCountsTracer(cosmo, False, (z_nz, nz_tot[i]), bias=(z_nz, np.ones_like(z_nz)))
-            for i in range(nbins)]
-    tr_l = [ccl.WeakLensingTracer(cosmo, (z_nz, nz_tot[i])) for i in range(nbins)]
+    log.info('Computing maps...')
+    dmap, shotnoise = normalize_maps(nmap, e1map, e2map)
 
     log.info(f'\t Relative time: {timer.lap()}\n')
-    log.info('Computing CCL power spectra...')
-    # Compute power spectra. I'm only doing delta-delta here.
-    larr = np.arange(3*nside)
-    cl_dd_t = np.array([ccl.angular_cl(cosmo, tr_d[p1], tr_d[p2], larr, p_of_k_a=pk2d_dd)
-                        for p1, p2 in pairs])
-    cl_dm_t = np.array([ccl.angular_cl(cosmo, tr_d[p1], tr_l[p2], larr, p_of_k_a=pk2d_dm)
-                        for p1, p2 in pairs])
-    cl_mm_t = np.array([ccl.angular_cl(cosmo, tr_l[p1], tr_l[p2], larr, p_of_k_a=pk2d_mm)
-                        for p1, p2 in pairs])
-    cl_md_t = np.array([ccl.angular_cl(cosmo, tr_d[p1], tr_l[p2], larr, p_of_k_a=pk2d_dm)
-                        for p2, p1 in pairs])
+    cls_t = compute_binned_theory(sim_path, nz_tot, z_nz, pairs, ell_edges, n_workers, theory_cache_dir, theory_ell_per_decade, threads, stage_threads, timer)
 
     log.info(f'\t Relative time: {timer.lap()}\n')
     log.info('Computing values from data...')
     import pymaster as nmt
-
-    b=nmt.NmtBin.from_edges(np.arange(3*nside+1)[:-1],
-                            np.arange(3*nside+1)[1:])
-    # Spin-0 fields
-    mone = np.ones(npix)
-    f0 = [nmt.NmtField(mone, [d], n_iter=0) for d in dmap]
-    # Spin-2 fields
-    f2 = [nmt.NmtField(n, [e1, e2], n_iter=0) for n, e1, e2 in zip(nmap, e1map, e2map)]
-
-    # DD power spectra
-    w_dd = {}
-    for p in range(nbins):
-        w_dd[p] = nmt.NmtWorkspace()
-        w_dd[p].compute_coupling_matrix(f0[p],f0[p], b)
-    cl_dd = np.array([w_dd[p2].decouple_cell(nmt.compute_coupled_cell(f0[p1], f0[p2]))[0] 
-                        for p1, p2 in pairs])
-
-    # w_dd = nmt.NmtWorkspace()
-    # w_dd.compute_coupling_matrix(f0, f0, b)
-    # cl_dd = np.array([w_dd.decouple_cell(nmt.compute_coupled_cell(f0[p1], f0[p2]))[0]
-    #                   for p1, p2 in pairs])
+    # pymaster is already loaded, so its OpenMP threads are limited
+    with limit_threads(threads, 'spectra', stage_threads):
+        edges = (ell_edges[:-1], ell_edges[1:])
+        b=nmt.NmtBin.from_edges(*edges)
+        # Spin-0 fields (the transforms only go up to lmax)
+        mone = np.ones(npix)
+        f0 = [nmt.NmtField(mone, [d], n_iter=0, lmax_sht=lmax) for d in dmap]
+        # Spin-2 fields
+        f2 = [nmt.NmtField(n, [e1, e2], n_iter=0, lmax_sht=lmax) for n, e1, e2 in zip(nmap, e1map, e2map)]
+
+        # Workspaces only depend on the masks, spins and binning, so bins with the same masks share them
+        # Each mask is hashed once, and the unit mask is identified by its name
+        workspaces = {}
+        mask_keys = [theory.TheoryCache.get_key(mask=n) for n in nmap]
+        def get_workspace(field1, mask_key1, spin1, field2, mask_key2, spin2):
+            key = theory.TheoryCache.get_key(masks=[mask_key1, mask_key2], spins=[spin1, spin2], nside=nside, lmin=edges[0], lmax=edges[1],
+                                             n_iter=0, version=getattr(nmt, '__version__', None))
+            if key not in workspaces:
+                workspaces[key] = get_namaster_workspace(field1, field2, b, key, workspace_cache_dir)
+            return workspaces[key]
+
+        # DD power spectra
+        w_dd = {p: get_workspace(f0[p], 'unit', 0, f0[p], 'unit', 0) for p in range(nbins)}
+        cl_dd = np.array([w_dd[p2].decouple_cell(nmt.compute_coupled_cell(f0[p1], f0[p2]))[0] 
+                            for p1, p2 in pairs])
+
+        # w_dd = nmt.NmtWorkspace()
+        # w_dd.compute_coupling_matrix(f0, f0, b)
+        # cl_dd = np.array([w_dd.decouple_cell(nmt.compute_coupled_cell(f0[p1], f0[p2]))[0]
+        #                   for p1, p2 in pairs])
         
-    # DM power spectra
-    w_dl = {}
-    for p in range(nbins):
-        w_dl[p] = nmt.NmtWorkspace()
-        w_dl[p].compute_coupling_matrix(f0[p], f2[p], b)
-    cl_dm = np.array([[w_dl[p2].decouple_cell(nmt.compute_coupled_cell(f0[p1], f2[p2]))
-                       for p2 in range(nbins)]
-                      for p1 in range(nbins)])
-
-    # MM power spectra
-    w_ll = {}
-    for p in range(nbins):
-        w_ll[p] = nmt.NmtWorkspace()
-        w_ll[p].compute_coupling_matrix(f2[p], f2[p], b)
-    cl_mm = np.array([w_ll[p2].decouple_cell(nmt.compute_coupled_cell(f2[p1], f2[p2]))
-                       for p1, p2 in pairs])
+        # DM power spectra
+        w_dl = {p: get_workspace(f0[p], 'unit', 0, f2[p], mask_keys[p], 2) for p in range(nbins)}
+        cl_dm = np.array([[w_dl[p2].decouple_cell(nmt.compute_coupled_cell(f0[p1], f2[p2]))
+                           for p2 in range(nbins)]
+                          for p1 in range(nbins)])
+
+        # MM power spectra
+        w_ll = {p: get_workspace(f2[p], mask_keys[p], 2, f2[p], mask_keys[p], 2) for p in range(nbins)}
+        cl_mm = np.array([w_ll[p2].decouple_cell(nmt.compute_coupled_cell(f2[p1], f2[p2]))
+                           for p1, p2 in pairs])
         
     #d_values = np.array([hp.anafast(np.asarray([dmap[p1],e1map[p1],e2map[p1]]),np.asarray([dmap[p2],e1map[p2],e2map[p2]]), pol=True) for p1,p2 in pairs])
     #
@@ -592,40 +891,101 @@ def compute_all_cls_namaster(sim_path, source=1, nside=128, max_files=None, down
     #    if p1 != p2:
     #        cl_md_d[i] = np.array(hp.anafast(np.asarray([dmap[p2],e1map[p2],e2map[p2]]), np.asarray([dmap[p1],e1map[p1],e2map[p1]])))[3]
 
-    cl_dd_d = cl_dd
-    cl_mm_d = cl_mm[:, 0, :]
-    cl_bb_d = cl_mm[:, 3, :]
-    cl_dm_d = np.array([cl_dm[0, 0, 0, :],
-                        cl_dm[0, 1, 0, :],
-                        cl_dm[1, 1, 0, :]])
-    cl_md_d = np.array([cl_dm[0, 0, 0, :],
-                        cl_dm[1, 0, 0, :],
-                        cl_dm[1, 1, 0, :]])
-    cl_mb_d = cl_mm[:, 1, :]
-    cl_db_d = np.array([cl_dm[0, 0, 1, :],
-                        cl_dm[0, 1, 1, :],
-                        cl_dm[1, 1, 1, :]])
+    cls_d = {
+        'cl_dd_d':      cl_dd,
+        'cl_mm_d':      cl_mm[:, 0, :],
+        'cl_bb_d':      cl_mm[:, 3, :],
+        'cl_dm_d':      np.array([cl_dm[p1, p2, 0, :] for p1, p2 in pairs]),
+        'cl_md_d':      np.array([cl_dm[p2, p1, 0, :] for p1, p2 in pairs]),
+        'cl_mb_d':      cl_mm[:, 1, :],
+        'cl_db_d':      np.array([cl_dm[p1, p2, 1, :] for p1, p2 in pairs])
+    }
+    values = get_cls_values(pairs, ell_edges, shotnoise, nz_tot, z_nz, cls_d, cls_t, stage_threads, maps=(nmap, e1map, e2map))
 
-    values = {
-        'pairs':        pairs,
-        'shotnoise':    shotnoise,
-        'nz_tot':       nz_tot,
-        'z_nz':         z_nz,
-        'cl_dd_d':      cl_dd_d,
-        'cl_dd_t':      cl_dd_t,
-        'cl_dm_d':      cl_dm_d,
-        'cl_dm_t':      cl_dm_t,
-        'cl_md_d':      cl_md_d,
-        'cl_md_t':      cl_md_t,
-        'cl_mm_d':      cl_mm_d,
-        'cl_mm_t':      cl_mm_t,
-        'cl_bb_d':      cl_bb_d,
-        'cl_mb_d':      cl_mb_d,
-        'cl_db_d':      cl_db_d,
-        'nmap':         nmap,
-        'e1map':        e1map,
-        'e2map':        e2map
+    log.info(f'\t Relative time: {timer.lap()}\n\n')
+    log.info(f'\t Total time: {timer.full()}')
+    return values
+
+
+def compute_all_cls_fullsky(sim_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[-1,0.15,1], nz_h = 50, nz_min=0, nz_max=None, n_workers=1, chunk_rows=None, max_pixel_nside=4096, seed=None, maps=None, theory_cache_dir=None, theory_ell_per_decade=None, workspace_cache_dir=None, threads=None, lmax=None, ell_edges=None, checkpoint_dir=None, pixel_cache_dir=None):
+    '''Method to compute all cls from the harmonic coefficients of full-sky maps using output from CoLoRe.
+
+    With a unit mask over the full sky the mode-coupling matrix is the identity, so the power spectra are obtained directly from the alms (HEALPix E/B convention, as in NaMaster) without computing any workspace. The values have the same keys as in compute_all_cls_namaster, but the ellipticity fields have a unit weight instead of the number of objects in each pixel. A ValueError is raised if any pixel is empty (use compute_all_cls_namaster for those maps).
+
+    Args:
+        sim_path (str): Path where the CoLoRe simulation is located.
+        source (int, optional): Source from which to compute data (default: 1)
+        nside (int, optional): nside to use (default:128)
+        max_files (int, optional): number of srcs files to consider (default: None, consider all the files) 
+        downsampling (float, optional): downsampling to apply to the data (from 0 to 1) (default: 1)
+        zbins (array of floats, optional): defines the binning in redshift of the data analysis (default: [0,0.15,0.5])
+        nz_h (int, optional): pixelization of the redshift analysis (default: 50)
+        nz_min (float, optional): min redshift for the N(z) histogram (default: 0)
+        nz_max (float, optional): max redshift for the N(z) histogram (default: None (set to the max value in zbins))
+        n_workers (int, optional): number of processes used to read the catalog files (and the P(k) files) (default: 1)
+        chunk_rows (int, optional): number of rows of the catalogs processed at once (default: None, set from the available memory)
+        max_pixel_nside (int, optional): nside of the pixel index stored for each catalog file, lower nside are derived from it. Set to 0/None to compute the pixels from the angles in each run (default: 4096)
+        seed (int, optional): seed for the photo-z scatter and the downsampling. Each catalog file (and block of rows) gets an independent random stream, so the result does not depend on the number of workers or the chunk size (default: None, use the global numpy random state in file order)
+        maps (tuple, optional): Maps and N(z) already computed at nside, as given by read_catalogs. If given, the catalogs are not read (default: None)
+        theory_cache_dir (str, optional): Folder where the grid of P(k) predictions and the theory power spectra are cached (default: None, compute them each time)
+        theory_ell_per_decade (int, optional): Compute the theory power spectra at this number of log-spaced multipoles per decade and interpolate the rest (default: None, compute all the multipoles)
+        workspace_cache_dir (str, optional): Not used (the argument is kept to share the signature with compute_all_cls_namaster)
+        threads (int, optional): Number of OpenMP/BLAS threads used to compute the theory and the data power spectra (default: None, use the library defaults)
+        lmax (int, optional): Maximum multipole of the power spectra (default: None, 3*nside-1 or the last bandpower given by ell_edges)
+        ell_edges (array of int, optional): Edges of the bandpowers, each one averages the multipoles ell_edges[i] <= ell < ell_edges[i+1] (default: None, one bandpower per multipole)
+        checkpoint_dir (str, optional): Folder where the reading of the catalogs is checkpointed, it is resumed from the checkpoint if there is one (default: None, no checkpoints)
+        pixel_cache_dir (str, optional): Folder where the pixel index of each catalog file is stored (default: None, compute the pixels from the angles)
+    
+    Returns: 
+        Dict with the pairs of bins, ell_edges, shotnoise, nz_tot, z_nz, the data (cl_*_d) and theory (cl_*_t) power spectra of each pair, with shape (npairs, nbandpowers), and the maps (nmap, e1map, e2map). The key info has the values stored in INFO.json.
+    '''
+    nbins   = len(zbins) - 1
+    pairs   = list(combinations_with_replacement(range(nbins), r=2))
+
+    # Bandpowers of the power spectra (data and theory)
+    ell_edges = get_ell_edges(nside, lmax, ell_edges)
+    lmax = ell_edges[-1] - 1
+
+
+    timer = Stopwatch()
+    # Number of threads used in each stage (saved in INFO.json)
+    stage_threads = {}
+    log.info('Reading output files...')
+    # These will be the density and ellipticity maps and the N(z) of the different bins
+    if maps is None:
+        maps = read_catalogs(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, checkpoint_dir, pixel_cache_dir)
+    nmap, e1map, e2map, nz_tot, z_nz = maps
+
+    # Empty pixels would couple the modes (and their ellipticity is undefined), so the maps must cover the full sky
+    for ib in range(nbins):
+        empty = np.mean(nmap[ib] <= 0)
+        if empty > 0:
+            raise ValueError(f'Bin { ib } has { 100*empty:.2f}% of empty pixels, the fullsky code needs maps without empty pixels (use the namaster code)')
+
+    log.info(f'\t Relative time: {timer.lap()}\n')
+    log.info('Computing maps...')
+    dmap, shotnoise = normalize_maps(nmap, e1map, e2map)
+
+    log.info(f'\t Relative time: {timer.lap()}\n')
+    cls_t = compute_binned_theory(sim_path, nz_tot, z_nz, pairs, ell_edges, n_workers, theory_cache_dir, theory_ell_per_decade, threads, stage_threads, timer)
+
+    log.info(f'\t Relative time: {timer.lap()}\n')
+    log.info('Computing values from data...')
+    # T, E, B alms of each bin (no iterations, as the NaMaster fields)
+    with limit_threads(threads, 'spectra', stage_threads):
+        alms = compute_alms(dmap, e1map, e2map, iter=0, lmax=lmax)
+    T, E, B = 0, 1, 2
+
+    cls_d = {
+        'cl_dd_d':      bin_cls([hp.alm2cl(alms[p1][T], alms[p2][T]) for p1, p2 in pairs], ell_edges),
+        'cl_dm_d':      bin_cls([hp.alm2cl(alms[p1][T], alms[p2][E]) for p1, p2 in pairs], ell_edges),
+        'cl_md_d':      bin_cls([hp.alm2cl(alms[p2][T], alms[p1][E]) for p1, p2 in pairs], ell_edges),
+        'cl_db_d':      bin_cls([hp.alm2cl(alms[p1][T], alms[p2][B]) for p1, p2 in pairs], ell_edges),
+        'cl_mm_d':      bin_cls([hp.alm2cl(alms[p1][E], alms[p2][E]) for p1, p2 in pairs], ell_edges),
+        'cl_mb_d':      bin_cls([hp.alm2cl(alms[p1][E], alms[p2][B]) for p1, p2 in pairs], ell_edges),
+        'cl_bb_d':      bin_cls([hp.alm2cl(alms[p1][B], alms[p2][B]) for p1, p2 in pairs], ell_edges)
     }
+    values = get_cls_values(pairs, ell_edges, shotnoise, nz_tot, z_nz, cls_d, cls_t, stage_threads, maps=(nmap, e1map, e2map))
 
     log.info(f'\t Relative time: {timer.lap()}\n\n')
     log.info(f'\t Total time: {timer.full()}')
@@ -9,7 +9,11 @@ from contextlib import contextmanager
 
 import healpy as hp
 import numpy as np
-from astropy.io import fits
+
+from CoLoRe_analysis.catalog_reader import CatalogReader, get_chunk_rows
+from CoLoRe_analysis.map_accumulator import MapAccumulator
+from CoLoRe_analysis.output_backend import check_output_options, map_storages, output_formats, save_array, save_map
+from CoLoRe_analysis.thread_control import limit_threads
 
 log = logging.getLogger(__name__)
 
@@ -17,9 +21,12 @@ log = logging.getLogger(__name__)
 ###############################################################################
 ### Functions
 ###############################################################################
-def savetofile(location,variables,variables_names):
+def savetofile(location,variables,variables_names,output_format='dat',map_storage=None):
     for i,variable in enumerate(variables):
-        np.savetxt( location + '/' + variables_names[i] + '.dat', variable)
+        if map_storage is not None:
+            save_map(location, variables_names[i], variable, output_format, map_storage)
+        else:
+            save_array(location, variables_names[i], variable, output_format)
     return
     
 @contextmanager   # Code to avoid output temporarily
@@ -35,59 +42,159 @@ def suppress_stdout():
 def fxn():
     warnings.warn("deprecrated", DeprecationWarning)
 
-def compute_data_shear(path,source=1, do_cls=False, do_kappa=False, minz=None,maxz=None, output_path=None):
+def redshift_to_str_for_path(redshift):
+    return round(float(redshift)*100)
+
+def compute_data_shear(path,source=1, do_cls=False, do_kappa=False, minz=None,maxz=None, output_path=None, chunk_rows=None, threads=None, output_format='dat', map_storage='full', cache_dir=None):
+    check_output_options(output_format, map_storage)
     if not output_path:
         output_path = path + f'/shear_data/source_{ source }'
-    os.makedirs(output_path, exist_ok=True)
     
     log.debug(f'path: { path }, source: { source }, do_cls: { do_cls }, do_kapa: { do_kappa }, minz: { minz }, maxz: { maxz }, output_path: { output_path }')
 
     minz = 0 if minz==None else minz
     maxz = 2000 if maxz==None else maxz
 
+    # By default the catalog index is stored next to the output
+    if cache_dir is None:
+        cache_dir = os.path.dirname(output_path) + '/catalog_cache'
+
+    nmap, e1map, e2map = compute_shear_maps(path, [minz, maxz], source, chunk_rows=chunk_rows, cache_dir=cache_dir)
+    save_shear_data(path, nmap[0], e1map[0], e2map[0], output_path, do_cls, do_kappa, threads=threads, output_format=output_format, map_storage=map_storage)
+
+def compute_data_shear_binned(path, zbins, source=1, do_cls=False, do_kappa=False, full_range=True, output_path=None, chunk_rows=None, threads=None, output_format='dat', map_storage='full', cache_dir=None):
+    '''Compute the shear data for a set of redshift bins reading each catalog file only once.
+
+    The output follows the same layout as compute_data_shear: { output_path }/binned/{ minz }_{ maxz }/source_{ source } for each bin and { output_path }/source_{ source } for the full range.
+
+    Args:
+        path (str): Path where the CoLoRe simulation is located.
+        zbins (array of floats): Redshift edges defining the bins.
+        source (int, optional): Source of which to compute data (default: 1)
+        do_cls (bool, optional): Compute the cls (default: False)
+        do_kappa (bool, optional): Analyse kappa (default: False)
+        full_range (bool, optional): Also compute the data for the full redshift range (default: True)
+        output_path (str, optional): Root of the shear data (default: { path }/shear_data)
+        chunk_rows (int, optional): Number of catalog rows processed at once (default: None, set from the available memory)
+        threads (int, optional): Number of OpenMP threads used by healpy (default: None, use the library default)
+        output_format (str, optional): Format of the output arrays: 'dat' (text), 'npy' (binary), 'npy32' (binary with floats in single precision), 'h5' (one HDF5 file per output) or 'h5gz' (h5 with gzip compression) (default: 'dat')
+        map_storage (str, optional): Storage of the maps: 'full' (as the rest of arrays), 'compact' (single precision) or 'partial' (compact, saved as (pixel index, value) pairs when most of the pixels are empty). compact and partial need a binary output_format (default: 'full')
+        cache_dir (str, optional): Folder where the catalog index is stored, used to skip the catalog files without objects in the bins (default: None, use { output_path }/catalog_cache)
+    '''
+    check_output_options(output_format, map_storage)
+    if not output_path:
+        output_path = path + '/shear_data'
+    if cache_dir is None:
+        cache_dir = output_path + '/catalog_cache'
+
+    log.debug(f'path: { path }, zbins: { zbins }, source: { source }, do_cls: { do_cls }, do_kappa: { do_kappa }, full_range: { full_range }, output_path: { output_path }')
+
+    outputs = [output_path + f'/binned/{ redshift_to_str_for_path(minz) }_{ redshift_to_str_for_path(maxz) }/source_{ source }' for minz, maxz in zip(zbins[:-1], zbins[1:])]
+    if full_range:
+        outputs.append(output_path + f'/source_{ source }')
+
+    nmap, e1map, e2map = compute_shear_maps(path, zbins, source, chunk_rows=chunk_rows, full_range=full_range, cache_dir=cache_dir)
+
+    mp_k = None
+    if do_kappa:
+        with suppress_stdout():
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                fxn()
+                mp_k = hp.read_map(path+"/out_kappa_z000.fits")
+
+    # The kappa map is the same for all the bins, so it is only transformed once
+    alm_k = None
+    if do_kappa and do_cls:
+        with limit_threads(threads):
+            alm_k = hp.map2alm(mp_k)
+
+    for i, output in enumerate(outputs):
+        save_shear_data(path, nmap[i], e1map[i], e2map[i], output, do_cls, do_kappa, mp_k, threads, alm_k, output_format, map_storage)
+
+def compute_shear_maps(path, zbins, source=1, nside=512, chunk_rows=None, full_range=False, cache_dir=None):
+    '''Build the number and ellipticity maps for several redshift bins in a single pass over the catalog files.
+
+    The CatalogIndex of the catalogs is used to skip, for the bins and for the full range separately, the files without objects in their redshift range.
+
+    Args:
+        path (str): Path where the CoLoRe simulation is located.
+        zbins (array of floats): Redshift edges defining the bins.
+        source (int, optional): Source of which to compute data (default: 1)
+        nside (int, optional): nside of the maps (default: 512)
+        chunk_rows (int, optional): Number of catalog rows processed at once (default: None, set from the available memory)
+        full_range (bool, optional): Add the maps for the full redshift range (0 to 2000) after the bins (default: False)
+        cache_dir (str, optional): Folder where the catalog index is stored (default: None, the index is built in each call)
+
+    Returns:
+        Tuple (nmap, e1map, e2map) of arrays with shape (len(zbins)-1+full_range, npix).
+    '''
+    accumulators = [MapAccumulator(nside, zbins)]
+    if full_range:
+        accumulators.append(MapAccumulator(nside, [0, 2000]))
+
+    if chunk_rows is None:
+        chunk_rows = get_chunk_rows()
+
+    reader = CatalogReader(path, source, cache_dir)
+    files = reader.get_files()
+    index = reader.get_index()
+    entries = index.get_entries(files, chunk_rows)
+
     with suppress_stdout():
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             fxn()
-            nside = 512
-            npix = hp.nside2npix(nside)
-
-            # Analyze sources
-            ifile = 0
-            nmap = np.zeros(hp.nside2npix(nside))
-            e1map = np.zeros(hp.nside2npix(nside))
-            e2map = np.zeros(hp.nside2npix(nside))
-
-            while os.path.isfile(path+f'/out_srcs_s{ source }_{ ifile }.fits'):
-                hdulist = fits.open(path+f'/out_srcs_s{ source }_{ ifile }.fits')
-                tbdata = hdulist[1].data
-                mask = (tbdata['Z_COSMO'] >= minz) & (tbdata['Z_COSMO'] < maxz)
-                tbdata = tbdata[mask]
-
-                pix = hp.ang2pix(nside,
-                                np.radians(90-tbdata['DEC']),
-                                np.radians(tbdata['RA']))
-                n = np.bincount(pix, minlength=npix)
-                e1 = np.bincount(pix, minlength=npix, weights=tbdata['E1'])
-                e2 = np.bincount(pix, minlength=npix, weights=tbdata['E2'])
-                nmap += n
-                e1map += e1
-                e2map += e2
-                ifile += 1
-                hdulist.close()
+            for filename, entry in zip(files, entries):
+                # Only the maps with objects of the file in their redshift range are filled
+                targets = [accumulator for accumulator in accumulators if index.count(entry, accumulator.zbins[0], accumulator.zbins[-1]) > 0]
+                if len(targets) == 0:
+                    log.info(f'Skipping file { filename }, without objects in the redshift range')
+                    continue
+                for tbdata in CatalogReader.read_file_chunks(filename, chunk_rows=chunk_rows):
+                    pix = targets[0].pixels(tbdata['RA'], tbdata['DEC']) if len(targets) > 1 else None
+                    for accumulator in targets:
+                        accumulator.add(tbdata['RA'], tbdata['DEC'], tbdata['Z_COSMO'], tbdata['E1'], tbdata['E2'], pix=pix)
 
+    nmap, e1map, e2map = [np.concatenate([getattr(accumulator, name) for accumulator in accumulators]) for name in ('nmap', 'e1map', 'e2map')]
+    return nmap, e1map, e2map
+
+def save_shear_data(path, nmap, e1map, e2map, output_path, do_cls=False, do_kappa=False, mp_k=None, threads=None, alm_k=None, output_format='dat', map_storage='full'):
+    '''Compute the shear maps (and optionally cls) from the number and ellipticity maps and save them into output_path.
+
+    Args:
+        path (str): Path where the CoLoRe simulation is located (used to read the kappa map).
+        nmap (array): Number of sources per pixel.
+        e1map (array): Sum of E1 per pixel.
+        e2map (array): Sum of E2 per pixel.
+        output_path (str): Path where to save the data.
+        do_cls (bool, optional): Compute the cls (default: False)
+        do_kappa (bool, optional): Analyse kappa (default: False)
+        mp_k (array, optional): Kappa map already read (default: None, read it from path if needed)
+        threads (int, optional): Number of OpenMP threads used by healpy (default: None, use the library default)
+        alm_k (array, optional): alms of the kappa map already computed (default: None, compute them from mp_k if needed)
+        output_format (str, optional): Format of the output arrays: 'dat' (text), 'npy' (binary), 'npy32' (binary with floats in single precision), 'h5' (one HDF5 file per output) or 'h5gz' (h5 with gzip compression) (default: 'dat')
+        map_storage (str, optional): Storage of the maps: 'full' (as the rest of arrays), 'compact' (single precision) or 'partial' (compact, saved as (pixel index, value) pairs when most of the pixels are empty). compact and partial need a binary output_format (default: 'full')
+    '''
+    os.makedirs(output_path, exist_ok=True)
+    nside = hp.npix2nside(len(nmap))
+
+    with suppress_stdout():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            fxn()
             ndens = (np.sum(nmap)+0.0)/(4*np.pi)
             mp_e1 = e1map/nmap
             mp_e1[nmap <= 0] = 0
             mp_e2 = e2map / nmap
             mp_e2[nmap <= 0] = 0
             mp_d = (nmap + 0.0) / np.mean(nmap + 0.0) - 1
-            mp_db, mp_E, mp_B = hp.alm2map(hp.map2alm(np.array([mp_d, mp_e1, mp_e2]),
-                                                    pol=True),
-                                        pol=False,
-                                        nside=nside)
+            # The alms are computed once and used for the E/B maps and the cls
+            with limit_threads(threads):
+                alm = hp.map2alm(np.array([mp_d, mp_e1, mp_e2]), pol=True)
+                mp_db, mp_E, mp_B = hp.alm2map(alm, pol=False, nside=nside)
         
-    savetofile(output_path,[mp_e1,mp_e2,mp_d,mp_db,mp_E,mp_B], ["mp_e1","mp_e2","mp_d","mp_db","mp_E","mp_B"])
+    savetofile(output_path,[mp_e1,mp_e2,mp_d,mp_db,mp_E,mp_B], ["mp_e1","mp_e2","mp_d","mp_db","mp_E","mp_B"], output_format, map_storage)
 
     if do_cls:
         with suppress_stdout():
@@ -110,11 +217,12 @@ def compute_data_shear(path,source=1, do_cls=False, do_kappa=False, minz=None,ma
             #                         unpack=True)
             # cln_dd = np.ones_like(lt) / ndens
             # clt_dd = cls_dd + cln_dd
-            d = hp.anafast(np.array([mp_d, mp_e1, mp_e2]), pol=True)
+            # Same as hp.anafast on the maps (which would transform them again)
+            d = hp.alm2cl(alm)
             cld_dd, cld_ee, cld_bb, cld_de, cld_eb, cld_db = d
             ld = np.arange(len(cld_dd))
             
-        savetofile(output_path, [cld_dd,cld_ee,cld_bb,cld_de,cld_eb,cld_db,ld], ["cld_dd","cld_ee","cld_bb","cld_de","cld_eb","cld_db","ld"] )
+        savetofile(output_path, [cld_dd,cld_ee,cld_bb,cld_de,cld_eb,cld_db,ld], ["cld_dd","cld_ee","cld_bb","cld_de","cld_eb","cld_db","ld"], output_format)
         
     if do_kappa:
         # Analyze kappa
@@ -122,16 +230,20 @@ def compute_data_shear(path,source=1, do_cls=False, do_kappa=False, minz=None,ma
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 fxn()
-                mp_k = hp.read_map(path+"/out_kappa_z000.fits")
+                if mp_k is None:
+                    mp_k = hp.read_map(path+"/out_kappa_z000.fits")
                 if do_cls:
-                    cld_kk = hp.anafast(mp_k)
+                    if alm_k is None:
+                        with limit_threads(threads):
+                            alm_k = hp.map2alm(mp_k)
+                    cld_kk = hp.alm2cl(alm_k)
                     ld = np.arange(len(cld_kk))
-                    cld_kd = hp.anafast(mp_k, map2=mp_d)
-                    savetofile(output_path, [cld_kk, cld_kd], ["cld_kk", "cld_kd"] )
-        savetofile(output_path, [mp_k], ["mp_k"] )
+                    cld_kd = hp.alm2cl(alm_k, alm[0])
+                    savetofile(output_path, [cld_kk, cld_kd], ["cld_kk", "cld_kd"], output_format)
+        savetofile(output_path, [mp_k], ["mp_k"], output_format, map_storage)
     
 if __name__ == "__main__": #pragma: no cover
-    parser = argparse.ArgumentParser(description="Save useful parameters into .dat files")
+    parser = argparse.ArgumentParser(description="Save useful parameters into .dat/.npy files")
     parser.add_argument("-p","--path", required=True, type=str, help="Path of CoLoRe run")
     parser.add_argument("-c","--cls", action='store_true', help="Compute cls (it should be provided by simulation")
     parser.add_argument("-k","--kappa", action='store_true', help="Analyse kappa")
@@ -139,6 +251,12 @@ if __name__ == "__main__": #pragma: no cover
     parser.add_argument("-o","--output", required=False, type=str, default=None, help="Path for output files")
     parser.add_argument("-mz","--minz", required=False, type=float, default=None, help="min. redshift")
     parser.add_argument("-Mz","--maxz", required=False, type=float, default=None, help="max. redshift")
+    parser.add_argument("-zb","--zbins", required=False, type=float, nargs='+', default=None, help="redshift edges, compute all the bins (and the full range) reading the catalogs once. Output is then the root of the shear data")
+    parser.add_argument("--chunk_rows", required=False, type=int, default=None, help="Number of catalog rows processed at once (default: set from the available memory)")
+    parser.add_argument("--threads", required=False, type=int, default=None, help="Number of OpenMP threads used by healpy (default: library default)")
+    parser.add_argument("--output_format", required=False, choices=output_formats, default='dat', help="Format of the output arrays: dat (text), npy (binary), npy32 (binary, floats in single precision), h5 (one HDF5 file per output) or h5gz (h5 compressed)")
+    parser.add_argument("--cache_dir", required=False, type=str, default=None, help="Folder where the catalog index is stored to skip the catalog files without objects in the redshift range (default: catalog_cache in the shear data folder)")
+    parser.add_argument("--map_storage", required=False, choices=map_storages, default='full', help="Storage of the maps: full (as the rest of arrays), compact (single precision) or partial (compact, as (pixel, value) pairs when most pixels are empty). compact and partial need a binary output_format")
 
     args = parser.parse_args()
 
@@ -150,4 +268,7 @@ if __name__ == "__main__": #pragma: no cover
     maxz    = args.maxz 
     output  = args.output
    
-    compute_data_shear(path, source, do_cls, do_kappa, minz, maxz, output)
+    if args.zbins is not None:
+        compute_data_shear_binned(path, args.zbins, source, do_cls, do_kappa, output_path=output, chunk_rows=args.chunk_rows, threads=args.threads, output_format=args.output_format, map_storage=args.map_storage, cache_dir=args.cache_dir)
+    else:
+        compute_data_shear(path, source, do_cls, do_kappa, minz, maxz, output, args.chunk_rows, args.threads, args.output_format, args.map_storage, args.cache_dir)
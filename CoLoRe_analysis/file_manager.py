@@ -5,7 +5,7 @@ from pathlib import Path
 
 from tabulate import tabulate
 
-from CoLoRe_analysis import sims_reader
+from CoLoRe_analysis import catalog_reader, sims_reader
 
 
 # The class FileManager should be understood as a group of functions (a FileManager object would be totally unuseful). 
@@ -124,6 +124,24 @@ class FileManager:
             info = json.load(json_file)
         return info[param]
     
+    @classmethod
+    def get_object_counts(cls, path, source=1, minz=None, maxz=None):
+        '''
+        Get the number of objects in the source catalogs of a simulation from the catalog index (catalog files are only read if they are not indexed yet).
+
+        Args:
+            path (str): Analysis path of the simulation (with the sim_info.json file).
+            source (int): Source of the catalogs.
+            minz (float): Min redshift (an upper bound of the count is given when a redshift range is used).
+            maxz (float): Max redshift.
+
+        Returns:
+            Number of objects.
+        '''
+        sim_location = cls.get_parameter(path, 'path')
+        # The index is stored with the analysis, the simulation may be shared or read-only
+        return catalog_reader.CatalogReader(sim_location, source, cache_dir=path + '/catalog_cache').count_objects(minz=minz, maxz=maxz)
+
     @classmethod
     def change_parameter(cls, path, param, value):
         with open(f'{path}/sim_info.json') as json_file:
@@ -0,0 +1,147 @@
+'''
+    Module built to accumulate tomographic HEALPix maps (number of sources and sum of ellipticities) and N(z) histograms from source catalogs.
+
+    Each object is assigned to a redshift bin once and all the bins are filled with a single np.bincount call over the flat index bin*npix + pix, so the cost per chunk does not grow with the number of bins.
+'''
+
+import logging
+
+import healpy as hp
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+class MapAccumulator:
+    '''Class made to accumulate the maps and N(z) of a set of contiguous redshift bins
+
+    Attributes:
+        nmap (array): Number of sources in each bin and pixel, shape (nbins, npix)
+        e1map (array): Sum of E1 in each bin and pixel, shape (nbins, npix)
+        e2map (array): Sum of E2 in each bin and pixel, shape (nbins, npix)
+        nz (array): N(z) histogram of each bin, shape (nbins, nz_h) (None if nz_h is None)
+    '''
+
+    def __init__(self, nside, zbins, nz_h=None, nz_min=0, nz_max=None):
+        '''Inits the accumulator with empty maps
+
+        Args:
+            nside (int): nside of the maps
+            zbins (array of floats): Redshift edges defining the bins (a bin includes its lower edge)
+            nz_h (int, optional): Number of bins of the N(z) histograms (default: None, do not compute N(z))
+            nz_min (float, optional): min redshift for the N(z) histogram (default: 0)
+            nz_max (float, optional): max redshift for the N(z) histogram (default: None (set to the max value in zbins))
+        '''
+        self.nside = nside
+        self.npix = hp.nside2npix(nside)
+        self.zbins = np.asarray(zbins)
+        self.nbins = len(zbins) - 1
+
+        self.nz_h = nz_h
+        self.nz_min = nz_min
+        self.nz_max = nz_max if nz_max is not None else zbins[-1]
+
+        self.nmap = np.zeros([self.nbins, self.npix])
+        self.e1map = np.zeros([self.nbins, self.npix])
+        self.e2map = np.zeros([self.nbins, self.npix])
+        self.nz = np.zeros([self.nbins, nz_h]) if nz_h is not None else None
+
+    def bin_index(self, z):
+        '''Get the redshift bin of each object
+
+        Args:
+            z (array): Redshift of the objects
+
+        Returns:
+            Array with the index of the bin of each object (-1 for objects out of the bins).
+        '''
+        ibin = np.digitize(z, self.zbins) - 1
+        ibin[ibin >= self.nbins] = -1
+        return ibin
+
+    def pixels(self, ra, dec):
+        '''Get the HEALPix pixel (RING ordering) of each object
+
+        Args:
+            ra (array): Right ascension of the objects in degrees
+            dec (array): Declination of the objects in degrees
+        '''
+        return hp.ang2pix(self.nside, np.radians(90-dec), np.radians(ra))
+
+    def nz_index(self, z):
+        '''Get the N(z) histogram bin of each object, using the same edges (and edge handling) as np.histogram
+
+        Args:
+            z (array): Redshift of the objects
+
+        Returns:
+            Array with the index of the histogram bin of each object (-1 for objects out of the histogram range).
+        '''
+        edges = np.histogram_bin_edges(np.zeros(0, dtype=z.dtype), bins=self.nz_h, range=[self.nz_min, self.nz_max])
+        iz = np.searchsorted(edges, z, side='right') - 1
+        # The last bin of np.histogram also includes its upper edge
+        iz[z == edges[-1]] = self.nz_h - 1
+        iz[iz >= self.nz_h] = -1
+        return iz
+
+    def add(self, ra, dec, z, e1, e2, z_nz=None, mask=None, pix=None):
+        '''Add a chunk of objects to the maps
+
+        Args:
+            ra (array): Right ascension of the objects in degrees
+            dec (array): Declination of the objects in degrees
+            z (array): Redshift used to assign the objects to the bins
+            e1 (array): E1 ellipticity of the objects
+            e2 (array): E2 ellipticity of the objects
+            z_nz (array, optional): Redshift used for the N(z) histograms (default: None, use z)
+            mask (bool array, optional): Only objects with a True value are considered (default: None, consider all the objects)
+            pix (array, optional): Pixel of each object, if it was already computed (default: None, compute it from ra, dec)
+        '''
+        ibin = self.bin_index(z)
+        selected = ibin >= 0
+        if mask is not None:
+            selected &= mask
+
+        ibin = ibin[selected]
+        if pix is None:
+            pix = self.pixels(ra[selected], dec[selected])
+        else:
+            pix = pix[selected]
+
+        flat = ibin*self.npix + pix
+        size = self.nbins*self.npix
+        self.nmap += np.bincount(flat, minlength=size).reshape(self.nbins, self.npix)
+        self.e1map += np.bincount(flat, weights=e1[selected], minlength=size).reshape(self.nbins, self.npix)
+        self.e2map += np.bincount(flat, weights=e2[selected], minlength=size).reshape(self.nbins, self.npix)
+
+        if self.nz is not None:
+            z_nz = z if z_nz is None else z_nz
+            iz = self.nz_index(z_nz[selected])
+            in_range = iz >= 0
+            flat = ibin[in_range]*self.nz_h + iz[in_range]
+            self.nz += np.bincount(flat, minlength=self.nbins*self.nz_h).reshape(self.nbins, self.nz_h)
+
+def degrade_maps(maps, nside):
+    '''Degrade RING maps to a lower nside summing the child pixels.
+
+    Number counts and weighted sums (like the e1 and e2 maps of MapAccumulator) add exactly, so the result is the same as accumulating the maps directly at the lower nside.
+
+    Args:
+        maps (array): Maps with shape (nmaps, npix) or (npix,) in RING ordering
+        nside (int): Output nside (lower or equal than the nside of the maps)
+
+    Returns:
+        Array with the degraded maps (always a new array).
+    '''
+    maps = np.asarray(maps)
+    nside_in = hp.npix2nside(maps.shape[-1])
+    if nside > nside_in:
+        raise ValueError(f'Maps with nside { nside_in } can not be degraded to nside { nside }')
+
+    npix = hp.nside2npix(nside)
+    # In NESTED ordering the children of each pixel are contiguous
+    nest = maps[..., hp.nest2ring(nside_in, np.arange(maps.shape[-1]))]
+    summed = nest.reshape(maps.shape[:-1] + (npix, -1)).sum(axis=-1)
+
+    degraded = np.empty_like(summed)
+    degraded[..., hp.nest2ring(nside, np.arange(npix))] = summed
+    return degraded
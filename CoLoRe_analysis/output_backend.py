@@ -0,0 +1,256 @@
+'''
+    Module built to save and read the arrays produced by the analysis scripts.
+
+    The arrays can be saved as text (.dat, the original format), as binary numpy files (.npy), optionally in single precision, or all together in one HDF5 file per output folder. The readers detect the format of each file, so the outputs saved as .dat are still readable. Saving an array removes its copies in the other formats, so the outputs of a previous run with another format are never read instead.
+
+    HEALPix maps can also be saved in a compact way (counts as integers, the rest in single precision) and, when most of the pixels are empty, as pairs of (pixel index, value). They are expanded to dense maps when read.
+'''
+
+import json
+import logging
+import os
+
+import h5py
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# dat: text files (np.savetxt), npy: binary files, npy32: binary files with floats saved in single precision, h5: one HDF5 file with a chunked dataset for each array, h5gz: same as h5 with gzip compression
+output_formats = ('dat', 'npy', 'npy32', 'h5', 'h5gz')
+h5_formats = ('h5', 'h5gz')
+
+# File holding all the arrays (and the info) of an output folder with the HDF5 formats
+h5_filename = 'data.h5'
+
+# full: maps saved as the rest of arrays, compact: maps with integer values (counts) saved as integers and the rest in single precision, partial: compact maps saved as (pixel index, value) pairs when it takes less space
+map_storages = ('full', 'compact', 'partial')
+
+def check_output_options(output_format='dat', map_storage='full'):
+    '''Check the output options before computing anything
+
+    Args:
+        output_format (str, optional): One of output_formats (default: 'dat')
+        map_storage (str, optional): One of map_storages (default: 'full')
+    '''
+    if output_format not in output_formats:
+        raise ValueError(f'Not a valid output format: { output_format }, enter one of { output_formats }')
+    if map_storage not in map_storages:
+        raise ValueError(f'Not a valid map storage: { map_storage }, enter one of { map_storages }')
+    if output_format == 'dat' and map_storage != 'full':
+        raise ValueError(f'Map storage { map_storage } needs a binary output format')
+
+def _get_h5_options(value, output_format):
+    # Scalars can not be chunked
+    options = {}
+    if value.ndim > 0:
+        options = dict(chunks=True)
+        if output_format == 'h5gz':
+            options.update(compression='gzip', shuffle=True)
+    return options
+
+def _remove_copies(location, name, keep):
+    # Copies of the array saved before in other formats would be read instead of the new one
+    for extension in ('dat', 'npy', 'npz'):
+        if extension != keep and os.path.isfile(location + f'/{ name }.{ extension }'):
+            os.remove(location + f'/{ name }.{ extension }')
+
+    h5_path = location + '/' + h5_filename
+    if keep != 'h5' and os.path.isfile(h5_path):
+        with h5py.File(h5_path, 'a') as h5file:
+            if name in h5file:
+                del h5file[name]
+
+def save_array(location, name, value, output_format='dat'):
+    '''Save an array into location, replacing the copies saved before in other formats
+
+    Args:
+        location (str): Folder where the array is saved.
+        name (str): Name of the array, the file is { location }/{ name }.{ extension } (a dataset of { location }/data.h5 with the HDF5 formats)
+        value (array): Array to save.
+        output_format (str, optional): One of output_formats (default: 'dat')
+    '''
+    if output_format not in output_formats:
+        raise ValueError(f'Not a valid output format: { output_format }, enter one of { output_formats }')
+    _remove_copies(location, name, 'h5' if output_format in h5_formats else output_format[:3])
+
+    if output_format == 'dat':
+        np.savetxt(location + f'/{ name }.dat', value)
+    elif output_format in ('npy', 'npy32'):
+        value = np.asarray(value)
+        if output_format == 'npy32' and np.issubdtype(value.dtype, np.floating):
+            value = value.astype(np.float32)
+        np.save(location + f'/{ name }.npy', value)
+    elif output_format in h5_formats:
+        value = np.asarray(value)
+        with h5py.File(location + '/' + h5_filename, 'a') as h5file:
+            if name in h5file:
+                del h5file[name]
+            h5file.create_dataset(name, data=value, **_get_h5_options(value, output_format))
+
+def compact_map(value):
+    '''Convert a map to its compact type: maps with integer values (counts) to int32 (int64 if needed) and the rest to float32
+
+    Args:
+        value (array): Map (or maps).
+
+    Returns:
+        The map with the compact type.
+    '''
+    value = np.asarray(value)
+    if np.issubdtype(value.dtype, np.integer) or np.all(np.mod(value, 1) == 0):
+        dtype = np.int32 if value.size == 0 or np.abs(value).max() < 2**31 else np.int64
+        return value.astype(dtype)
+    return value.astype(np.float32)
+
+def save_map(location, name, value, output_format='dat', map_storage='full'):
+    '''Save a HEALPix map (or an array of maps) into location
+
+    Args:
+        location (str): Folder where the map is saved.
+        name (str): Name of the map.
+        value (array): Map to save.
+        output_format (str, optional): One of output_formats (default: 'dat')
+        map_storage (str, optional): One of map_storages. With partial, the map is saved as (index, value) pairs of the non-zero pixels if it takes less space than the dense map. The index is flat for arrays of maps (default: 'full')
+    '''
+    check_output_options(output_format, map_storage)
+    if map_storage == 'full':
+        save_array(location, name, value, output_format)
+        return
+
+    value = compact_map(value)
+    index = None
+    if map_storage == 'partial':
+        index = np.flatnonzero(value).astype(np.int32 if value.size < 2**31 else np.int64)
+    if index is None or index.nbytes + index.size*value.itemsize >= value.nbytes:
+        save_array(location, name, value, output_format)
+        return
+
+    values = value.ravel()[index]
+    _remove_copies(location, name, 'h5' if output_format in h5_formats else 'npz')
+    if output_format in h5_formats:
+        with h5py.File(location + '/' + h5_filename, 'a') as h5file:
+            if name in h5file:
+                del h5file[name]
+            group = h5file.create_group(name)
+            group.attrs['shape'] = value.shape
+            for key, array in (('index', index), ('values', values)):
+                group.create_dataset(key, data=array, **_get_h5_options(array, output_format))
+    else:
+        np.savez(location + f'/{ name }.npz', index=index, values=values, shape=value.shape)
+
+def expand_map(index, values, shape):
+    '''Build the dense map from the (index, value) pairs of its non-zero pixels
+
+    Args:
+        index (array): Flat index of the non-zero pixels.
+        values (array): Values of the non-zero pixels.
+        shape (tuple): Shape of the dense map.
+
+    Returns:
+        The dense map.
+    '''
+    value = np.zeros(shape, dtype=values.dtype)
+    value.flat[index] = values
+    return value
+
+def get_array_path(location, name):
+    '''Get the file of an array saved into location in any of the output formats
+
+    Args:
+        location (str): Folder where the array is saved.
+        name (str): Name of the array.
+
+    Returns:
+        Path of the file (None if the array is not saved). The HDF5 file is preferred over binary files and binary files over text files.
+    '''
+    h5_path = location + '/' + h5_filename
+    if os.path.isfile(h5_path):
+        with h5py.File(h5_path, 'r') as h5file:
+            if name in h5file:
+                return h5_path
+
+    for extension in ('npy', 'npz', 'dat'):
+        path = location + f'/{ name }.{ extension }'
+        if os.path.isfile(path):
+            return path
+    return None
+
+def load_array(location, name, dense=True):
+    '''Read an array saved with save_array or save_map (or as .dat by older versions)
+
+    Args:
+        location (str): Folder where the array is saved.
+        name (str): Name of the array.
+        dense (bool, optional): Expand the maps saved as (index, value) pairs (default: True)
+
+    Returns:
+        The array (arrays saved in single precision are returned as float32). For maps saved as (index, value) pairs and dense=False, the tuple (index, values, shape).
+    '''
+    path = get_array_path(location, name)
+    if path is None:
+        raise FileNotFoundError(f'Array { name } not found in { location }')
+
+    log.debug(f'Reading { path }')
+    if path.endswith('.h5'):
+        # Only the requested dataset is read from the file
+        with h5py.File(path, 'r') as h5file:
+            if not isinstance(h5file[name], h5py.Group):
+                return h5file[name][()]
+            group = h5file[name]
+            index, values, shape = group['index'][()], group['values'][()], tuple(group.attrs['shape'])
+    elif path.endswith('.npz'):
+        with np.load(path) as npzfile:
+            index, values, shape = npzfile['index'], npzfile['values'], tuple(npzfile['shape'])
+    elif path.endswith('.npy'):
+        return np.load(path)
+    else:
+        return np.loadtxt(path)
+
+    if not dense:
+        return index, values, shape
+    return expand_map(index, values, shape)
+
+def save_info(location, info, output_format='dat'):
+    '''Save the info (options) of an output folder
+
+    Args:
+        location (str): Folder of the output.
+        info (dict): Info to save, the values must be JSON serializable.
+        output_format (str, optional): One of output_formats. With the HDF5 formats the info is saved as attributes of the HDF5 file, otherwise it is saved in INFO.json. The info saved before in the other way is removed (default: 'dat')
+    '''
+    h5_path = location + '/' + h5_filename
+    if output_format in h5_formats:
+        if os.path.isfile(location + '/INFO.json'):
+            os.remove(location + '/INFO.json')
+        with h5py.File(h5_path, 'a') as h5file:
+            h5file.attrs.clear()
+            for key, value in info.items():
+                # Saved as JSON to keep None values and lists
+                h5file.attrs[key] = json.dumps(value)
+    else:
+        if os.path.isfile(h5_path):
+            with h5py.File(h5_path, 'a') as h5file:
+                h5file.attrs.clear()
+        with open(location + '/INFO.json', 'w') as outfile:
+            json.dump(info, outfile)
+
+def load_info(location):
+    '''Read the info saved with save_info
+
+    Args:
+        location (str): Folder of the output.
+
+    Returns:
+        Dict with the info.
+    '''
+    if os.path.isfile(location + '/INFO.json'):
+        with open(location + '/INFO.json') as json_file:
+            return json.load(json_file)
+
+    h5_path = location + '/' + h5_filename
+    if os.path.isfile(h5_path):
+        with h5py.File(h5_path, 'r') as h5file:
+            if len(h5file.attrs) > 0:
+                return {key: json.loads(value) for key, value in h5file.attrs.items()}
+
+    raise FileNotFoundError(f'Info not found in { location }')
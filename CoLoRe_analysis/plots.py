@@ -51,11 +51,12 @@ class CCLPlotter():
     '''
         Class to plot CCL values (for a given set)
     '''
-    def __init__(self, values, labels, pairs, nside):
+    def __init__(self, values, labels, pairs, nside, ell_edges=None):
         '''
         Args:
-            Values: tuple or list of arrays with the values of galaxy Cls. An array with shape (n. of values, n. of pairs, 2, 3*nside) is expected.
+            Values: tuple or list of arrays with the values of galaxy Cls. An array with shape (n. of values, n. of pairs, n. of bandpowers) is expected.
             Labels: tupel or list of labels for the previous values. An array of shape (n. of values) is expected. 
+            ell_edges: Edges of the bandpowers of the values, as saved in ell_edges by compute_data_CCL (default: None, one bandpower per multipole up to 3*nside-1)
         '''
         self.labels = labels
         self.raw_values = dict()
@@ -67,15 +68,16 @@ class CCLPlotter():
         self.pairs = pairs
 
         self.nside = nside
-        self.larr = np.arange(3*nside)
-        self.l = np.arange(3*nside)
+        self.ell_edges = np.arange(3*nside+1) if ell_edges is None else np.asarray(ell_edges, dtype=int)
+        # Centre and width of each bandpower (the multipole itself and 1 without bandpowers)
+        self.larr = 0.5*(self.ell_edges[:-1] + self.ell_edges[1:] - 1)
+        self.dl = np.diff(self.ell_edges)
+        self.l = self.larr
     
     def compute_error_bars(self):
         '''
             Compute the error bars associated with the Cls.
         '''
-        Dl = self.larr[1] - self.larr[0]
-
         self.raw_errors = dict()
 
         for name in self.labels:
@@ -84,9 +86,25 @@ class CCLPlotter():
                 a, b = name[0], name[1]
                 
                 self.raw_errors[name][i] = self.get_raw_values(a,a,pair1,pair1)*self.get_raw_values(b,b,pair2,pair2) + self.get_raw_values(a,b,pair1,pair2)**2
-                self.raw_errors[name][i] = self.raw_errors[name][i] / (Dl*(2*self.larr+1))
+                self.raw_errors[name][i] = self.raw_errors[name][i] / (self.dl*(2*self.larr+1))
                 self.raw_errors[name][i] = np.sqrt(self.raw_errors[name][i])    
 
+    def rebin(self, values, rebin):
+        '''
+        Average groups of rebin consecutive bandpowers, weighted by their width. The last bandpowers are dropped if they do not fill a group.
+
+        Args:
+            values (array): Array with the bandpowers in the last axis.
+            rebin (int): Number of bins to average within.
+
+        Returns:
+            Array with the averaged values.
+        '''
+        nbins = len(self.dl) // rebin * rebin
+        values = np.asarray(values)[..., :nbins]
+        weights = self.dl[:nbins].reshape([-1,rebin])
+        return np.sum( values.reshape(values.shape[:-1] + (-1,rebin))*weights, axis=-1) / np.sum(weights, axis=-1)
+
     def reshape(self, rebin):
         '''
         Reshape the values averaging over the rebinning
@@ -95,9 +113,9 @@ class CCLPlotter():
             rebin (int): Number of bins to average within.
         '''
         for name in self.labels:
-            self.values[name] = np.mean( self.raw_values[name].reshape([3,-1,rebin]), axis=2)
+            self.values[name] = self.rebin(self.raw_values[name], rebin)
                 
-        self.l = np.mean( self.larr.reshape([-1,rebin]), axis=1)
+        self.l = self.rebin(self.larr, rebin)
 
     def reshape_error_bars(self, rebin):
         '''
@@ -109,7 +127,7 @@ class CCLPlotter():
 
         self.errors = dict()
         for name in self.labels:
-            self.errors[name] = np.mean( self.raw_errors[name].reshape([3,-1,rebin]), axis=2)
+            self.errors[name] = self.rebin(self.raw_errors[name], rebin)
             
     def get_raw_values(self, a, b, pair1, pair2):
         '''
@@ -122,7 +140,7 @@ class CCLPlotter():
             pair2 (int): Second component region.
 
         Returns:
-            Array of length 3*nside with the values without rebinning.
+            Array with the values of each bandpower without rebinning.
         '''
         return self.raw_values[a+b][ self.get_index(pair1, pair2) ]
             
@@ -138,7 +156,7 @@ class CCLPlotter():
             mask (array): Mask to apply 
 
         Returns:
-            Array of length 3*nside/rebin with the rebinned values.
+            Array with the rebinned values.
         '''
         if mask is None:
             return self.values[a+b][ self.get_index(pair1, pair2) ]
@@ -156,7 +174,7 @@ class CCLPlotter():
             pair2 (int): Second component region.
 
         Returns:
-            Array of length 3*nside with the errors without rebinning.
+            Array with the errors of each bandpower without rebinning.
         '''
         return self.raw_errors[a+b][ self.get_index(pair1, pair2) ]
     
@@ -172,7 +190,7 @@ class CCLPlotter():
             mask (array): Mask to apply 
 
         Returns:
-            Array of length 3*nside/rebin with the rebinned errors.
+            Array with the rebinned errors.
         '''
         if mask is None:
             return self.errors[a+b][ self.get_index(pair1, pair2) ]
@@ -26,7 +26,9 @@ def getArgs():
     parser.add_argument("--nz_h",         required=False, type=int , default=50 , help="pixelization of the redshift analysis ")
     parser.add_argument("--nz_min",       required=False, type=float , default=0 , help="min redshift for the redshfit analysis")
     parser.add_argument("--nz_max",       required=False, type=float , default=3 , help="max redshift for the redshfit analysis")
-    parser.add_argument('--code',         required=False, choices=['anafast','namaster'], default='anafast', help='Which code use to compute the cls')
+    parser.add_argument('--code',         required=False, choices=['anafast','namaster','fullsky'], default='anafast', help='Which code use to compute the cls')
+    parser.add_argument('--lmax',         required=False, type=int, default=None, help='Maximum multipole of the power spectra')
+    parser.add_argument('--ell_edges',    required=False, type=int, nargs='+', default=None, help='Edges of the bandpowers of the power spectra')
 
     args = parser.parse_args()
     return args
@@ -60,12 +62,18 @@ def main(args=None):
             x.cl_dm_t, x.cl_mm_t, x.cl_md_d, x.cl_md_t, x.cl_bb_d, x.cl_mb_d,
             x.cl_db_d) = [x.get_values(value, **options) for value in values_names]
 
+        # Bandpowers used in the output (outputs computed before they were saved have one per multipole)
+        try:
+            x.ell_edges = x.get_values('ell_edges', **options)
+        except FileNotFoundError:
+            x.ell_edges = None
+
     for sim in sims:
         x = sim.ccl_reader
         x.d_values = plots.CCLPlotter([x.cl_dd_d, x.cl_dm_d/2, x.cl_md_d/2, x.cl_mm_d/4], 
-                            ['dd', 'dm', 'md', 'mm'], x.pairs, args.nside)
+                            ['dd', 'dm', 'md', 'mm'], x.pairs, args.nside, x.ell_edges)
         x.t_values = plots.CCLPlotter([x.cl_dd_t, x.cl_dm_t, x.cl_md_t, x.cl_mm_t],
-                            ['dd', 'dm', 'md', 'mm'], x.pairs, args.nside)
+                            ['dd', 'dm', 'md', 'mm'], x.pairs, args.nside, x.ell_edges)
         x.d_values.reshape(args.rebin)
         x.t_values.reshape(args.rebin)
         x.d_values.compute_error_bars()
@@ -175,7 +183,7 @@ def main(args=None):
     for sim in sims:
         x = sim.ccl_reader
         x.d_values = plots.CCLPlotter([x.cl_bb_d, x.cl_mb_d, x.cl_db_d, x.cl_dd_d, x.cl_mm_d], 
-                                ['bb','mb','db','dd','mm'],  x.pairs, args.nside)
+                                ['bb','mb','db','dd','mm'],  x.pairs, args.nside, x.ell_edges)
 
         x.d_values.reshape(args.rebin)
         x.d_values.compute_error_bars()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+'''
+    Script to convert the source catalogs of a simulation into a columnar store. Once compacted, the catalogs are read from the store by compute_data_CCL and compute_data_shear.
+
+'''
+import argparse
+import logging
+
+from CoLoRe_analysis import catalog_reader
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description="Convert the source catalogs (out_srcs_s*_*.fits) of a CoLoRe simulation into a columnar store")
+    parser.add_argument("--input",        required=True, type=str, help="Path of CoLoRe run")
+    parser.add_argument("--source",       required=False, type=int, nargs='+', default=[1], help="Sources to be compacted")
+    parser.add_argument('--chunk_rows',   required=False, type=int, default=None, help='Number of catalog rows copied at once (default: set from the available memory)')
+    parser.add_argument('--dtypes',       required=False, type=str, nargs='+', default=[], help='dtype of some columns in the store, given as COLUMN:DTYPE (e.g. RA:f4) (default: keep the dtype of the catalogs)')
+    parser.add_argument('--log',          required=False, default=None, help='Setup logging, use levelname as string')
+
+    args = parser.parse_args()
+    return args
+
+def main(args=None):
+    if args is None:
+        args = getArgs()
+
+    if args.log is not None:
+        logging.basicConfig(level=logging.getLevelName(args.log))
+
+    dtypes = dict(item.split(':') for item in args.dtypes)
+    for source in args.source:
+        store = catalog_reader.compact_catalogs(args.input, source, args.chunk_rows, dtypes)
+        print(f'Source { source } compacted into { store.location }')
+
+if __name__ == '__main__':
+    main()
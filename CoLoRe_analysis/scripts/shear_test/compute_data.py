@@ -4,7 +4,7 @@ from CoLoRe_analysis.shear_reader import ShearReader
 from CoLoRe_analysis.sims_reader import Sim0404
 from CoLoRe_analysis.file_manager import FileManager
 import shutil
-from CoLoRe_analysis.compute_data_shear import compute_data_shear
+from CoLoRe_analysis.compute_data_shear import compute_data_shear_binned
 from multiprocessing import Pool
 
 import logging.config
@@ -19,6 +19,10 @@ def log_result(retval):
 
 path = "/global/cscratch1/sd/cramirez/CoLoRe_LSST/"
 
+# Each process uses its share of the cores for the healpy threads
+processes = 64
+threads = max(1, os.cpu_count() // processes)
+
 filt = {
     "status" : ["done"],
     "preparation_time": [20200528044545, 20200529043731,20200529043742]
@@ -42,21 +46,17 @@ def main():
         sim.set_shear_reader()
         sim.shear_reader.remove_shear_data()
         
-        for b in range(10):
-            minz = 0 + b*0.25
-            maxz = 0 + (1+b)*0.25
-            minz_str    = round(float(minz)*100)
-            maxz_str    = round(float(maxz)*100)
-            arguments = (sim.location, 2,True,True,minz,maxz,sim.location+ f'/shear_data/binned/{ str(minz_str) }_{ str(maxz_str) }/source_2')
-
-            compute_data_shear_args.append(arguments)
-        compute_data_shear_args.append((sim.location,2,True,True,None,None,None))
+        # All the bins and the full range are computed in the same job, reading each catalog once
+        zbins = [0 + b*0.25 for b in range(11)]
+        arguments = (sim.location, zbins, 2, True, True, True, sim.location + '/shear_data', None, threads)
+
+        compute_data_shear_args.append(arguments)
         #sim.shear_reader.compute_binned_statistics(minz=0, maxz=2.5, bins=10, source=2, do_cls=False, do_kappa=True)
 
 
-    pool = Pool(processes = 64)
+    pool = Pool(processes = processes)
     print('starting pool')
-    x= [pool.apply_async(compute_data_shear, args,callback=log_result, error_callback=log_error) for args in compute_data_shear_args]
+    x= [pool.apply_async(compute_data_shear_binned, args,callback=log_result, error_callback=log_error) for args in compute_data_shear_args]
 
     pool.close()
     pool.join()
@@ -4,7 +4,7 @@ sys.path.insert(1,'..')
 from CoLoRe_analysis.shear_reader import ShearReader
 from CoLoRe_analysis.sims_reader import (FileManager, Sim0404)
 import shutil
-from CoLoRe_analysis.compute_data_shear import compute_data_shear
+from CoLoRe_analysis.compute_data_shear import compute_data_shear_binned
 from multiprocessing import Pool
 
 import logging.config
@@ -16,6 +16,10 @@ def log_error(retval):
 
 path = "/global/cscratch1/sd/cramirez/CoLoRe_LSST/"
 
+# Each process uses its share of the cores for the healpy threads
+processes = 64
+threads = max(1, os.cpu_count() // processes)
+
 filt = {
     "status" : ["done"],
     "template": ["shear_test"],
@@ -40,19 +44,16 @@ def main():
         sim.set_shear_reader()
         sim.shear_reader.remove_shear_data()
         
-        for b in range(10):
-            minz = 0 + b*0.25
-            maxz = 0 + (1+b)*0.25
-            minz_str    = round(float(minz)*100)
-            maxz_str    = round(float(maxz)*100)
-            arguments = (sim.location, 2,False,True,minz,maxz,sim.location+ f'/shear_data/binned/{ str(minz_str) }_{ str(maxz_str) }/source_2')
-
-            compute_data_shear_args.append(arguments)
+        # All the bins are computed in the same job, reading each catalog once
+        zbins = [0 + b*0.25 for b in range(11)]
+        arguments = (sim.location, zbins, 2, False, True, False, sim.location + '/shear_data', None, threads)
+
+        compute_data_shear_args.append(arguments)
         #sim.shear_reader.compute_binned_statistics(minz=0, maxz=2.5, bins=10, source=2, do_cls=False, do_kappa=True)
 
-    pool = Pool(processes = 64)
+    pool = Pool(processes = processes)
     
-    x= [pool.apply_async(compute_data_shear, args, error_callback=log_error) for args in compute_data_shear_args]
+    x= [pool.apply_async(compute_data_shear_binned, args, error_callback=log_error) for args in compute_data_shear_args]
 
     pool.close()
     pool.join()
@@ -2,26 +2,24 @@ import logging
 import os
 from shutil import rmtree
 
-import numpy as np
-
-from CoLoRe_analysis import compute_data_shear
+from CoLoRe_analysis.compute_data_shear import (compute_data_shear,
+                                                compute_data_shear_binned,
+                                                redshift_to_str_for_path)
+from CoLoRe_analysis.output_backend import get_array_path, load_array
 
 log = logging.getLogger(__name__)
 
-def redshift_to_str_for_path(redshift):
-    return round(float(redshift)*100)
-
 # The class shear reader is used to get data from compute_data_shear, it will always be shear information but it can also deal with cl information.
 class ShearReader:
     def __init__(self, sim_location, analysis_location):
         self.sim_location = sim_location
         self.analysis_location = analysis_location
     
-    def do_compute_data_shear(self, source=1, do_cls=False, do_kappa=False, minz=None, maxz=None, output_path=None):
+    def do_compute_data_shear(self, source=1, do_cls=False, do_kappa=False, minz=None, maxz=None, output_path=None, output_format='dat', map_storage='full'):
         log.info(f'Doing shear data computation for source: { source }. cls: { do_cls }, kappa: { do_kappa }, minz: { minz }, maxz: { maxz }')
-        compute_data_shear(self.sim_location, source, do_cls, do_kappa, minz, maxz, output_path)
+        compute_data_shear(self.sim_location, source, do_cls, do_kappa, minz, maxz, output_path, output_format=output_format, map_storage=map_storage, cache_dir=self.analysis_location + '/catalog_cache')
 
-    def get_values(self, parameter, source=1, minz=None, maxz=None, do_cls=False, do_kappa=False, compute=False):
+    def get_values(self, parameter, source=1, minz=None, maxz=None, do_cls=False, do_kappa=False, compute=False, output_format='dat', map_storage='full'):
         log.info(f'Getting values for sim: { self.sim_location }. Parameter: { parameter }')
         if minz != None and maxz != None:
             minz_str    = redshift_to_str_for_path(minz)
@@ -30,8 +28,9 @@ class ShearReader:
         else:
             path    = self.analysis_location + f'/shear_data/source_{ source }'
 
+        # The format is detected from the files, maps saved as (pixel, value) pairs are expanded
         try:
-            return np.loadtxt( path + '/'+parameter+'.dat')
+            return load_array(path, parameter)
         except OSError:
             if not compute:
                 raise
@@ -41,16 +40,24 @@ class ShearReader:
             if parameter[:2] == 'cl' or parameter == 'ld' or parameter == 'lt':
                 do_cls   = True
 
-            self.do_compute_data_shear(source=source, do_cls=do_cls, do_kappa=do_kappa, minz=minz, maxz=maxz, output_path=path)
-            return np.loadtxt( path + '/'+parameter+'.dat')
+            self.do_compute_data_shear(source=source, do_cls=do_cls, do_kappa=do_kappa, minz=minz, maxz=maxz, output_path=path, output_format=output_format, map_storage=map_storage)
+            return load_array(path, parameter)
 
     
-    def compute_binned_statistics(self, minz, maxz, bins, source=1, do_cls=False, do_kappa=False):
+    def compute_binned_statistics(self, minz, maxz, bins, source=1, do_cls=False, do_kappa=False, full_range=False, output_format='dat', map_storage='full'):
         log.info(f'Computing binned statistics for sim: { self.sim_location }')
-        # I use mp_e1 to not compute if values already exist
         step = (maxz-minz)/bins
-        for b in range(bins):
-            _ = self.get_values('mp_e1', minz=minz+b*step, maxz= minz + (1+b)*step, do_cls=do_cls, do_kappa=do_kappa, source=source, compute=True)
+        zbins = [minz + b*step for b in range(bins+1)]
+
+        # I use mp_e1 to not compute if values already exist
+        paths = [self.analysis_location + f'/shear_data/binned/{ redshift_to_str_for_path(zbins[b]) }_{ redshift_to_str_for_path(zbins[b+1]) }/source_{ source }' for b in range(bins)]
+        if full_range:
+            paths.append(self.analysis_location + f'/shear_data/source_{ source }')
+        if all(get_array_path(path, 'mp_e1') is not None for path in paths):
+            return
+
+        # All the bins are computed at once so each catalog file is read only once
+        compute_data_shear_binned(self.sim_location, zbins, source, do_cls, do_kappa, full_range, self.analysis_location + '/shear_data', output_format=output_format, map_storage=map_storage, cache_dir=self.analysis_location + '/catalog_cache')
     
     def remove_shear_data(self):
         while True:
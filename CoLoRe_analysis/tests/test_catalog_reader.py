@@ -0,0 +1,260 @@
+import json
+import os
+import tempfile
+import unittest
+from shutil import copyfile, rmtree
+from unittest import mock
+
+import healpy as hp
+import numpy as np
+from astropy.io import fits
+
+from CoLoRe_analysis.catalog_reader import CatalogIndex, CatalogReader, CompactStore, PixelIndexCache, compact_catalogs, get_chunk_rows
+
+class TestCatalogReader(unittest.TestCase):
+    def setUp(self):
+        self.sim_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+        self.catalog = CatalogReader(self.sim_path, source=2)
+
+    def test_get_files(self):
+        self.assertEqual( self.catalog.get_files(), [self.sim_path + '/out_srcs_s2_0.fits'] )
+        self.assertEqual( CatalogReader(self.sim_path, source=3).get_files(), [] )
+
+    def test_read_file_only_requested_columns(self):
+        values = CatalogReader.read_file(self.sim_path + '/out_srcs_s2_0.fits', columns=['Z_COSMO'])
+        self.assertEqual( list(values.keys()), ['Z_COSMO'] )
+
+    def test_read_file_native_byteorder(self):
+        values = CatalogReader.read_file(self.sim_path + '/out_srcs_s2_0.fits')
+        self.assertEqual( tuple(values.keys()), CatalogReader.columns )
+
+        with fits.open(self.sim_path + '/out_srcs_s2_0.fits') as hdulist:
+            data = hdulist[1].data
+            for column, value in values.items():
+                self.assertTrue( value.dtype.isnative )
+                np.testing.assert_equal( value, data[column] )
+
+    def test_read_file_chunks(self):
+        chunks = list(CatalogReader.read_file_chunks(self.sim_path + '/out_srcs_s2_0.fits', columns=['Z_COSMO'], chunk_rows=1000))
+        self.assertEqual( [len(chunk['Z_COSMO']) for chunk in chunks], 6*[1000] + [314] )
+
+        full = CatalogReader.read_file(self.sim_path + '/out_srcs_s2_0.fits', columns=['Z_COSMO'])
+        np.testing.assert_equal( np.concatenate([chunk['Z_COSMO'] for chunk in chunks]), full['Z_COSMO'] )
+
+    def test_get_chunk_rows(self):
+        self.assertEqual( get_chunk_rows(max_rows=10), 10 )
+        self.assertGreater( get_chunk_rows(), 0 )
+
+    def test_read(self):
+        values = list(self.catalog.read())
+        self.assertEqual( len(values), 1 )
+        self.assertEqual( len(values[0]['RA']), 6314 )
+
+class TestPixelIndexCache(unittest.TestCase):
+    catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+
+    def setUp(self):
+        self.sim_path = tempfile.mkdtemp()
+        self.filename = self.sim_path + '/out_srcs_s1_0.fits'
+        # Copied (not linked) because the tests change the modification time
+        copyfile(self.catalogs_path + '/out_srcs_s2_0.fits', self.filename)
+        self.cache = PixelIndexCache(self.sim_path + '/analysis/catalog_cache', max_nside=256)
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+
+    def test_sidecar_is_stored(self):
+        pixels = self.cache.load(self.filename, chunk_rows=1000)
+        self.assertTrue( os.path.isfile(self.cache.get_path(self.filename)) )
+        self.assertTrue( self.cache.get_path(self.filename).startswith(self.sim_path + '/analysis/catalog_cache/') )
+        self.assertEqual( len(pixels), 6314 )
+
+        values = CatalogReader.read_file(self.filename)
+        np.testing.assert_equal( pixels, hp.ang2pix(256, np.radians(90-values['DEC']), np.radians(values['RA']), nest=True) )
+
+    def test_sidecar_is_reused(self):
+        self.cache.load(self.filename)
+        with mock.patch.object(PixelIndexCache, '_fill') as fill:
+            self.cache.load(self.filename)
+        fill.assert_not_called()
+
+    def test_sidecar_rebuilt_when_catalog_changes(self):
+        self.cache.load(self.filename)
+        old_path = self.cache.get_path(self.filename)
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        self.assertNotEqual( self.cache.get_path(self.filename), old_path )
+        self.cache.load(self.filename)
+        self.assertFalse( os.path.isfile(old_path) )
+        self.assertTrue( os.path.isfile(self.cache.get_path(self.filename)) )
+
+    def test_degrade(self):
+        values = CatalogReader.read_file(self.filename)
+        pixels = self.cache.load(self.filename)
+        for nside in (256, 64, 8):
+            np.testing.assert_equal( self.cache.degrade(pixels, nside), hp.ang2pix(nside, np.radians(90-values['DEC']), np.radians(values['RA'])) )
+
+        with self.assertRaises(ValueError):
+            self.cache.degrade(pixels, 512)
+        with self.assertRaises(ValueError):
+            self.cache.degrade(pixels, 100)
+
+    def test_read_file_chunks_with_pixels(self):
+        with mock.patch.object(self.cache, '_fill', wraps=self.cache._fill) as fill:
+            chunks = list(CatalogReader.read_file_chunks(self.filename, columns=['Z_COSMO'], chunk_rows=4000, pixel_cache=self.cache, nside=32))
+        self.assertEqual( [len(chunk['PIX']) for chunk in chunks], [4000, 2314] )
+        # The sidecar is also built in chunks
+        self.assertEqual( fill.call_args[0][2], 4000 )
+
+    def test_read_file_chunks_nside_not_power_of_2(self):
+        chunks = list(CatalogReader.read_file_chunks(self.filename, columns=['Z_COSMO'], chunk_rows=4000, pixel_cache=self.cache, nside=100))
+        self.assertFalse( os.path.isdir(self.sim_path + '/analysis/catalog_cache') )
+
+        values = CatalogReader.read_file(self.filename)
+        np.testing.assert_equal( np.concatenate([chunk['PIX'] for chunk in chunks]), hp.ang2pix(100, np.radians(90-values['DEC']), np.radians(values['RA'])) )
+
+class TestCompactStore(unittest.TestCase):
+    catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+
+    def setUp(self):
+        self.sim_path = tempfile.mkdtemp()
+        for i, filename in enumerate(('out_srcs_s1_0.fits', 'out_srcs_s2_0.fits')):
+            copyfile(self.catalogs_path + '/' + filename, self.sim_path + f'/out_srcs_s1_{ i }.fits')
+        self.catalog = CatalogReader(self.sim_path)
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+
+    def test_manifest(self):
+        store = compact_catalogs(self.sim_path)
+        manifest = store.load_manifest()
+        self.assertEqual( manifest['rows'], 8408 + 6314 )
+        self.assertEqual( manifest['files']['out_srcs_s1_1.fits'], {'offset': 8408, 'rows': 6314} )
+        self.assertEqual( set(manifest['columns']), set(CatalogReader.columns) )
+
+        with self.assertRaises(FileNotFoundError):
+            compact_catalogs(self.sim_path, source=2)
+
+    def test_read_from_store(self):
+        fits_values = list(self.catalog.read(chunk_rows=5000))
+        compact_catalogs(self.sim_path, chunk_rows=1000)
+        self.assertIsNotNone( CompactStore.for_file(self.sim_path + '/out_srcs_s1_1.fits') )
+
+        with mock.patch.object(CatalogReader, '_read_fits_chunks') as read_fits:
+            store_values = list(self.catalog.read(chunk_rows=5000))
+        read_fits.assert_not_called()
+
+        self.assertEqual( len(store_values), len(fits_values) )
+        for fits_chunk, store_chunk in zip(fits_values, store_values):
+            for column in CatalogReader.columns:
+                self.assertEqual( store_chunk[column].dtype, np.float32 )
+                np.testing.assert_equal( store_chunk[column], fits_chunk[column] )
+
+    def test_keeps_precision(self):
+        table = fits.BinTableHDU.from_columns([fits.Column(name=column, format='D', array=np.linspace(0, 1, 10) + 1e-12) for column in CatalogReader.columns])
+        for i in range(2):
+            table.writeto(self.sim_path + f'/out_srcs_s1_{ i }.fits', overwrite=True)
+
+        store = compact_catalogs(self.sim_path)
+        values = next(store.read_file_chunks(self.sim_path + '/out_srcs_s1_0.fits'))
+        for column in CatalogReader.columns:
+            np.testing.assert_equal( values[column], np.linspace(0, 1, 10) + 1e-12 )
+
+        store = compact_catalogs(self.sim_path, dtypes={'E1': 'f4'})
+        values = next(store.read_file_chunks(self.sim_path + '/out_srcs_s1_0.fits'))
+        self.assertEqual( values['E1'].dtype, np.float32 )
+        self.assertEqual( values['RA'].dtype, np.float64 )
+
+        with self.assertRaises(ValueError):
+            compact_catalogs(self.sim_path, dtypes={'TYPE': 'i4'})
+
+    def test_manifest_parsed_once(self):
+        compact_catalogs(self.sim_path)
+        with mock.patch('CoLoRe_analysis.catalog_reader.json.load', wraps=json.load) as load:
+            for filename in self.catalog.get_files():
+                list(CatalogReader.read_file_chunks(filename, chunk_rows=1000))
+        self.assertEqual( load.call_count, 1 )
+
+    def test_not_used_when_older_than_catalog(self):
+        compact_catalogs(self.sim_path)
+        manifest_mtime = os.path.getmtime(self.sim_path + '/catalog_cache/compact_s1/manifest.json')
+        os.utime(self.sim_path + '/out_srcs_s1_1.fits', (manifest_mtime + 10, manifest_mtime + 10))
+
+        self.assertIsNotNone( CompactStore.for_file(self.sim_path + '/out_srcs_s1_0.fits') )
+        self.assertIsNone( CompactStore.for_file(self.sim_path + '/out_srcs_s1_1.fits') )
+        self.assertIsNone( CompactStore.for_file(self.sim_path + '/out_srcs_s1_0.fits', columns=['TYPE']) )
+
+class TestCatalogIndex(unittest.TestCase):
+    catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+
+    def setUp(self):
+        self.sim_path = tempfile.mkdtemp()
+        for i, filename in enumerate(('out_srcs_s1_0.fits', 'out_srcs_s2_0.fits')):
+            copyfile(self.catalogs_path + '/' + filename, self.sim_path + f'/out_srcs_s1_{ i }.fits')
+        self.catalog = CatalogReader(self.sim_path, cache_dir=self.sim_path + '/analysis/catalog_cache')
+        self.index = self.catalog.get_index()
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+
+    def test_entries(self):
+        entries = self.index.get_entries(self.catalog.get_files())
+        self.assertTrue( os.path.isfile(self.sim_path + '/analysis/catalog_cache/index_s1.json') )
+        self.assertEqual( [entry['rows'] for entry in entries], [8408, 6314] )
+        self.assertEqual( sum(entries[1]['z_hist']), 6314 )
+
+        values = CatalogReader.read_file(self.sim_path + '/out_srcs_s1_1.fits')
+        for column in CatalogIndex.columns:
+            self.assertEqual( entries[1][column], [values[column].min(), values[column].max()] )
+
+    def test_entries_not_computed_again(self):
+        self.index.get_entries(self.catalog.get_files())
+        with mock.patch.object(CatalogIndex, 'build_entry') as build_entry:
+            self.index.get_entries(self.catalog.get_files())
+        build_entry.assert_not_called()
+
+        os.utime(self.sim_path + '/out_srcs_s1_1.fits', ns=(0, 10**9))
+        with mock.patch.object(CatalogIndex, 'build_entry', wraps=CatalogIndex.build_entry) as build_entry:
+            self.index.get_entries(self.catalog.get_files())
+        build_entry.assert_called_once_with(self.sim_path + '/out_srcs_s1_1.fits', None)
+
+    def test_entries_built_in_one_pass(self):
+        with mock.patch.object(CatalogReader, 'read_file_chunks', wraps=CatalogReader.read_file_chunks) as read_file_chunks:
+            entries = self.index.get_entries(self.catalog.get_files(), chunk_rows=1000)
+        self.assertEqual( [call_[0][2] for call_ in read_file_chunks.call_args_list], [1000, 1000] )
+
+        # Same histogram as reading the file at once
+        z = CatalogReader.read_file(self.sim_path + '/out_srcs_s1_1.fits')['Z_COSMO']
+        self.assertEqual( entries[1], CatalogIndex.build_entry(self.sim_path + '/out_srcs_s1_1.fits', chunk_rows=len(z)) )
+        ibin = np.floor(z / CatalogIndex.z_width).astype(int)
+        np.testing.assert_equal( entries[1]['z_hist'], np.bincount(ibin - ibin.min()) )
+        self.assertEqual( entries[1]['z_first'], ibin.min() )
+
+    def test_count(self):
+        self.assertEqual( self.catalog.count_objects(), 8408 + 6314 )
+        self.assertEqual( self.catalog.count_objects(max_files=0), 8408 )
+        self.assertEqual( self.catalog.count_objects(minz=0, maxz=1), 0 )
+
+        values = CatalogReader.read_file(self.sim_path + '/out_srcs_s1_1.fits')
+        in_range = np.sum((values['Z_COSMO'] >= 2.002) & (values['Z_COSMO'] < 2.004))
+        self.assertGreaterEqual( self.catalog.count_objects(minz=2.002, maxz=2.004), in_range )
+
+    def test_read_skips_files(self):
+        z_s1 = CatalogReader.read_file(self.sim_path + '/out_srcs_s1_0.fits')['Z_COSMO']
+        self.assertEqual( self.catalog.get_files_in_range(z_s1.min(), z_s1.max()), [self.sim_path + '/out_srcs_s1_0.fits'] )
+        self.assertEqual( self.catalog.get_files_in_range(2.001, 2.002), [self.sim_path + '/out_srcs_s1_1.fits'] )
+        self.assertEqual( len(list(self.catalog.read(zrange=(0, 1)))), 0 )
+
+    def test_not_stored_without_cache_dir(self):
+        catalog = CatalogReader(self.sim_path)
+        self.assertEqual( catalog.count_objects(), 8408 + 6314 )
+        self.assertEqual( sorted(os.listdir(self.sim_path)), ['out_srcs_s1_0.fits', 'out_srcs_s1_1.fits'] )
+
+        # Without a stored index the files are read without indexing them
+        with mock.patch.object(CatalogIndex, 'build_entry') as build_entry:
+            self.assertEqual( len(list(catalog.read(zrange=(0, 1)))), 2 )
+        build_entry.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,15 @@
 import json
 import os
+import tempfile
 import unittest
 from shutil import rmtree
 
 import numpy as np
 from mock import call, patch
 
-from CoLoRe_analysis import ccl_reader, compute_data_CCL, compute_data_shear
+from CoLoRe_analysis import ccl_reader, compute_data_CCL, compute_data_shear, output_backend
 
-def mock_compute_data(path, analysis_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[0,0.15,1], nz_h = 50, nz_min=None, nz_max=None, code='anafast'):
+def mock_compute_data(path, analysis_path, source=1, nside=128, max_files=None, downsampling=1, zbins=[0,0.15,1], nz_h = 50, nz_min=None, nz_max=None, code='anafast', n_workers=1, chunk_rows=None, max_pixel_nside=4096, seed=None, theory_ell_per_decade=None, workspace_cache_dir=None, threads=None, lmax=None, ell_edges=None, output_format='dat', map_storage='full', resume=False, checkpoint=False):
     
     output_path = analysis_path + f'/ccl_data/20200101_000000/'
         
@@ -18,7 +19,7 @@ def mock_compute_data(path, analysis_path, source=1, nside=128, max_files=None,
     pairs   = [(0,0), (0,1), (1,1)]
     nz_tot  = [4,5,6]
 
-    compute_data_shear.savetofile(output_path, [cl_mm_t,pairs,nz_tot],['cl_mm_t','pairs','nz_tot'])
+    compute_data_shear.savetofile(output_path, [cl_mm_t,pairs,nz_tot],['cl_mm_t','pairs','nz_tot'], output_format)
 
     info = {
         'id'            : '20200101_000000',
@@ -30,7 +31,10 @@ def mock_compute_data(path, analysis_path, source=1, nside=128, max_files=None,
         'nz_h'          : nz_h,
         'nz_min'        : nz_min,
         'nz_max'        : nz_max,
-        'code'          : code
+        'code'          : code,
+        'shear_weight'  : compute_data_CCL.shear_weights[code],
+        'seed'          : seed,
+        'theory_ell_per_decade' : theory_ell_per_decade
     }
 
     with open(output_path + '/INFO.json','w') as outfile:
@@ -101,6 +105,73 @@ class TestCCLReader(unittest.TestCase):
         self.assertEqual( self.cr.search_output(**self.data1), [self.data1]) 
 
 
+    def test_search_ignores_execution_options(self):
+        self.assertEqual( self.cr.search_output(n_workers=8, **self.data1), [self.data1])
+
+    def test_search_missing_options_are_none(self):
+        self.assertEqual( self.cr.search_output(nside=16, source=1, seed=None), [self.data1] )
+        self.assertEqual( self.cr.search_output(nside=16, source=1, seed=1), [] )
+
+    def test_search_by_run_id(self):
+        options = {key: self.data1.get(key) for key in compute_data_CCL.run_options}
+        id_ = compute_data_CCL.get_run_id(self.cr.get_fingerprint(1), **options)
+        data = dict(options, id=id_)
+        os.makedirs(self.computed_data_path + f'/{ id_ }')
+        with open(self.computed_data_path + f'/{ id_ }/INFO.json','w') as outfile:
+            json.dump(data, outfile)
+
+        # Found without listing the outputs
+        with patch('os.scandir') as mock_scandir:
+            self.assertEqual( self.cr.search_output(**options), [data] )
+        mock_scandir.assert_not_called()
+
+        # With some of the options the outputs are read
+        self.assertCountEqual( self.cr.search_output(nside=16, source=1, zbins=[1,2,3]), [self.data1, data] )
+
+    def test_search_by_run_id_falls_back_to_all_outputs(self):
+        options = {key: self.data1.get(key) for key in compute_data_CCL.run_options}
+        # Outputs still being written are not read
+        os.makedirs(self.computed_data_path + '/.0123456789abcdef.1.tmp')
+        with open(self.computed_data_path + '/.0123456789abcdef.1.tmp/INFO.json','w') as outfile:
+            json.dump(self.data1, outfile)
+        self.assertEqual( self.cr.search_output(**options), [self.data1] )
+
+    def test_search_after_catalogs_change(self):
+        catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+        sim_path = tempfile.mkdtemp()
+        self.addCleanup(rmtree, sim_path)
+        for i in range(2):
+            os.symlink(catalogs_path + '/out_srcs_s1_0.fits', sim_path + f'/out_srcs_s1_{ i }.fits')
+
+        options = {key: self.data1.get(key) for key in compute_data_CCL.run_options}
+        id_ = compute_data_CCL.get_run_id(compute_data_CCL.get_sim_fingerprint(sim_path), **options)
+        data = dict(options, id=id_)
+        os.makedirs(self.computed_data_path + f'/{ id_ }')
+        with open(self.computed_data_path + f'/{ id_ }/INFO.json','w') as outfile:
+            json.dump(data, outfile)
+
+        # The catalogs are purged after the run, so the id of the options is not the same
+        os.remove(sim_path + '/out_srcs_s1_1.fits')
+        reader = ccl_reader.CCLReader(sim_path, self.analysis_path)
+        self.assertNotEqual( compute_data_CCL.get_run_id(reader.get_fingerprint(1), **options), id_ )
+        self.assertCountEqual( reader.search_output(**options), [self.data1, data] )
+
+    def test_search_by_shear_weight(self):
+        namaster = dict(self.data1, id='2', code='namaster', shear_weight='nmap')
+        # Computed before shear_weight was saved
+        fullsky = dict(self.data1, id='3', code='fullsky')
+        for data in (namaster, fullsky):
+            os.makedirs(self.computed_data_path + f'/{ data["id"] }')
+            with open(self.computed_data_path + f'/{ data["id"] }/INFO.json','w') as outfile:
+                json.dump(data, outfile)
+
+        self.assertEqual( self.cr.search_output(nside=16, source=1, shear_weight='nmap'), [namaster] )
+        self.assertEqual( self.cr.search_output(nside=16, source=1, shear_weight='unit'), [fullsky] )
+        self.assertEqual( self.cr.search_output(nside=16, source=1), [self.data1, namaster, fullsky] )
+
+        with self.assertRaises(ValueError):
+            self.cr.do_data_computations(code='fullsky', shear_weight='nmap')
+
     def test_search_with_nothing_to_search(self):
         if os.path.isdir(self.computed_data_path):
             rmtree(self.computed_data_path)
@@ -118,6 +189,45 @@ class TestCCLReader(unittest.TestCase):
         cl_mm_t = np.loadtxt(self.computed_data_path + '/20200101_000000/cl_mm_t.dat')
         np.testing.assert_equal(cl_mm_t, [1,2,3])
 
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_data', side_effect=mock_compute_data)
+    def test_get_values_npy_output(self, mock_func):
+        for dir_ in os.scandir(self.computed_data_path):
+            rmtree(dir_)
+        self.cr.do_data_computations( source=1, output_format='npy' )
+        self.assertTrue( os.path.isfile(self.computed_data_path + '/20200101_000000/cl_mm_t.npy') )
+        cl_mm_t = self.cr.get_values('cl_mm_t', source=1, output_format='npy')
+        # Read from the binary file (the text file would give floats)
+        self.assertTrue( np.issubdtype(cl_mm_t.dtype, np.integer) )
+        np.testing.assert_equal( cl_mm_t, [1,2,3] )
+
+    def test_h5_output(self):
+        # One HDF5 file with the arrays and the info as attributes, no INFO.json
+        data5 = dict(self.data4, id='5', source=5)
+        os.makedirs(self.computed_data_path + '/5')
+        output_backend.save_array(self.computed_data_path + '/5', 'cl_dd_d', np.arange(4.), 'h5gz')
+        output_backend.save_info(self.computed_data_path + '/5', data5, 'h5gz')
+        self.assertEqual( os.listdir(self.computed_data_path + '/5'), ['data.h5'] )
+
+        self.assertEqual( self.cr.search_output(source=5), [data5] )
+        np.testing.assert_equal( self.cr.get_values('cl_dd_d', source=5), np.arange(4.) )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_data', side_effect=mock_compute_data)
+    def test_do_data_computations_n_workers(self, mock_func):
+        self.cr.do_data_computations( source=1, n_workers=4 )
+        self.assertEqual( mock_func.call_args[1]['n_workers'], 4 )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_data')
+    def test_compute_missing_nsides(self, mock_func):
+        options = {key: value for key, value in self.data1.items() if key not in ('id', 'nside')}
+
+        self.assertEqual( self.cr.compute_missing_nsides([16, 64, 128], **options), [64, 128] )
+        mock_func.assert_called_once()
+        self.assertEqual( mock_func.call_args[0][3], [64, 128] )
+
+        mock_func.reset_mock()
+        self.assertEqual( self.cr.compute_missing_nsides([16], **options), [] )
+        mock_func.assert_not_called()
+
     @patch('builtins.input', return_value='y')
     @patch('CoLoRe_analysis.compute_data_CCL.compute_data', side_effect=mock_compute_data)
     def test_creation_when_does_not_exist(self, mock_func, mocked_input):
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+from unittest import mock
+
+import numpy as np
+
+from CoLoRe_analysis.checkpoint import IngestionCheckpoint
+from CoLoRe_analysis.map_accumulator import MapAccumulator
+
+class TestIngestionCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.path = self.location + '/run/checkpoint_0.npz'
+        self.accumulator = MapAccumulator(4, [0, 1, 2], nz_h=5)
+        self.accumulator.nmap[1, 3] = 2
+        self.accumulator.nz[0, 1] = 7
+
+    def tearDown(self):
+        rmtree(self.location)
+
+    def test_save_and_load(self):
+        checkpoint = IngestionCheckpoint(self.path, 'key')
+        np.random.seed(1)
+        checkpoint.save(self.accumulator, 3, force=True)
+        expected = np.random.random(5)
+
+        accumulator = MapAccumulator(4, [0, 1, 2], nz_h=5)
+        self.assertEqual( IngestionCheckpoint(self.path, 'key').load(accumulator), 3 )
+        np.testing.assert_equal( accumulator.nmap, self.accumulator.nmap )
+        np.testing.assert_equal( accumulator.nz, self.accumulator.nz )
+        # The global random state continues from the checkpoint
+        np.testing.assert_equal( np.random.random(5), expected )
+
+    def test_other_key(self):
+        IngestionCheckpoint(self.path, 'key').save(self.accumulator, 3, force=True)
+        self.assertTrue( IngestionCheckpoint(self.path, 'key').exists() )
+        self.assertFalse( IngestionCheckpoint(self.path, 'other').exists() )
+
+        accumulator = MapAccumulator(4, [0, 1, 2], nz_h=5)
+        self.assertEqual( IngestionCheckpoint(self.path, 'other').load(accumulator), 0 )
+        self.assertEqual( accumulator.nmap.sum(), 0 )
+
+    def test_interval(self):
+        checkpoint = IngestionCheckpoint(self.path, 'key')
+        checkpoint.save(self.accumulator, 1)
+        self.assertFalse( os.path.isfile(self.path) )
+
+        with mock.patch.object(IngestionCheckpoint, 'interval', 0):
+            checkpoint.save(self.accumulator, 1)
+        self.assertTrue( os.path.isfile(self.path) )
+        self.assertEqual( os.listdir(self.location + '/run'), ['checkpoint_0.npz'] )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ import logging
 import os
 import pickle
 import sys
+import tempfile
 import unittest
 import warnings
 from datetime import date
@@ -11,28 +12,35 @@ from types import SimpleNamespace
 from unittest import skipUnless
 from unittest.mock import call, patch
 
+import healpy as hp
 import numpy as np
-from mock import call, patch
+from mock import MagicMock, call, patch
 
-from CoLoRe_analysis import sims_reader, compute_data_CCL
+from CoLoRe_analysis import sims_reader, compute_data_CCL, output_backend, theory
+from CoLoRe_analysis.checkpoint import IngestionCheckpoint
 from CoLoRe_analysis.tests import test_ccl_reader
 
 log = logging.getLogger(__name__)
 
+def get_output_path(sim_path, analysis_path, **options):
+    '''Output folder of a run of compute_data with options'''
+    options = {key: value for key, value in options.items() if key in compute_data_CCL.run_options}
+    fingerprint = compute_data_CCL.get_sim_fingerprint(sim_path, options.get('source', 1))
+    return analysis_path + '/ccl_data/' + compute_data_CCL.get_run_id(fingerprint, **options)
 
 @skipUnless('RUN_CCL_TESTS' in os.environ, 'Only run when activated in environment')
 class TestComputeDataCCL(unittest.TestCase):
     sim_path    = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/New_CCL'
     analysis_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/analysis/New_CCL'
-    output_path = analysis_path + '/ccl_data/20200101_000000'
 
     def setUp(self):
         warnings.simplefilter('ignore', category=RuntimeWarning)
         warnings.simplefilter('ignore', category=ResourceWarning)
         
     def tearDown(self):
-        if os.path.isdir(self.analysis_path + '/ccl_data'):
-            rmtree(self.analysis_path + '/ccl_data')
+        for folder in ('/ccl_data', '/theory_cache'):
+            if os.path.isdir(self.analysis_path + folder):
+                rmtree(self.analysis_path + folder)
 
     @patch('CoLoRe_analysis.compute_data_CCL.datetime')
     @patch('builtins.print')
@@ -44,6 +52,7 @@ class TestComputeDataCCL(unittest.TestCase):
         mocked_time.today.return_value = date(2020,1,1)
         mocked_time.side_effect = lambda *args, **kw: date(*args, **kw)
         compute_data_CCL.compute_data(self.sim_path, self.analysis_path, zbins=[0,0.15,1],code='anafast')
+        self.output_path = get_output_path(self.sim_path, self.analysis_path, zbins=[0,0.15,1], code='anafast')
 
         # values = ['pairs', 'shotnoise', 'nz_tot', 'z_nz', 'cl_dd_d', 'cl_dd_t', 'cl_dm_d', 'cl_dm_t', 'cl_md_d', 'cl_md_t', 'cl_mm_d', 'cl_mm_t']
         values = ['pairs', 'shotnoise', 'nz_tot', 'z_nz', 'cl_dd_d', 'cl_dd_t', 'cl_dm_d', 'cl_dm_t', 'cl_mm_d', 'cl_mm_t']
@@ -55,8 +64,10 @@ class TestComputeDataCCL(unittest.TestCase):
         with open(self.output_path + '/INFO.json') as json_file:
             data = json.load(json_file)
             self.assertEqual( data['zbins'], [0,0.15,1])
-            self.assertEqual( data['id'], '20200101_000000')
+            self.assertEqual( data['id'], os.path.basename(self.output_path))
+            self.assertEqual( data['date'], '20200101_000000')
             self.assertEqual( data['code'], 'anafast')
+            self.assertEqual( data['shear_weight'], 'unit')
     
     @patch('CoLoRe_analysis.compute_data_CCL.datetime')
     @patch('builtins.print')
@@ -68,6 +79,7 @@ class TestComputeDataCCL(unittest.TestCase):
         mocked_time.today.return_value = date(2020,1,1)
         mocked_time.side_effect = lambda *args, **kw: date(*args, **kw)
         compute_data_CCL.compute_data(self.sim_path, self.analysis_path, zbins=[0, 0.15, 1], code='namaster')
+        self.output_path = get_output_path(self.sim_path, self.analysis_path, zbins=[0, 0.15, 1], code='namaster')
 
         names = ['pairs', 'shotnoise', 'nz_tot', 'z_nz', 'cl_dd_d', 'cl_dd_t', 'cl_dm_d', 'cl_dm_t', 'cl_mm_d', 'cl_mm_t']
 
@@ -77,8 +89,461 @@ class TestComputeDataCCL(unittest.TestCase):
         with open(self.output_path + '/INFO.json') as json_file:
             data = json.load(json_file)
             self.assertEqual( data['zbins'], [0, 0.15, 1] )
-            self.assertEqual( data['id'], '20200101_000000')
+            self.assertEqual( data['id'], os.path.basename(self.output_path))
+            self.assertEqual( data['date'], '20200101_000000')
             self.assertEqual( data['code'], 'namaster')
+            self.assertEqual( data['shear_weight'], 'nmap')
+
+class TestReadCatalogs(unittest.TestCase):
+    catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+
+    def setUp(self):
+        # Fake simulation with several catalog files
+        self.sim_path = tempfile.mkdtemp()
+        for i, filename in enumerate(('out_srcs_s1_0.fits', 'out_srcs_s2_0.fits', 'out_srcs_s1_0.fits')):
+            os.symlink(self.catalogs_path + '/' + filename, self.sim_path + f'/out_srcs_s1_{ i }.fits')
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+
+    def test_read_catalogs(self):
+        nmap, e1map, e2map, nz_tot, z_nz = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10, nz_max=2.5)
+        self.assertEqual( nmap.shape, (1, 3072) )
+        self.assertEqual( np.sum(nmap), 2*8408 + 6314 )
+        self.assertEqual( np.sum(nz_tot), 2*8408 + 6314 )
+        np.testing.assert_almost_equal( z_nz, np.arange(0.125, 2.5, 0.25) )
+
+    def test_read_catalogs_max_files(self):
+        nmap, _, _, _, _ = compute_data_CCL.read_catalogs(self.sim_path, nside=16, max_files=0, zbins=[0, 10])
+        self.assertEqual( np.sum(nmap), 8408 )
+
+    def test_read_catalogs_workers(self):
+        serial = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10)
+        parallel = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10, n_workers=2)
+
+        for a, b in zip(serial, parallel):
+            np.testing.assert_allclose(a, b)
+
+    def test_read_catalogs_workers_without_seed(self):
+        # Two workers reading the same catalog, with a bin edge in the middle of its redshifts
+        os.replace(self.sim_path + '/out_srcs_s1_2.fits', self.sim_path + '/out_srcs_s1_1.fits')
+        options = dict(nside=16, zbins=[0, 1.905, 10], nz_h=10, max_pixel_nside=0)
+        np.random.seed(0)
+        nmap, *_ = compute_data_CCL.read_catalogs(self.sim_path, n_workers=2, **options)
+
+        # With the same random stream in both workers every pixel would have an even number of sources
+        self.assertEqual( np.sum(nmap), 2*8408 )
+        self.assertTrue( np.any(nmap % 2 == 1) )
+
+        np.random.seed(0)
+        np.testing.assert_array_equal( compute_data_CCL.read_catalogs(self.sim_path, n_workers=2, **options)[0], nmap )
+
+    def test_read_catalogs_pixel_cache(self):
+        cache_dir = self.sim_path + '/analysis/catalog_cache'
+        computed = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10, max_pixel_nside=0, pixel_cache_dir=cache_dir)
+        self.assertFalse( os.path.isdir(cache_dir) )
+        # Without a folder for the cache, nothing is stored
+        compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10, max_pixel_nside=512)
+        self.assertFalse( os.path.isdir(self.sim_path + '/catalog_cache') )
+
+        for _ in range(2):
+            cached = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10, max_pixel_nside=512, pixel_cache_dir=cache_dir)
+            self.assertEqual( len(os.listdir(cache_dir)), 3 )
+            for a, b in zip(computed, cached):
+                np.testing.assert_allclose(a, b)
+
+    def test_read_catalogs_nside_not_power_of_2(self):
+        cache_dir = self.sim_path + '/analysis/catalog_cache'
+        computed = compute_data_CCL.read_catalogs(self.sim_path, nside=12, zbins=[0, 10], nz_h=10, max_pixel_nside=0)
+        cached = compute_data_CCL.read_catalogs(self.sim_path, nside=12, zbins=[0, 10], nz_h=10, max_pixel_nside=512, pixel_cache_dir=cache_dir)
+        self.assertFalse( os.path.isdir(cache_dir) )
+        for a, b in zip(computed, cached):
+            np.testing.assert_allclose(a, b)
+
+    def test_read_catalogs_seed(self):
+        options = dict(nside=16, zbins=[0, 2.002, 2.006, 10], nz_h=10, downsampling=0.5, seed=3)
+        reference = compute_data_CCL.read_catalogs(self.sim_path, **options)
+        np.random.seed(0) # The global random state is not used
+        for extra in (dict(n_workers=2), dict(chunk_rows=1000), dict(pixel_cache_dir=self.sim_path + '/analysis/catalog_cache')):
+            values = compute_data_CCL.read_catalogs(self.sim_path, **options, **extra)
+            for a, b in zip(reference, values):
+                np.testing.assert_array_equal(a, b)
+
+        other_seed = compute_data_CCL.read_catalogs(self.sim_path, **dict(options, seed=4))
+        self.assertFalse( np.array_equal(reference[0], other_seed[0]) )
+
+    def test_read_catalogs_resume(self):
+        checkpoint_dir = self.sim_path + '/run'
+        for options in (dict(seed=3), dict(seed=None, downsampling=0.5)):
+            options = dict(nside=16, zbins=[0, 2.002, 10], nz_h=10, **options)
+            np.random.seed(0)
+            reference = compute_data_CCL.read_catalogs(self.sim_path, **options)
+
+            # Stops while reading the last file
+            read_file_chunks = compute_data_CCL.CatalogReader.read_file_chunks
+            def fail_last_file(filename, *args):
+                if filename.endswith('_2.fits'):
+                    raise MemoryError
+                return read_file_chunks(filename, *args)
+
+            np.random.seed(0)
+            with patch.object(IngestionCheckpoint, 'interval', 0), patch('CoLoRe_analysis.compute_data_CCL.CatalogReader.read_file_chunks', side_effect=fail_last_file):
+                with self.assertRaises(MemoryError):
+                    compute_data_CCL.read_catalogs(self.sim_path, checkpoint_dir=checkpoint_dir, **options)
+
+            np.random.seed(10)
+            with patch('CoLoRe_analysis.compute_data_CCL.CatalogReader.read_file_chunks', wraps=read_file_chunks) as mock_read:
+                resumed = compute_data_CCL.read_catalogs(self.sim_path, checkpoint_dir=checkpoint_dir, **options)
+            self.assertEqual( [call_[0][0] for call_ in mock_read.call_args_list], [self.sim_path + '/out_srcs_s1_2.fits'] )
+            for a, b in zip(reference, resumed):
+                np.testing.assert_array_equal(a, b)
+            rmtree(checkpoint_dir)
+
+    def test_compute_data_resume(self):
+        analysis_path = self.sim_path + '/analysis'
+        options = dict(nside=8, zbins=[0, 10], code='anafast', seed=1)
+        # Stops after reading the catalogs
+        def read_and_fail(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, checkpoint_dir, **kwargs):
+            compute_data_CCL.read_catalogs(sim_path, source, nside, max_files, downsampling, zbins, nz_h, nz_min, nz_max, n_workers, chunk_rows, max_pixel_nside, seed, checkpoint_dir)
+            raise MemoryError
+
+        output_path = get_output_path(self.sim_path, analysis_path, **options)
+        checkpoint_dir = analysis_path + '/ccl_data/.checkpoints/' + os.path.basename(output_path)
+        with patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast', side_effect=read_and_fail):
+            # Without checkpoints there is nothing to resume
+            with self.assertRaises(MemoryError):
+                compute_data_CCL.compute_data(self.sim_path, analysis_path, **options)
+            self.assertFalse( os.path.isdir(checkpoint_dir) )
+
+            with self.assertRaises(MemoryError):
+                compute_data_CCL.compute_data(self.sim_path, analysis_path, **options, checkpoint=True)
+        self.assertTrue( os.path.isfile(checkpoint_dir + '/checkpoint_0.npz') )
+        # No partial output is left
+        self.assertEqual( os.listdir(analysis_path + '/ccl_data'), ['.checkpoints'] )
+
+        with patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast', return_value={'cl_mm_t': [1, 2, 3]}) as mock_cls:
+            # Other options do not resume the run
+            compute_data_CCL.compute_data(self.sim_path, analysis_path, **dict(options, seed=2), resume=True)
+            self.assertNotEqual( mock_cls.call_args[1]['checkpoint_dir'], checkpoint_dir )
+            self.assertTrue( os.path.isfile(checkpoint_dir + '/checkpoint_0.npz') )
+
+            compute_data_CCL.compute_data(self.sim_path, analysis_path, **options, resume=True)
+            self.assertEqual( mock_cls.call_args[1]['checkpoint_dir'], checkpoint_dir )
+
+        self.assertEqual( sorted(os.listdir(output_path)), ['INFO.json', 'cl_mm_t.dat'] )
+        self.assertFalse( os.path.isdir(checkpoint_dir) )
+
+    def test_compute_data_without_resume(self):
+        analysis_path = self.sim_path + '/analysis'
+        output_path = get_output_path(self.sim_path, analysis_path, nside=8, zbins=[0, 10], code='anafast')
+        checkpoint_dir = analysis_path + '/ccl_data/.checkpoints/' + os.path.basename(output_path)
+        os.makedirs(checkpoint_dir)
+        open(checkpoint_dir + '/checkpoint_0.npz', 'w').close()
+
+        # The checkpoints of the run are removed before reading the catalogs
+        def check_removed(*args, **kwargs):
+            self.assertFalse( os.path.isfile(checkpoint_dir + '/checkpoint_0.npz') )
+            return {'cl_mm_t': [1, 2, 3]}
+
+        with patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast', side_effect=check_removed) as mock_cls:
+            compute_data_CCL.compute_data(self.sim_path, analysis_path, nside=8, zbins=[0, 10], code='anafast')
+        mock_cls.assert_called_once()
+
+    def test_compute_data_replaces_output(self):
+        analysis_path = self.sim_path + '/analysis'
+        options = dict(nside=8, zbins=[0, 10], code='anafast')
+        output_path = get_output_path(self.sim_path, analysis_path, **options)
+        with patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast', return_value={'cl_mm_t': [1, 2, 3], 'nmap': np.ones((1, 768))}):
+            compute_data_CCL.compute_data(self.sim_path, analysis_path, **options, output_format='npy')
+        self.assertEqual( sorted(os.listdir(output_path)), ['INFO.json', 'cl_mm_t.npy', 'nmap.npy'] )
+
+        # The files of the previous output are not kept
+        with patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast', return_value={'cl_mm_t': [4, 5, 6]}):
+            compute_data_CCL.compute_data(self.sim_path, analysis_path, **options, output_format='h5')
+        self.assertEqual( os.listdir(output_path), ['data.h5'] )
+        np.testing.assert_equal( output_backend.load_array(output_path, 'cl_mm_t'), [4, 5, 6] )
+
+    def test_replace_output_written_by_other_run(self):
+        tmp_path, output_path = self.sim_path + '/tmp', self.sim_path + '/output'
+        os.makedirs(tmp_path)
+        # Output written by another run after the previous one was removed
+        def replace(src, dst):
+            os.makedirs(output_path + '/other')
+            raise OSError
+        with patch('os.replace', side_effect=replace):
+            compute_data_CCL.replace_output(tmp_path, output_path)
+        self.assertEqual( os.listdir(output_path), ['other'] )
+
+    def test_get_run_id(self):
+        fingerprint = compute_data_CCL.get_sim_fingerprint(self.sim_path)
+        id_ = compute_data_CCL.get_run_id(fingerprint, nside=8, zbins=[0, 10], code='anafast')
+        self.assertRegex( id_, '^[0-9a-f]{16}$' )
+        # Same options given with other types
+        self.assertEqual( compute_data_CCL.get_run_id(fingerprint, nside=np.int64(8), zbins=np.array([0., 10.]), code='anafast', downsampling=1.), id_ )
+
+        self.assertEqual( compute_data_CCL.get_run_id(fingerprint, nside=8, zbins=[0, 10], code='anafast', nz_max=10), id_ )
+        for options in (dict(nside=16), dict(zbins=[0, 5]), dict(code='namaster'), dict(seed=1), dict(ell_edges=[0, 10, 24]), dict(max_files=0), dict(nz_max=5)):
+            self.assertNotEqual( compute_data_CCL.get_run_id(fingerprint, **dict(dict(nside=8, zbins=[0, 10], code='anafast'), **options)), id_ )
+
+        # Changing the catalogs changes the fingerprint
+        os.remove(self.sim_path + '/out_srcs_s1_2.fits')
+        self.assertNotEqual( compute_data_CCL.get_sim_fingerprint(self.sim_path), fingerprint )
+
+    def test_get_random_values(self):
+        normal, uniform = compute_data_CCL.get_random_values(1, 'out_srcs_s1_0.fits', 0, 100000, uniform=True)
+        self.assertEqual( normal.shape, (100000,) )
+        self.assertTrue( np.all((uniform >= 0) & (uniform < 1)) )
+
+        pieces = [compute_data_CCL.get_random_values(1, 'out_srcs_s1_0.fits', start, 7000)[0] for start in range(0, 100000, 7000)]
+        np.testing.assert_array_equal( np.concatenate(pieces)[:100000], normal )
+        self.assertIsNone( compute_data_CCL.get_random_values(1, 'out_srcs_s1_0.fits', 0, 10)[1] )
+        self.assertFalse( np.array_equal(compute_data_CCL.get_random_values(1, 'out_srcs_s1_1.fits', 0, 10)[0], normal[:10]) )
+
+    def test_random_blocks_generated_once(self):
+        compute_data_CCL.get_random_block.cache_clear()
+        for start in range(0, 100000, 7000):
+            compute_data_CCL.get_random_values(2, 'out_srcs_s1_0.fits', start, 7000, uniform=True)
+        self.assertEqual( compute_data_CCL.get_random_block.cache_info().misses, 2 )
+
+    def test_read_catalogs_keeps_chunk_rows_with_seed(self):
+        full = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 1.905, 10], nz_h=10, seed=3, downsampling=0.5)
+        with self.assertLogs('CoLoRe_analysis.compute_data_CCL', level='INFO') as logs:
+            chunked = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 1.905, 10], nz_h=10, seed=3, downsampling=0.5, chunk_rows=1000)
+        self.assertIn( 'chunks of 1000 rows', '\n'.join(logs.output) )
+
+        for a, b in zip(full, chunked):
+            np.testing.assert_allclose(a, b)
+
+    def test_read_catalogs_chunks(self):
+        full = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10)
+        chunked = compute_data_CCL.read_catalogs(self.sim_path, nside=16, zbins=[0, 10], nz_h=10, chunk_rows=1000)
+
+        for a, b in zip(full, chunked):
+            np.testing.assert_allclose(a, b)
+
+class TestNsideSweep(unittest.TestCase):
+    catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+
+    def setUp(self):
+        self.sim_path = tempfile.mkdtemp()
+        self.analysis_path = tempfile.mkdtemp()
+        os.symlink(self.catalogs_path + '/out_srcs_s1_0.fits', self.sim_path + '/out_srcs_s1_0.fits')
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+        rmtree(self.analysis_path)
+
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast')
+    def test_catalogs_read_once(self, mock_cls):
+        mock_cls.return_value = {'cl_mm_t': [1,2,3]}
+
+        with patch('CoLoRe_analysis.compute_data_CCL.read_catalogs', wraps=compute_data_CCL.read_catalogs) as mock_read:
+            compute_data_CCL.compute_data(self.sim_path, self.analysis_path, nside=[8, 32, 16], zbins=[0, 10], code='anafast')
+        mock_read.assert_called_once()
+        self.assertEqual( mock_read.call_args[0][2], 32 )
+        # The pixel index is stored with the analysis, the simulation is not written
+        self.assertEqual( os.listdir(self.sim_path), ['out_srcs_s1_0.fits'] )
+        self.assertTrue( os.path.isdir(self.analysis_path + '/catalog_cache') )
+
+        direct = compute_data_CCL.read_catalogs(self.sim_path, nside=8, zbins=[0, 10])
+        for nside in (8, 16, 32):
+            with open(get_output_path(self.sim_path, self.analysis_path, nside=nside, zbins=[0, 10], code='anafast') + '/INFO.json') as json_file:
+                self.assertEqual( json.load(json_file)['nside'], nside )
+
+        maps = [call_[1]['maps'] for call_ in mock_cls.call_args_list]
+        self.assertEqual( [call_[0][2] for call_ in mock_cls.call_args_list], [32, 16, 8] )
+        self.assertEqual( [nmap.shape[1] for nmap, *_ in maps], [12288, 3072, 768] )
+        np.testing.assert_equal( maps[2][0], direct[0] )
+        np.testing.assert_allclose( maps[2][1], direct[1], atol=1e-10 )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast')
+    def test_theory_error_in_info(self, mock_cls):
+        mock_cls.return_value = {'cl_mm_t': [1,2,3], 'info': {'theory_max_rel_error': 1e-4, 'threads': {'theory': 2}}}
+
+        compute_data_CCL.compute_data(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast', theory_ell_per_decade=20)
+        self.assertEqual( mock_cls.call_args[1]['theory_ell_per_decade'], 20 )
+
+        output_path = get_output_path(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast', theory_ell_per_decade=20)
+        with open(output_path + '/INFO.json') as json_file:
+            info = json.load(json_file)
+        self.assertEqual( info['theory_ell_per_decade'], 20 )
+        self.assertEqual( info['theory_max_rel_error'], 1e-4 )
+        self.assertEqual( info['threads'], {'theory': 2} )
+        self.assertFalse( os.path.isfile(output_path + '/info.dat') )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast')
+    def test_h5_output(self, mock_cls):
+        mock_cls.return_value = {'cl_mm_t': np.ones((3, 24)), 'info': {'threads': {'theory': 2}}}
+
+        compute_data_CCL.compute_data(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast', output_format='h5')
+        output_path = get_output_path(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast')
+        self.assertEqual( os.listdir(output_path), ['data.h5'] )
+        self.assertEqual( output_backend.load_info(output_path)['threads'], {'theory': 2} )
+        np.testing.assert_equal( output_backend.load_array(output_path, 'cl_mm_t'), np.ones((3, 24)) )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.compute_all_cls_anafast')
+    def test_partial_maps(self, mock_cls):
+        nmap = np.zeros((1, 768))
+        nmap[0, :10] = 3
+        mock_cls.return_value = {'cl_mm_t': np.ones((1, 24)), 'nmap': nmap}
+
+        compute_data_CCL.compute_data(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast', output_format='npy', map_storage='partial')
+        output_path = get_output_path(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast')
+        self.assertEqual( sorted(os.listdir(output_path)), ['INFO.json', 'cl_mm_t.npy', 'nmap.npz'] )
+        np.testing.assert_equal( output_backend.load_array(output_path, 'nmap'), nmap )
+
+        # Checked before reading the catalogs
+        mock_cls.reset_mock()
+        with self.assertRaises(ValueError):
+            compute_data_CCL.compute_data(self.sim_path, self.analysis_path, nside=8, zbins=[0, 10], code='anafast', map_storage='partial')
+        mock_cls.assert_not_called()
+
+class TestNamasterWorkspace(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.nmt = MagicMock()
+        # Writing the workspace creates the file
+        self.nmt.NmtWorkspace.return_value.write_to.side_effect = lambda path: open(path, 'w').close()
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def get_workspace(self, key, cache_dir):
+        with patch.dict(sys.modules, {'pymaster': self.nmt}):
+            return compute_data_CCL.get_namaster_workspace('f1', 'f2', 'bins', key, cache_dir)
+
+    def test_workspace_cached(self):
+        workspace = self.get_workspace('abc', self.cache_dir)
+        workspace.compute_coupling_matrix.assert_called_once_with('f1', 'f2', 'bins')
+        self.assertEqual( os.listdir(self.cache_dir), ['abc.fits'] )
+
+        self.nmt.reset_mock()
+        workspace = self.get_workspace('abc', self.cache_dir)
+        workspace.compute_coupling_matrix.assert_not_called()
+        workspace.read_from.assert_called_once_with(self.cache_dir + '/abc.fits')
+
+        self.nmt.reset_mock()
+        workspace = self.get_workspace('def', self.cache_dir)
+        workspace.compute_coupling_matrix.assert_called_once()
+
+    def test_without_cache(self):
+        workspace = self.get_workspace('abc', None)
+        workspace.compute_coupling_matrix.assert_called_once()
+        workspace.write_to.assert_not_called()
+
+    def test_unreadable_workspace(self):
+        open(self.cache_dir + '/abc.fits', 'w').close()
+        self.nmt.NmtWorkspace.return_value.read_from.side_effect = RuntimeError
+        workspace = self.get_workspace('abc', self.cache_dir)
+        workspace.compute_coupling_matrix.assert_called_once()
+
+class TestHarmonicCodes(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.nside = 8
+        npix = 12*self.nside**2
+        self.nmap = rng.poisson(20, size=(2, npix)).astype(float) + 1
+        self.e1map = rng.normal(0, 0.1, size=(2, npix)) * self.nmap
+        self.e2map = rng.normal(0, 0.1, size=(2, npix)) * self.nmap
+        self.maps = (self.nmap.copy(), self.e1map.copy(), self.e2map.copy(), np.ones((2, 5)), np.linspace(0, 1, 5))
+
+    @patch('CoLoRe_analysis.compute_data_CCL.theory')
+    def test_anafast_transforms_each_bin_once(self, mock_theory):
+        mock_theory.read_pk_grid.return_value = [None]*5
+        mock_theory.compute_theory_cls.return_value = {key: np.ones((3, 24)) for key in ('cl_dd_t', 'cl_dm_t', 'cl_mm_t', 'cl_md_t')}
+
+        with patch('CoLoRe_analysis.compute_data_CCL.hp.map2alm', wraps=hp.map2alm) as map2alm:
+            values = compute_data_CCL.compute_all_cls_anafast(None, nside=self.nside, zbins=[0, 1, 2], maps=self.maps)
+        self.assertEqual( map2alm.call_count, 2 )
+
+        fields = [[n/n.mean() - 1, e1/n, e2/n] for n, e1, e2 in zip(self.nmap, self.e1map, self.e2map)]
+        for i, (p1, p2) in enumerate(values['pairs']):
+            cls = hp.anafast(fields[p1], fields[p2], pol=True)
+            for key, j in (('cl_dd_d', 0), ('cl_mm_d', 1), ('cl_bb_d', 2), ('cl_dm_d', 3), ('cl_mb_d', 4), ('cl_db_d', 5)):
+                np.testing.assert_allclose( values[key][i], cls[j], rtol=1e-12, atol=1e-20 )
+            np.testing.assert_allclose( values['cl_md_d'][i], hp.anafast(fields[p2], fields[p1])[3], rtol=1e-12, atol=1e-20 )
+
+    def test_ell_edges(self):
+        np.testing.assert_equal( compute_data_CCL.get_ell_edges(8), np.arange(25) )
+        np.testing.assert_equal( compute_data_CCL.get_ell_edges(8, lmax=16), np.arange(18) )
+        np.testing.assert_equal( compute_data_CCL.get_ell_edges(8, ell_edges=[2, 5, 10, 20]), [2, 5, 10, 20] )
+        np.testing.assert_equal( compute_data_CCL.get_ell_edges(8, lmax=12, ell_edges=[2, 5, 10, 20]), [2, 5, 10] )
+        with self.assertRaises(ValueError):
+            compute_data_CCL.get_ell_edges(8, ell_edges=[5, 2, 10])
+
+    def test_bin_cls(self):
+        cls = np.arange(24.)[None, :] * [[1], [2]]
+        np.testing.assert_equal( compute_data_CCL.bin_cls(cls, np.arange(25)), cls )
+        np.testing.assert_equal( compute_data_CCL.bin_cls(cls, [2, 4, 7]), [[2.5, 5], [5, 10]] )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.theory')
+    def test_anafast_bandpowers(self, mock_theory):
+        mock_theory.read_pk_grid.return_value = [None]*5
+        mock_theory.compute_theory_cls.return_value = {key: np.ones((3, 13)) for key in ('cl_dd_t', 'cl_dm_t', 'cl_mm_t', 'cl_md_t')}
+
+        values = compute_data_CCL.compute_all_cls_anafast(None, nside=self.nside, zbins=[0, 1, 2], maps=self.maps, ell_edges=[0, 4, 8, 13])
+        np.testing.assert_equal( mock_theory.compute_theory_cls.call_args[0][7], np.arange(13) )
+        np.testing.assert_equal( values['ell_edges'], [0, 4, 8, 13] )
+        np.testing.assert_equal( values['cl_dd_t'], np.ones((3, 3)) )
+
+        fields = [[n/n.mean() - 1, e1/n, e2/n] for n, e1, e2 in zip(self.nmap, self.e1map, self.e2map)]
+        cls = hp.anafast(fields[0], fields[1], pol=True, lmax=12)
+        np.testing.assert_allclose( values['cl_dm_d'][1], [cls[3][:4].mean(), cls[3][4:8].mean(), cls[3][8:].mean()] )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.theory')
+    def test_namaster_hashes_each_mask_once(self, mock_theory):
+        mock_theory.read_pk_grid.return_value = [None]*5
+        mock_theory.compute_theory_cls.return_value = {key: np.ones((3, 24)) for key in ('cl_dd_t', 'cl_dm_t', 'cl_mm_t', 'cl_md_t')}
+        mock_theory.TheoryCache.get_key.side_effect = theory.TheoryCache.get_key
+        nmt = MagicMock()
+        nmt.NmtWorkspace.return_value.decouple_cell.return_value = np.zeros((4, 24))
+
+        with patch.dict(sys.modules, {'pymaster': nmt}):
+            compute_data_CCL.compute_all_cls_namaster(None, nside=self.nside, zbins=[0, 1, 2], maps=self.maps)
+        hashed = [call_ for call_ in mock_theory.TheoryCache.get_key.call_args_list
+                  if any(np.size(value) >= 12*self.nside**2 for value in call_[1].values())]
+        self.assertEqual( len(hashed), 2 )
+        # One DD workspace shared by the bins, and one DM and MM workspace per bin
+        self.assertEqual( nmt.NmtWorkspace.return_value.compute_coupling_matrix.call_count, 5 )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.theory')
+    def test_fullsky_matches_harmonic_spectra(self, mock_theory):
+        mock_theory.read_pk_grid.return_value = [None]*5
+        mock_theory.compute_theory_cls.return_value = {key: np.ones((3, 24)) for key in ('cl_dd_t', 'cl_dm_t', 'cl_mm_t', 'cl_md_t')}
+
+        values = compute_data_CCL.compute_all_cls_fullsky(None, nside=self.nside, zbins=[0, 1, 2], maps=self.maps, threads=1)
+        self.assertEqual( values['pairs'], [(0, 0), (0, 1), (1, 1)] )
+        self.assertEqual( values['info']['threads'], {'theory': 1, 'spectra': 1} )
+        self.assertEqual( values['cl_dd_d'].shape, (3, 3*self.nside) )
+
+        fields = [[n/n.mean() - 1, e1/n, e2/n] for n, e1, e2 in zip(self.nmap, self.e1map, self.e2map)]
+        for i, (p1, p2) in enumerate(values['pairs']):
+            # anafast returns TT, EE, BB, TE, EB, TB
+            cls = hp.anafast(fields[p1], fields[p2], pol=True, iter=0)
+            np.testing.assert_allclose( values['cl_dd_d'][i], cls[0] )
+            np.testing.assert_allclose( values['cl_mm_d'][i], cls[1] )
+            np.testing.assert_allclose( values['cl_bb_d'][i], cls[2] )
+            np.testing.assert_allclose( values['cl_dm_d'][i], cls[3] )
+            np.testing.assert_allclose( values['cl_mb_d'][i], cls[4] )
+            np.testing.assert_allclose( values['cl_db_d'][i], cls[5] )
+            np.testing.assert_allclose( values['cl_md_d'][i], hp.anafast(fields[p2], fields[p1], pol=True, iter=0)[3] )
+
+    @patch('CoLoRe_analysis.compute_data_CCL.theory')
+    def test_fullsky_fails_with_empty_pixels(self, mock_theory):
+        self.maps[0][1, :10] = 0
+
+        with self.assertRaisesRegex(ValueError, 'Bin 1'):
+            compute_data_CCL.compute_all_cls_fullsky(None, nside=self.nside, zbins=[0, 1, 2], maps=self.maps)
+        mock_theory.compute_theory_cls.assert_not_called()
+
+    def test_normalize_maps(self):
+        nmap, e1map, e2map = self.nmap.copy(), self.e1map.copy(), self.e2map.copy()
+        nmap[0, :10] = 0
+        dmap, shotnoise = compute_data_CCL.normalize_maps(nmap, e1map, e2map)
+        np.testing.assert_allclose( dmap, nmap/nmap.mean(axis=1)[:, None] - 1 )
+        np.testing.assert_allclose( shotnoise, 4*np.pi/nmap.sum(axis=1) )
+        np.testing.assert_equal( e1map[0, :10], 0 )
+        np.testing.assert_allclose( e2map[1], self.e2map[1]/self.nmap[1] )
 
 class TestMainFunction(unittest.TestCase):
     empty_output = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/analysis/empty_ccl'
@@ -100,6 +565,19 @@ class TestMainFunction(unittest.TestCase):
         nz_min=0,
         nz_max=None,
         code='anafast',
+        n_workers=1,
+        chunk_rows=None,
+        max_pixel_nside=4096,
+        seed=None,
+        theory_ell_per_decade=None,
+        workspace_cache_dir=None,
+        threads=None,
+        lmax=None,
+        ell_edges=None,
+        output_format='dat',
+        map_storage='full',
+        resume=False,
+        checkpoint=False,
         log=None
     )
 
@@ -1,13 +1,100 @@
 import glob
 import os
 import sys
+import tempfile
 import unittest
 from shutil import rmtree
 from unittest import skipUnless
+from unittest.mock import patch
 
+import healpy as hp
 import numpy as np
 
-from CoLoRe_analysis import compute_data_shear
+from CoLoRe_analysis import compute_data_shear, output_backend
+from CoLoRe_analysis.catalog_reader import CatalogReader
+from CoLoRe_analysis.map_accumulator import MapAccumulator
+
+class TestSaveShearData(unittest.TestCase):
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        npix = hp.nside2npix(8)
+        self.nmap = rng.poisson(10, npix).astype(float) + 1
+        self.e1map = rng.normal(0, 0.1, npix) * self.nmap
+        self.e2map = rng.normal(0, 0.1, npix) * self.nmap
+        self.mp_k = rng.normal(0, 0.01, npix)
+
+    def tearDown(self):
+        rmtree(self.output_path)
+
+    def test_matches_anafast(self):
+        with patch('CoLoRe_analysis.compute_data_shear.hp.map2alm', wraps=hp.map2alm) as map2alm:
+            compute_data_shear.save_shear_data(None, self.nmap, self.e1map, self.e2map, self.output_path, do_cls=True, do_kappa=True, mp_k=self.mp_k)
+        self.assertEqual( map2alm.call_count, 2 )
+
+        mp_d = self.nmap / self.nmap.mean() - 1
+        maps = np.array([mp_d, self.e1map/self.nmap, self.e2map/self.nmap])
+        names = ['cld_dd', 'cld_ee', 'cld_bb', 'cld_de', 'cld_eb', 'cld_db']
+        for name, cl in zip(names, hp.anafast(maps, pol=True)):
+            np.testing.assert_allclose( np.loadtxt(self.output_path + f'/{ name }.dat'), cl, rtol=1e-12, atol=1e-30 )
+        np.testing.assert_allclose( np.loadtxt(self.output_path + '/cld_kk.dat'), hp.anafast(self.mp_k), rtol=1e-12, atol=1e-30 )
+        np.testing.assert_allclose( np.loadtxt(self.output_path + '/cld_kd.dat'), hp.anafast(self.mp_k, map2=mp_d), rtol=1e-12, atol=1e-30 )
+
+    def test_kappa_alms_reused(self):
+        alm_k = hp.map2alm(self.mp_k)
+        with patch('CoLoRe_analysis.compute_data_shear.hp.map2alm', wraps=hp.map2alm) as map2alm:
+            compute_data_shear.save_shear_data(None, self.nmap, self.e1map, self.e2map, self.output_path, do_cls=True, do_kappa=True, mp_k=self.mp_k, alm_k=alm_k)
+        self.assertEqual( map2alm.call_count, 1 )
+
+    def test_partial_maps(self):
+        # Only a few pixels are occupied
+        self.nmap[10:] = 0
+        compute_data_shear.save_shear_data(None, self.nmap, self.e1map, self.e2map, self.output_path, output_format='h5', map_storage='partial')
+        self.assertEqual( os.listdir(self.output_path), ['data.h5'] )
+
+        mp_e1 = output_backend.load_array(self.output_path, 'mp_e1')
+        self.assertEqual( mp_e1.dtype, np.float32 )
+        np.testing.assert_allclose( mp_e1[:10], self.e1map[:10]/self.nmap[:10], rtol=1e-6 )
+        np.testing.assert_equal( mp_e1[10:], 0 )
+        self.assertEqual( len(output_backend.load_array(self.output_path, 'mp_e1', dense=False)[0]), 10 )
+
+class TestComputeShearMaps(unittest.TestCase):
+    catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+
+    def setUp(self):
+        # Fake simulation with a file at z~1.905 and another at z~2.00
+        self.sim_path = tempfile.mkdtemp()
+        for i, filename in enumerate(('out_srcs_s1_0.fits', 'out_srcs_s2_0.fits')):
+            os.symlink(self.catalogs_path + '/' + filename, self.sim_path + f'/out_srcs_s1_{ i }.fits')
+        self.cache_dir = self.sim_path + '/analysis/catalog_cache'
+        self.z = CatalogReader.read_file(self.sim_path + '/out_srcs_s1_1.fits')['Z_COSMO']
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+
+    def read_files(self, **kwargs):
+        with patch('CoLoRe_analysis.compute_data_shear.CatalogReader.read_file_chunks', wraps=CatalogReader.read_file_chunks) as read_file_chunks:
+            maps = compute_data_shear.compute_shear_maps(self.sim_path, nside=8, cache_dir=self.cache_dir, **kwargs)
+        return maps, [call_[0][0] for call_ in read_file_chunks.call_args_list if call_[0][0].startswith(self.sim_path + '/out_srcs')]
+
+    def test_skips_files_out_of_bins(self):
+        (nmap, _, _), files = self.read_files(zbins=[2, 2.005])
+        self.assertEqual( np.sum(nmap), np.sum((self.z >= 2) & (self.z < 2.005)) )
+        self.assertEqual( os.listdir(self.cache_dir), ['index_s1.json'] )
+
+        # With the index stored, only the file with objects in the bins is read
+        _, files = self.read_files(zbins=[2, 2.005])
+        self.assertEqual( files, [self.sim_path + '/out_srcs_s1_1.fits'] )
+
+    def test_full_range_skips_files_per_bin(self):
+        self.read_files(zbins=[0, 1])
+        with patch('CoLoRe_analysis.compute_data_shear.MapAccumulator.add', autospec=True, side_effect=MapAccumulator.add) as add:
+            (nmap, _, _), files = self.read_files(zbins=[2, 2.005], full_range=True)
+        self.assertEqual( files, [self.sim_path + '/out_srcs_s1_0.fits', self.sim_path + '/out_srcs_s1_1.fits'] )
+        # The maps of the bins are not filled with the file out of them
+        self.assertEqual( [call_[0][0].zbins[0] for call_ in add.call_args_list], [0, 2, 0] )
+        self.assertEqual( np.sum(nmap[0]), np.sum((self.z >= 2) & (self.z < 2.005)) )
+        self.assertEqual( np.sum(nmap[-1]), 8408 + 6314 )
 
 @skipUnless('RUN_SHEAR_TESTS' in os.environ, 'Only run when activated in environment')
 class TestShearDataComputation(unittest.TestCase):
@@ -41,5 +128,16 @@ class TestShearDataComputation(unittest.TestCase):
 
         self.assertEqual(np.mean(a), -4.153934804547951e-11)
 
+    def test_compute_data_shear_binned(self):
+        compute_data_shear.compute_data_shear_binned(self.sim_path, [2, 2.005, 2.01], source=2, output_path=self.analysis_path + '/shear_data')
+        compute_data_shear.compute_data_shear(self.sim_path, source=2, minz=2.005, maxz=2.01, output_path=self.analysis_path + '/shear_data/single')
+
+        for path in ('/binned/200_200/source_2', '/binned/200_201/source_2', '/source_2'):
+            self.assertTrue( os.path.isfile(self.analysis_path + '/shear_data' + path + '/mp_E.dat'), path )
+
+        a = np.loadtxt(self.analysis_path + '/shear_data/binned/200_201/source_2/mp_e1.dat')
+        b = np.loadtxt(self.analysis_path + '/shear_data/single/mp_e1.dat')
+        np.testing.assert_equal(a, b)
+
 if __name__ == '__main__':
     unittest.main()
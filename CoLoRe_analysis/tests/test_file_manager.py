@@ -1,5 +1,8 @@
+import json
 import os
+import tempfile
 import unittest
+from shutil import rmtree
 
 from CoLoRe_analysis.file_manager import FileManager, FilterList
 
@@ -12,3 +15,17 @@ class TestFileManager(unittest.TestCase):
         filt = self.filters[3][1]
         result = FileManager.get_simulations(os.path.dirname(os.path.realpath(__file__)) + '/test_sims/analysis',param_filter=filt)
         self.assertIn( os.path.dirname(os.path.realpath(__file__)) + '/test_sims/analysis/0404', result )
+
+    def test_get_object_counts(self):
+        catalogs_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/0404'
+        sim_path = tempfile.mkdtemp()
+        os.symlink(catalogs_path + '/out_srcs_s2_0.fits', sim_path + '/out_srcs_s2_0.fits')
+        with open(sim_path + '/sim_info.json', 'w') as json_file:
+            json.dump({'path': sim_path}, json_file)
+
+        try:
+            self.assertEqual( FileManager.get_object_counts(sim_path, source=2), 6314 )
+            self.assertEqual( FileManager.get_object_counts(sim_path, source=2, minz=0, maxz=1), 0 )
+            self.assertTrue( os.path.isfile(sim_path + '/catalog_cache/index_s2.json') )
+        finally:
+            rmtree(sim_path)
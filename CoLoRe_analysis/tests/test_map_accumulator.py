@@ -0,0 +1,80 @@
+import unittest
+
+import healpy as hp
+import numpy as np
+
+from CoLoRe_analysis.map_accumulator import MapAccumulator, degrade_maps
+
+class TestMapAccumulator(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        size = 5000
+        self.ra = rng.uniform(0, 360, size).astype(np.float32)
+        self.dec = np.degrees(np.arcsin(rng.uniform(-1, 1, size))).astype(np.float32)
+        self.z = rng.uniform(-0.2, 1.2, size).astype(np.float32)
+        self.e1 = rng.normal(0, 0.1, size).astype(np.float32)
+        self.e2 = rng.normal(0, 0.1, size).astype(np.float32)
+
+        self.nside = 8
+        self.zbins = [0, 0.3, 0.6, 1]
+
+    def reference(self, mask):
+        npix = hp.nside2npix(self.nside)
+        nmap, e1map, e2map, nz = [], [], [], []
+        for minz, maxz in zip(self.zbins[:-1], self.zbins[1:]):
+            msk = (minz <= self.z) & (self.z < maxz) & mask
+            pix = hp.ang2pix(self.nside, np.radians(90-self.dec[msk]), np.radians(self.ra[msk]))
+            nmap.append(np.bincount(pix, minlength=npix))
+            e1map.append(np.bincount(pix, minlength=npix, weights=self.e1[msk]))
+            e2map.append(np.bincount(pix, minlength=npix, weights=self.e2[msk]))
+            nz.append(np.histogram(self.z[msk], bins=7, range=[0, 1])[0])
+        return nmap, e1map, e2map, nz
+
+    def test_add_matches_loop_over_bins(self):
+        accumulator = MapAccumulator(self.nside, self.zbins, nz_h=7)
+        accumulator.add(self.ra[:2000], self.dec[:2000], self.z[:2000], self.e1[:2000], self.e2[:2000])
+        accumulator.add(self.ra[2000:], self.dec[2000:], self.z[2000:], self.e1[2000:], self.e2[2000:])
+
+        nmap, e1map, e2map, nz = self.reference(np.full(len(self.z), True))
+        np.testing.assert_equal( accumulator.nmap, nmap )
+        np.testing.assert_allclose( accumulator.e1map, e1map, atol=1e-12 )
+        np.testing.assert_allclose( accumulator.e2map, e2map, atol=1e-12 )
+        np.testing.assert_equal( accumulator.nz, nz )
+
+    def test_add_with_mask(self):
+        mask = np.arange(len(self.z)) % 3 == 0
+        accumulator = MapAccumulator(self.nside, self.zbins, nz_h=7)
+        accumulator.add(self.ra, self.dec, self.z, self.e1, self.e2, mask=mask)
+
+        nmap, _, _, nz = self.reference(mask)
+        np.testing.assert_equal( accumulator.nmap, nmap )
+        np.testing.assert_equal( accumulator.nz, nz )
+
+    def test_without_nz(self):
+        accumulator = MapAccumulator(self.nside, self.zbins)
+        accumulator.add(self.ra, self.dec, self.z, self.e1, self.e2)
+        self.assertIsNone( accumulator.nz )
+        self.assertEqual( accumulator.nmap.sum(), np.sum((self.z >= 0) & (self.z < 1)) )
+
+    def test_nz_index_includes_last_edge(self):
+        accumulator = MapAccumulator(self.nside, self.zbins, nz_h=4, nz_min=0, nz_max=1)
+        z = np.array([-0.1, 0, 0.25, 0.99, 1, 1.1])
+        np.testing.assert_equal( accumulator.nz_index(z), [-1, 0, 1, 3, 3, -1] )
+
+    def test_degrade_maps(self):
+        high = MapAccumulator(32, self.zbins)
+        high.add(self.ra, self.dec, self.z, self.e1, self.e2)
+        low = MapAccumulator(self.nside, self.zbins)
+        low.add(self.ra, self.dec, self.z, self.e1, self.e2)
+
+        nmap, e1map, e2map = degrade_maps([high.nmap, high.e1map, high.e2map], self.nside)
+        np.testing.assert_equal( nmap, low.nmap )
+        np.testing.assert_allclose( e1map, low.e1map, atol=1e-12 )
+        np.testing.assert_allclose( e2map, low.e2map, atol=1e-12 )
+
+        np.testing.assert_equal( degrade_maps(high.nmap[0], 32), high.nmap[0] )
+        with self.assertRaises(ValueError):
+            degrade_maps(high.nmap, 64)
+
+if __name__ == '__main__':
+    unittest.main()
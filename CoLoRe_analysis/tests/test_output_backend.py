@@ -0,0 +1,151 @@
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from CoLoRe_analysis.output_backend import check_output_options, compact_map, get_array_path, load_array, load_info, save_array, save_info, save_map
+
+class TestOutputBackend(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.value = np.random.default_rng(0).normal(size=(3, 10))
+
+    def tearDown(self):
+        rmtree(self.location)
+
+    def test_dat(self):
+        save_array(self.location, 'cl', self.value)
+        self.assertTrue( os.path.isfile(self.location + '/cl.dat') )
+        np.testing.assert_equal( load_array(self.location, 'cl'), np.loadtxt(self.location + '/cl.dat') )
+
+    def test_npy(self):
+        save_array(self.location, 'cl', self.value, 'npy')
+        self.assertEqual( get_array_path(self.location, 'cl'), self.location + '/cl.npy' )
+        np.testing.assert_equal( load_array(self.location, 'cl'), self.value )
+
+    def test_npy32(self):
+        save_array(self.location, 'cl', self.value, 'npy32')
+        save_array(self.location, 'pairs', [(0, 0), (0, 1)], 'npy32')
+        self.assertEqual( load_array(self.location, 'cl').dtype, np.float32 )
+        np.testing.assert_allclose( load_array(self.location, 'cl'), self.value, rtol=1e-7 )
+        # Only the floats are saved in single precision
+        self.assertTrue( np.issubdtype(load_array(self.location, 'pairs').dtype, np.integer) )
+
+    def test_h5(self):
+        for output_format in ('h5', 'h5gz'):
+            save_array(self.location, 'cl', self.value, output_format)
+            save_array(self.location, 'ell', 3, output_format)
+            self.assertEqual( get_array_path(self.location, 'cl'), self.location + '/data.h5' )
+            np.testing.assert_equal( load_array(self.location, 'cl'), self.value )
+            self.assertEqual( load_array(self.location, 'ell'), 3 )
+
+        with h5py.File(self.location + '/data.h5', 'r') as h5file:
+            self.assertEqual( sorted(h5file.keys()), ['cl', 'ell'] )
+            self.assertIsNotNone( h5file['cl'].chunks )
+            self.assertEqual( h5file['cl'].compression, 'gzip' )
+
+    def test_h5_reads_only_requested_dataset(self):
+        save_array(self.location, 'cl', self.value, 'h5')
+        save_array(self.location, 'map', np.ones(10000), 'h5')
+        read = []
+        getitem = h5py.Dataset.__getitem__
+        def record(dataset, key):
+            read.append(dataset.name)
+            return getitem(dataset, key)
+
+        with mock.patch('h5py.Dataset.__getitem__', record):
+            load_array(self.location, 'cl')
+        self.assertEqual( read, ['/cl'] )
+
+    def test_info(self):
+        info = {'nside': 16, 'zbins': [0, 0.5], 'seed': None}
+        save_info(self.location, info)
+        self.assertEqual( load_info(self.location), info )
+
+        os.remove(self.location + '/INFO.json')
+        with self.assertRaises(FileNotFoundError):
+            load_info(self.location)
+
+        save_info(self.location, info, 'h5')
+        self.assertFalse( os.path.isfile(self.location + '/INFO.json') )
+        self.assertEqual( load_info(self.location), info )
+
+    def test_replaces_other_formats(self):
+        formats = ('npy', 'dat', 'h5', 'npy32', 'h5gz', 'dat')
+        for i, output_format in enumerate(formats):
+            save_array(self.location, 'cl', self.value + i, output_format)
+            np.testing.assert_allclose( load_array(self.location, 'cl'), self.value + i, rtol=1e-6 )
+        self.assertEqual( sorted(os.listdir(self.location)), ['cl.dat', 'data.h5'] )
+        with h5py.File(self.location + '/data.h5', 'r') as h5file:
+            self.assertNotIn( 'cl', h5file )
+
+        # Partial maps replace the dense ones and the other way round
+        value = np.zeros(768)
+        value[3] = 2
+        save_map(self.location, 'cl', value, 'npy', 'partial')
+        self.assertFalse( os.path.isfile(self.location + '/cl.dat') )
+        save_map(self.location, 'cl', value + 1, 'h5', 'partial')
+        self.assertFalse( os.path.isfile(self.location + '/cl.npz') )
+        np.testing.assert_equal( load_array(self.location, 'cl'), value + 1 )
+
+    def test_info_replaces_other_formats(self):
+        save_info(self.location, {'nside': 16})
+        save_info(self.location, {'nside': 32}, 'h5')
+        self.assertEqual( load_info(self.location), {'nside': 32} )
+        save_info(self.location, {'nside': 64})
+        self.assertEqual( load_info(self.location), {'nside': 64} )
+        with h5py.File(self.location + '/data.h5', 'r') as h5file:
+            self.assertEqual( len(h5file.attrs), 0 )
+
+    def test_compact_map(self):
+        self.assertEqual( compact_map(np.array([0., 3., 2.])).dtype, np.int32 )
+        self.assertEqual( compact_map(np.array([0., 2.**40])).dtype, np.int64 )
+        self.assertEqual( compact_map(self.value).dtype, np.float32 )
+
+    def test_partial_map(self):
+        # Low occupancy maps are saved as (index, value) pairs
+        value = np.zeros((2, 768))
+        value[1, [3, 500]] = [1.5, -2]
+        for output_format in ('npy', 'h5gz'):
+            location = self.location + f'/{ output_format }'
+            os.makedirs(location)
+            save_map(location, 'e1map', value, output_format, 'partial')
+            np.testing.assert_equal( load_array(location, 'e1map'), value )
+            index, values, shape = load_array(location, 'e1map', dense=False)
+            np.testing.assert_equal( index, [771, 1268] )
+            self.assertEqual( shape, (2, 768) )
+        self.assertTrue( os.path.isfile(self.location + '/npy/e1map.npz') )
+
+        # Full maps are saved dense
+        save_map(self.location + '/npy', 'e1map', self.value, 'npy', 'partial')
+        self.assertFalse( os.path.isfile(self.location + '/npy/e1map.npz') )
+        np.testing.assert_allclose( load_array(self.location + '/npy', 'e1map'), self.value, rtol=1e-7 )
+
+    def test_compact_nmap(self):
+        nmap = np.zeros(768)
+        nmap[:300] = 4
+        save_map(self.location, 'nmap', nmap, 'npy', 'compact')
+        self.assertEqual( load_array(self.location, 'nmap').dtype, np.int32 )
+        np.testing.assert_equal( load_array(self.location, 'nmap'), nmap )
+
+    def test_check_output_options(self):
+        check_output_options('h5', 'partial')
+        for output_format, map_storage in (('dat', 'compact'), ('txt', 'full'), ('npy', 'sparse')):
+            with self.assertRaises(ValueError):
+                check_output_options(output_format, map_storage)
+
+    def test_missing(self):
+        self.assertIsNone( get_array_path(self.location, 'cl') )
+        with self.assertRaises(FileNotFoundError):
+            load_array(self.location, 'cl')
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            save_array(self.location, 'cl', self.value, 'txt')
+
+if __name__ == '__main__':
+    unittest.main()
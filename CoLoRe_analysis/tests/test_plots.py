@@ -0,0 +1,45 @@
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+from CoLoRe_analysis.plots import CCLPlotter
+
+class TestCCLPlotter(unittest.TestCase):
+    def setUp(self):
+        self.pairs = np.array([(0, 0), (0, 1), (1, 1)])
+        rng = np.random.default_rng(0)
+        self.values = [rng.uniform(1, 2, size=(3, 24)) for _ in range(3)]
+
+    def test_one_bandpower_per_multipole(self):
+        plotter = CCLPlotter(self.values, ['dd', 'dm', 'mm'], self.pairs, nside=8)
+        np.testing.assert_equal( plotter.larr, np.arange(24) )
+        plotter.reshape(4)
+        np.testing.assert_equal( plotter.l, np.arange(24).reshape(-1, 4).mean(axis=1) )
+        np.testing.assert_allclose( plotter.get_values('d', 'd', 0, 1), self.values[0][1].reshape(-1, 4).mean(axis=1) )
+
+        plotter.compute_error_bars()
+        dd, mm, dm = plotter.get_raw_values('d', 'd', 0, 0), plotter.get_raw_values('m', 'm', 1, 1), plotter.get_raw_values('d', 'm', 0, 1)
+        np.testing.assert_allclose( plotter.get_raw_errors('d', 'm', 0, 1), np.sqrt((dd*mm + dm**2)/(2*np.arange(24)+1)) )
+
+    def test_bandpowers(self):
+        ell_edges = [2, 4, 8, 12, 20]
+        values = [value[:, :4] for value in self.values]
+        plotter = CCLPlotter(values, ['dd', 'dm', 'mm'], self.pairs, nside=8, ell_edges=ell_edges)
+        np.testing.assert_equal( plotter.larr, [2.5, 5.5, 9.5, 15.5] )
+
+        # The errors scale with the width of the bandpowers
+        plotter.compute_error_bars()
+        expected = np.sqrt(2*values[0][0]**2/(np.diff(ell_edges)*(2*plotter.larr+1)))
+        np.testing.assert_allclose( plotter.get_raw_errors('d', 'd', 0, 0), expected )
+
+        # Averages weighted by the width, the last bandpowers are dropped if they do not fill a group
+        plotter.reshape(3)
+        plotter.reshape_error_bars(3)
+        np.testing.assert_allclose( plotter.l, [(2*2.5 + 4*5.5 + 4*9.5)/10] )
+        np.testing.assert_allclose( plotter.get_values('m', 'm', 1, 1), [np.average(values[2][2, :3], weights=[2, 4, 4])] )
+        self.assertEqual( plotter.get_errors('d', 'd', 0, 0).shape, (1,) )
+
+if __name__ == '__main__':
+    unittest.main()
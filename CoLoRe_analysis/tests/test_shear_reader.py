@@ -8,7 +8,7 @@ from mock import call, patch
 
 from CoLoRe_analysis import shear_reader, compute_data_shear, shear_reader
 
-def mock_compute_data_shear(path, source=1, do_cls=False, do_kappa=False, minz=None, maxz=None, output_path=None):
+def mock_compute_data_shear(path, source=1, do_cls=False, do_kappa=False, minz=None, maxz=None, output_path=None, output_format='dat', map_storage='full', cache_dir=None):
     if not output_path:
         output_path = path + f'/shear_data/source_{ source }'
     os.makedirs(output_path, exist_ok=True)
@@ -18,17 +18,29 @@ def mock_compute_data_shear(path, source=1, do_cls=False, do_kappa=False, minz=N
 
     mp_e1 = [1,2,3]
     mp_E  = [21,22,23]
-    compute_data_shear.savetofile(output_path, [mp_e1,mp_E],['mp_e1','mp_E'])
+    compute_data_shear.savetofile(output_path, [mp_e1,mp_E],['mp_e1','mp_E'], output_format)
     if do_cls:
         cld_dd = [4,5,6]
-        compute_data_shear.savetofile(output_path, [cld_dd],['cld_dd'])
+        compute_data_shear.savetofile(output_path, [cld_dd],['cld_dd'], output_format)
     
     if do_kappa:
         mp_k   = [7,8,9]
         if do_cls:
             cld_kk = [10,11,12]
-            compute_data_shear.savetofile(output_path, [cld_kk],['cld_kk'])
-        compute_data_shear.savetofile(output_path, [mp_k],["mp_k"])
+            compute_data_shear.savetofile(output_path, [cld_kk],['cld_kk'], output_format)
+        compute_data_shear.savetofile(output_path, [mp_k],["mp_k"], output_format)
+
+def mock_compute_data_shear_binned(path, zbins, source=1, do_cls=False, do_kappa=False, full_range=True, output_path=None, output_format='dat', map_storage='full', cache_dir=None):
+    if not output_path:
+        output_path = path + '/shear_data'
+
+    for minz, maxz in zip(zbins[:-1], zbins[1:]):
+        minz_str = shear_reader.redshift_to_str_for_path(minz)
+        maxz_str = shear_reader.redshift_to_str_for_path(maxz)
+        mock_compute_data_shear(path, source, do_cls, do_kappa, minz, maxz, output_path + f'/binned/{ minz_str }_{ maxz_str }/source_{ source }', output_format)
+
+    if full_range:
+        mock_compute_data_shear(path, source, do_cls, do_kappa, output_path=output_path + f'/source_{ source }', output_format=output_format)
 
 class TestShearReader(unittest.TestCase):
     def setUp(self):
@@ -37,10 +49,23 @@ class TestShearReader(unittest.TestCase):
         self.sr = shear_reader.ShearReader( self.sim_path , self.analysis_path)
 
     def tearDown(self):
-        shear_data_path = self.sim_path + '/shear_data'
-        if os.path.isdir(shear_data_path):
-            rmtree(self.sim_path + '/shear_data')
+        for location in self.sim_path, self.analysis_path:
+            shear_data_path = location + '/shear_data'
+            if os.path.isdir(shear_data_path):
+                rmtree(shear_data_path)
     
+    @patch('CoLoRe_analysis.shear_reader.compute_data_shear',side_effect=mock_compute_data_shear)
+    def test_creation_with_npy_output(self, mock_func):
+        a = self.sr.get_values('mp_E', source=1, compute=True, output_format='npy')
+        self.assertTrue( os.path.isfile(self.analysis_path + '/shear_data/source_1/mp_E.npy') )
+        self.assertFalse( os.path.isfile(self.analysis_path + '/shear_data/source_1/mp_E.dat') )
+        np.testing.assert_equal( a, [21,22,23] )
+
+        # Already computed, the binary file is read without computing again
+        mock_func.reset_mock()
+        np.testing.assert_equal( self.sr.get_values('mp_e1', source=1, compute=True), [1,2,3] )
+        mock_func.assert_not_called()
+
     @patch('CoLoRe_analysis.shear_reader.compute_data_shear',side_effect=mock_compute_data_shear)
     def test_creation_when_does_not_exist(self, mock_func):
         a = self.sr.get_values('mp_E', source=1, compute=True)
@@ -105,9 +130,10 @@ class TestShearReader(unittest.TestCase):
         mock_func.assert_not_called()
         self.assertEqual(vals,3141592653)
 
-    @patch('CoLoRe_analysis.shear_reader.compute_data_shear',side_effect=mock_compute_data_shear)
+    @patch('CoLoRe_analysis.shear_reader.compute_data_shear_binned',side_effect=mock_compute_data_shear_binned)
     def test_binned_statistics(self, mock_func):
         self.sr.compute_binned_statistics(1,1.1,2)
+        mock_func.assert_called_once()
 
         path_head   = self.analysis_path + f'/shear_data/binned/'
         path_tail    = '/source_1/mp_E.dat'
@@ -116,6 +142,27 @@ class TestShearReader(unittest.TestCase):
         for str in '100_105','105_110':
             self.assertEqual( vals[0], 1)
             self.assertTrue( os.path.isfile(path_head + str + path_tail), path_head+str+path_tail)
+        self.assertFalse( os.path.isdir(self.analysis_path + '/shear_data/source_1') )
+
+    @patch('CoLoRe_analysis.shear_reader.compute_data_shear_binned',side_effect=mock_compute_data_shear_binned)
+    def test_binned_statistics_not_computed_when_exists(self, mock_func):
+        self.sr.compute_binned_statistics(1,1.1,2)
+        self.sr.compute_binned_statistics(1,1.1,2)
+        mock_func.assert_called_once()
+
+        self.sr.compute_binned_statistics(1,1.1,2, full_range=True)
+        self.assertEqual(mock_func.call_count, 2)
+        self.assertTrue( os.path.isfile(self.analysis_path + '/shear_data/source_1/mp_E.dat') )
+
+    @patch('CoLoRe_analysis.shear_reader.compute_data_shear_binned',side_effect=mock_compute_data_shear_binned)
+    def test_binned_statistics_h5(self, mock_func):
+        self.sr.compute_binned_statistics(1,1.1,2, output_format='h5')
+        self.sr.compute_binned_statistics(1,1.1,2)
+        mock_func.assert_called_once()
+
+        path = self.analysis_path + '/shear_data/binned/105_110/source_1'
+        self.assertEqual( os.listdir(path), ['data.h5'] )
+        np.testing.assert_equal( self.sr.get_values('mp_E', source=1, minz=1.05, maxz=1.1), [21,22,23] )
 
     @patch('builtins.input', return_value='y')
     @patch('builtins.print')
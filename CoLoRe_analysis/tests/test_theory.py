@@ -0,0 +1,182 @@
+import os
+import tempfile
+import unittest
+from shutil import copyfile, rmtree
+from unittest import mock
+
+import numpy as np
+
+from CoLoRe_analysis import theory
+
+class TestReadPkGrid(unittest.TestCase):
+    pk_path = os.path.dirname(os.path.realpath(__file__)) + '/test_sims/sims/New_CCL'
+
+    def setUp(self):
+        self.sim_path = tempfile.mkdtemp()
+        self.cache_dir = self.sim_path + '/theory_cache'
+        for z in ('0.000', '0.100', '0.200', '0.300'):
+            copyfile(self.pk_path + f'/out_pk_srcs_pop0_z{ z }.txt', self.sim_path + f'/out_pk_srcs_pop0_z{ z }.txt')
+
+    def tearDown(self):
+        rmtree(self.sim_path)
+
+    def test_get_pk_files(self):
+        zs, files = theory.get_pk_files(self.sim_path)
+        self.assertEqual( zs, [0, 0.1, 0.2, 0.3] )
+        self.assertEqual( files[1], self.sim_path + '/out_pk_srcs_pop0_z0.100.txt' )
+        self.assertEqual( theory.get_pk_files(self.sim_path, pop=1), ([], []) )
+
+    def test_read_pk_grid(self):
+        zs, ks, pks_dd, pks_dm, pks_mm = theory.read_pk_grid(self.sim_path)
+        np.testing.assert_equal( zs, [0, 0.1, 0.2, 0.3] )
+        self.assertEqual( pks_dd.shape, (4, len(ks)) )
+
+        k, pdd, pdm, pmm = np.loadtxt(self.sim_path + '/out_pk_srcs_pop0_z0.200.txt', unpack=True)
+        pdd[pmm<1E-30] = 0
+        np.testing.assert_equal( ks, k )
+        np.testing.assert_equal( pks_dd[2], pdd )
+        np.testing.assert_equal( pks_mm[2], pmm )
+
+        parallel = theory.read_pk_grid(self.sim_path, n_workers=2)
+        for a, b in zip((zs, ks, pks_dd, pks_dm, pks_mm), parallel):
+            np.testing.assert_equal(a, b)
+
+    def test_cache(self):
+        values = theory.read_pk_grid(self.sim_path, self.cache_dir)
+        self.assertTrue( os.path.isfile(self.cache_dir + '/pk_grid_pop0.npz') )
+
+        with mock.patch('CoLoRe_analysis.theory.read_pk_file') as read_pk_file:
+            cached = theory.read_pk_grid(self.sim_path, self.cache_dir)
+        read_pk_file.assert_not_called()
+        for a, b in zip(values, cached):
+            np.testing.assert_equal(a, b)
+
+        # A new file invalidates the cache
+        copyfile(self.pk_path + '/out_pk_srcs_pop0_z0.400.txt', self.sim_path + '/out_pk_srcs_pop0_z0.400.txt')
+        zs, *_ = theory.read_pk_grid(self.sim_path, self.cache_dir)
+        np.testing.assert_equal( zs, [0, 0.1, 0.2, 0.3, 0.4] )
+
+    def test_raise_without_files(self):
+        with self.assertRaises(FileNotFoundError):
+            theory.read_pk_grid(self.cache_dir)
+
+class TestTheoryCache(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.cache = theory.TheoryCache(self.location)
+
+    def tearDown(self):
+        rmtree(self.location)
+
+    def test_key(self):
+        key = self.cache.get_key(larr=np.arange(10), pairs=[[0, 0]])
+        self.assertEqual( key, self.cache.get_key(pairs=[[0, 0]], larr=np.arange(10)) )
+        self.assertNotEqual( key, self.cache.get_key(larr=np.arange(11), pairs=[[0, 0]]) )
+        self.assertNotEqual( key, self.cache.get_key(larr=np.arange(10, dtype=np.float64), pairs=[[0, 0]]) )
+        self.assertNotEqual( key, self.cache.get_key(larr=np.arange(10), pairs=[[0, 1]]) )
+
+    def test_put_and_get(self):
+        self.assertIsNone( self.cache.get('missing') )
+        self.cache.put('key', {'cl_dd_t': np.ones((3, 4))})
+        np.testing.assert_equal( self.cache.get('key')['cl_dd_t'], np.ones((3, 4)) )
+
+    def test_eviction(self):
+        self.cache.put('first', {'cl': np.zeros(100)})
+        self.cache.max_bytes = 2*os.path.getsize(self.cache.get_path('first'))
+        os.utime(self.cache.get_path('first'), ns=(0, 10**9))
+        self.cache.put('second', {'cl': np.zeros(100)})
+        os.utime(self.cache.get_path('second'), ns=(0, 2*10**9))
+
+        # Reading the first entry makes it the most recently used one
+        self.cache.get('first')
+        self.cache.put('third', {'cl': np.zeros(100)})
+        self.assertIsNotNone( self.cache.get('first') )
+        self.assertIsNone( self.cache.get('second') )
+        self.assertIsNotNone( self.cache.get('third') )
+
+class TestComputeTheoryCls(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.zs = np.array([0, 0.5, 1])
+        self.ks = np.logspace(-3, 1, 5)
+        self.pks = [np.ones((3, 5)), 2*np.ones((3, 5)), 3*np.ones((3, 5))]
+        self.z_nz = np.linspace(0, 1, 10)
+        self.nz_tot = np.ones((2, 10))
+        self.larr = np.arange(12)
+        self.pairs = [(0, 0), (0, 1), (1, 1)]
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def compute(self, **kwargs):
+        with mock.patch('CoLoRe_analysis.theory.ccl') as ccl:
+            ccl.angular_cl.side_effect = lambda cosmo, tr1, tr2, larr, p_of_k_a: np.full(len(larr), 1.)
+            values = theory.compute_theory_cls(self.zs, self.ks, *self.pks, self.nz_tot, self.z_nz, self.larr, self.pairs, cache_dir=self.cache_dir, **kwargs)
+        return ccl, values
+
+    def test_cached(self):
+        ccl, values = self.compute()
+        # 3 dd, 3 mm and 4 dm combinations
+        self.assertEqual( ccl.angular_cl.call_count, 10 )
+        self.assertEqual( values['cl_md_t'].shape, (3, 12) )
+
+        ccl, cached = self.compute()
+        ccl.angular_cl.assert_not_called()
+        for key in ('cl_dd_t', 'cl_dm_t', 'cl_mm_t', 'cl_md_t'):
+            np.testing.assert_equal( cached[key], values[key] )
+
+        # Any change in the inputs needs a new computation
+        ccl, _ = self.compute(h=0.67)
+        ccl.angular_cl.assert_called()
+        self.nz_tot[1, 0] = 2
+        ccl, _ = self.compute()
+        ccl.angular_cl.assert_called()
+
+    def test_orderings(self):
+        # Each tracer is identified by its kind and bin, and each spectrum by its tracers
+        self.nz_tot = np.array([np.full(10, 1.), np.full(10, 2.)])
+        with mock.patch('CoLoRe_analysis.theory.ccl') as ccl:
+            ccl.NumberCountsTracer.side_effect = lambda cosmo, has_rsd, dndz, bias: 10*dndz[1][0]
+            ccl.WeakLensingTracer.side_effect = lambda cosmo, dndz: dndz[1][0]
+            ccl.angular_cl.side_effect = lambda cosmo, tr1, tr2, larr, p_of_k_a: np.full(len(larr), 100*tr1 + tr2)
+            values = theory.compute_theory_cls(self.zs, self.ks, *self.pks, self.nz_tot, self.z_nz, self.larr, self.pairs)
+
+        np.testing.assert_equal( values['cl_dd_t'][:, 0], [1010, 1020, 2020] )
+        np.testing.assert_equal( values['cl_dm_t'][:, 0], [1001, 1002, 2002] )
+        np.testing.assert_equal( values['cl_md_t'][:, 0], [1001, 2001, 2002] )
+        np.testing.assert_equal( values['cl_mm_t'][:, 0], [101, 102, 202] )
+
+    def test_sparse_ells(self):
+        ells = theory.get_sparse_ells(np.arange(6144), 20)
+        self.assertEqual( (ells[0], ells[-1]), (0, 6143) )
+        self.assertLess( len(ells), 100 )
+        np.testing.assert_equal( theory.get_sparse_ells(np.arange(12), 20), np.arange(12) )
+
+        check_ells = theory.get_check_ells(ells)
+        self.assertEqual( len(check_ells), 5 )
+        self.assertEqual( len(np.intersect1d(check_ells, ells)), 0 )
+        self.assertEqual( len(theory.get_check_ells(np.arange(12))), 0 )
+
+    def test_interpolated(self):
+        self.larr = np.arange(3000)
+        smooth = lambda larr: 1e-5 / (1 + larr/50.)**1.3
+        with mock.patch('CoLoRe_analysis.theory.ccl') as ccl:
+            ccl.angular_cl.side_effect = lambda cosmo, tr1, tr2, larr, p_of_k_a: smooth(larr)
+            values = theory.compute_theory_cls(self.zs, self.ks, *self.pks, self.nz_tot, self.z_nz, self.larr, self.pairs, ell_per_decade=20)
+
+        computed_ells = ccl.angular_cl.call_args_list[0][0][3]
+        self.assertLess( len(computed_ells), 100 )
+        self.assertEqual( values['cl_dd_t'].shape, (3, 3000) )
+        np.testing.assert_allclose( values['cl_dd_t'][0], smooth(self.larr), rtol=1e-3 )
+        self.assertLess( values['max_rel_error'], 1e-3 )
+        self.assertGreater( values['max_rel_error'], 0 )
+
+    def test_ccl_inputs(self):
+        ccl, _ = self.compute()
+        _, kwargs = ccl.Pk2D.call_args_list[2]
+        np.testing.assert_allclose( kwargs['a_arr'], 1/(1+self.zs[::-1]) )
+        np.testing.assert_allclose( kwargs['lk_arr'], np.log(self.ks*0.7) )
+        np.testing.assert_allclose( kwargs['pk_arr'], 3/0.7**3 )
+
+if __name__ == '__main__':
+    unittest.main()
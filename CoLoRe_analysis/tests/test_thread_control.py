@@ -0,0 +1,28 @@
+import unittest
+from unittest import mock
+
+from CoLoRe_analysis import thread_control
+
+class TestLimitThreads(unittest.TestCase):
+    def test_record(self):
+        record = {}
+        with thread_control.limit_threads(1, 'spectra', record):
+            self.assertEqual( thread_control.get_num_threads(), 1 )
+        self.assertEqual( record, {'spectra': 1} )
+
+        with thread_control.limit_threads(None, 'theory', record):
+            pass
+        self.assertEqual( record['theory'], thread_control.get_num_threads() )
+
+    def test_limits_passed_to_threadpoolctl(self):
+        with mock.patch('CoLoRe_analysis.thread_control.threadpool_limits') as threadpool_limits:
+            with thread_control.limit_threads(3):
+                pass
+        threadpool_limits.assert_called_once_with(limits=3)
+
+    def test_without_libraries(self):
+        with mock.patch('CoLoRe_analysis.thread_control.threadpool_info', return_value=[]):
+            self.assertEqual( thread_control.get_num_threads(), 1 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,338 @@
+'''
+    Module built to handle the theoretical predictions used in the CCL analysis.
+
+    The P(k) predictions written by CoLoRe (out_pk_srcs_pop0_z*.txt) are read into a single (z, k) grid that can be cached as a .npz file.
+
+    The angular power spectra computed with CCL are cached on disk (TheoryCache) by a hash of all their inputs.
+'''
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+from multiprocessing import Pool
+
+import numpy as np
+import pyccl as ccl
+from scipy.interpolate import CubicSpline
+
+log = logging.getLogger(__name__)
+
+def get_pk_files(sim_path, pop=0):
+    '''Get the P(k) files of a simulation sorted by redshift
+
+    Args:
+        sim_path (str): Path where the CoLoRe simulation is located.
+        pop (int, optional): Population of the P(k) files (default: 0)
+
+    Returns:
+        Tuple (zs, files) with the redshift of each file (as given in the file name) and the paths to the files.
+    '''
+    files = []
+    for filename in glob.glob(sim_path + f'/out_pk_srcs_pop{ pop }_z*.txt'):
+        match = re.search(r'_z(\d+\.\d+)\.txt$', filename)
+        if match:
+            files.append((float(match.group(1)), filename))
+    files.sort()
+    return [z for z, _ in files], [filename for _, filename in files]
+
+def read_pk_file(filename):
+    '''Read a P(k) file
+
+    Args:
+        filename (str): Path to the file.
+
+    Returns:
+        Array with shape (4, nk) with the columns k, pdd, pdm, pmm.
+    '''
+    return np.loadtxt(filename, unpack=True)
+
+def read_pk_grid(sim_path, cache_dir=None, n_workers=1, pop=0):
+    '''Read the P(k) predictions of a simulation into a grid
+
+    Args:
+        sim_path (str): Path where the CoLoRe simulation is located.
+        cache_dir (str, optional): Folder for the cached grid ({ cache_dir }/pk_grid_pop{ pop }.npz). It is used if it was built from the same files (same names and modification times) (default: None, do not cache the grid)
+        n_workers (int, optional): Number of processes reading the files (default: 1)
+        pop (int, optional): Population of the P(k) files (default: 0)
+
+    Returns:
+        Tuple (zs, ks, pks_dd, pks_dm, pks_mm) with zs in increasing order and pks with shape (nz, nk) (in h units, as given by CoLoRe). pks_dd is set to zero where pks_mm < 1E-30.
+    '''
+    zs, files = get_pk_files(sim_path, pop)
+    if len(files) == 0:
+        raise FileNotFoundError(f'No P(k) files found in { sim_path }')
+
+    key = json.dumps([(os.path.basename(filename), os.stat(filename).st_mtime_ns) for filename in files])
+    cache_file = cache_dir + f'/pk_grid_pop{ pop }.npz' if cache_dir is not None else None
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        with np.load(cache_file) as cache:
+            if str(cache['key']) == key:
+                log.debug(f'Reading P(k) grid from { cache_file }')
+                return cache['zs'], cache['ks'], cache['pks_dd'], cache['pks_dm'], cache['pks_mm']
+
+    log.info(f'Reading { len(files) } P(k) files')
+    if n_workers == 1:
+        values = [read_pk_file(filename) for filename in files]
+    else:
+        with Pool(processes=n_workers) as pool:
+            values = pool.map(read_pk_file, files)
+
+    ks = values[0][0]
+    for filename, (k, _, _, _) in zip(files, values):
+        if not np.array_equal(k, ks):
+            raise ValueError(f'P(k) file { filename } does not use the same k values as { files[0] }')
+
+    zs = np.array(zs)
+    pks_dd, pks_dm, pks_mm = [np.array([value[i] for value in values]) for i in (1, 2, 3)]
+    # The delta-delta prediction involves some Fourier transforms that make it unstable
+    # at high-k, so we just set it to zero.
+    pks_dd[pks_mm < 1E-30] = 0
+
+    if cache_file is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + f'.{ os.getpid() }.tmp.npz'
+            np.savez(tmp_file, key=key, zs=zs, ks=ks, pks_dd=pks_dd, pks_dm=pks_dm, pks_mm=pks_mm)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            log.warning(f'P(k) grid could not be cached in { cache_dir }')
+
+    return zs, ks, pks_dd, pks_dm, pks_mm
+
+class TheoryCache:
+    '''Class made to cache the theoretical angular power spectra on disk.
+
+    Each entry is a .npz file named by a hash of all the inputs of the computation. When the size of the cache exceeds max_bytes, the least recently used entries are removed.
+    '''
+
+    def __init__(self, location, max_bytes=2**30):
+        '''Inits the cache
+
+        Args:
+            location (str): Folder of the cache
+            max_bytes (int, optional): Maximum size of the cache in bytes (default: 2**30)
+        '''
+        self.location = location
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def get_key(**inputs):
+        '''Get the key of a set of inputs
+
+        Args:
+            **inputs: Arrays and json serializable values used in the computation
+
+        Returns:
+            Hexadecimal sha256 hash of the inputs.
+        '''
+        sha = hashlib.sha256()
+        for name in sorted(inputs):
+            value = inputs[name]
+            sha.update(name.encode())
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(value)
+                sha.update(f'{ value.dtype.str }{ value.shape }'.encode())
+                sha.update(value.tobytes())
+            else:
+                sha.update(json.dumps(value, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def get_path(self, key):
+        return self.location + f'/{ key }.npz'
+
+    def get(self, key):
+        '''Get an entry of the cache
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            Dict with the cached arrays (None if the entry is not in the cache).
+        '''
+        path = self.get_path(key)
+        try:
+            with np.load(path) as data:
+                values = {name: data[name] for name in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        # The modification time is used to find the least recently used entries
+        os.utime(path)
+        return values
+
+    def put(self, key, values):
+        '''Add an entry to the cache (and remove old entries if the cache is too large)
+
+        Args:
+            key (str): Key of the entry
+            values (dict): Arrays to store
+        '''
+        try:
+            os.makedirs(self.location, exist_ok=True)
+            tmp_path = self.get_path(key) + f'.{ os.getpid() }.tmp.npz'
+            np.savez(tmp_path, **values)
+            os.replace(tmp_path, self.get_path(key))
+        except OSError:
+            log.warning(f'Theory values could not be cached in { self.location }')
+            return
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is smaller than max_bytes'''
+        entries = []
+        for entry in os.scandir(self.location):
+            if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            log.debug(f'Removing theory cache entry { path }')
+            os.remove(path)
+            total -= size
+
+def get_sparse_ells(larr, ell_per_decade):
+    '''Get a log-spaced subset of the multipoles
+
+    Args:
+        larr (array of int): Multipoles
+        ell_per_decade (int): Number of multipoles per decade
+
+    Returns:
+        Sorted array of unique multipoles (it always includes the first and the last ones).
+    '''
+    larr = np.asarray(larr)
+    lmin = max(larr[0], 1)
+    npoints = max(int(np.ceil(ell_per_decade * np.log10(larr[-1] / lmin))) + 1, 2)
+    ells = np.round(np.geomspace(lmin, larr[-1], npoints)).astype(larr.dtype)
+    return np.unique(np.concatenate([larr[:1], ells]))
+
+def get_check_ells(ells, n=5):
+    '''Get multipoles in the middle of gaps of a sparse grid (spread over the whole range), used to check the interpolation
+
+    Args:
+        ells (array of int): Sparse grid of multipoles
+        n (int, optional): Number of multipoles (default: 5)
+
+    Returns:
+        Sorted array of multipoles not included in ells (it can have less than n values).
+    '''
+    gaps = np.diff(ells)
+    candidates = np.flatnonzero(gaps > 1)
+    if len(candidates) == 0:
+        return np.array([], dtype=ells.dtype)
+    selected = np.unique(candidates[np.round(np.linspace(0, len(candidates)-1, n)).astype(int)])
+    return ells[selected] + gaps[selected] // 2
+
+def interpolate_cls(ells, cls, larr):
+    '''Interpolate power spectra computed at a sparse grid of multipoles with a cubic spline in log(1 + ell)
+
+    Args:
+        ells (array): Sparse grid of multipoles
+        cls (array): Power spectra at ells, with shape (..., len(ells))
+        larr (array): Multipoles where the power spectra are needed
+
+    Returns:
+        Array with shape (..., len(larr)).
+    '''
+    return CubicSpline(np.log1p(ells), cls, axis=-1)(np.log1p(larr))
+
+def compute_theory_cls(zs, ks, pks_dd, pks_dm, pks_mm, nz_tot, z_nz, larr, pairs, h=0.7, cache_dir=None, ell_per_decade=None):
+    '''Compute the theoretical angular power spectra with CCL
+
+    The spectra are computed one after the other: CCL does not release the GIL, so it is parallelized with its own OpenMP threads (see thread_control.limit_threads).
+
+    Args:
+        zs, ks, pks_dd, pks_dm, pks_mm (arrays): P(k) grid as given by read_pk_grid
+        nz_tot (array): N(z) of each bin, shape (nbins, nz_h)
+        z_nz (array): Redshift of the N(z) values
+        larr (array): Multipoles
+        pairs (list of tuples): Pairs of bins
+        h (float, optional): Hubble constant (default: 0.7)
+        cache_dir (str, optional): Folder of the TheoryCache (default: None, do not cache the values)
+        ell_per_decade (int, optional): Compute the power spectra only at this number of log-spaced multipoles per decade and interpolate them to larr (default: None, compute all the multipoles)
+
+    Returns:
+        Dict with the arrays cl_dd_t, cl_dm_t, cl_mm_t and cl_md_t (one row per pair). If ell_per_decade is given, it also includes max_rel_error: maximum relative error of the interpolation measured at a few multipoles (computed without interpolation).
+    '''
+    cosmo_params = dict(Omega_c=0.25, Omega_b=0.05, h=h, n_s=0.96, sigma8=0.8)
+
+    if cache_dir is not None:
+        cache = TheoryCache(cache_dir)
+        key = cache.get_key(cosmo_params=cosmo_params, zs=np.asarray(zs), ks=np.asarray(ks), pks_dd=pks_dd, pks_dm=pks_dm, pks_mm=pks_mm,
+                            nz_tot=np.asarray(nz_tot), z_nz=np.asarray(z_nz), larr=np.asarray(larr), pairs=[list(pair) for pair in pairs], ell_per_decade=ell_per_decade)
+        values = cache.get(key)
+        if values is not None:
+            log.info('Theory values read from cache')
+            return values
+
+    nbins = len(nz_tot)
+    # Reverse order (because CCL needs increasing scale factor - not redshift).
+    # Also, CCL uses non-h units.
+    a_arr = 1./(1+np.asarray(zs)[::-1])
+    lk_arr = np.log(np.asarray(ks) * h)
+
+    # Create CCL P(k) structures
+    cosmo = ccl.Cosmology(**cosmo_params)
+    pk2d_dd, pk2d_dm, pk2d_mm = [ccl.Pk2D(a_arr=a_arr, lk_arr=lk_arr, pk_arr=pks[::-1, :] / h**3,
+                                    is_logp=False, extrap_order_hik=0, extrap_order_lok=0)
+                                 for pks in (pks_dd, pks_dm, pks_mm)]
+
+    # Create a number counts and a weak lensing tracer for each of the bins
+    tr_d = [ccl.NumberCountsTracer(cosmo, False, (z_nz, nz_tot[i]), bias=(z_nz, np.ones_like(z_nz)))
+            for i in range(nbins)]
+    tr_l = [ccl.WeakLensingTracer(cosmo, (z_nz, nz_tot[i])) for i in range(nbins)]
+
+    # Each tracer combination is computed once: dd and mm are symmetric and
+    # cl_md_t uses the same number counts x lensing integrals as cl_dm_t
+    combinations = sorted({('dd',) + tuple(sorted(pair)) for pair in pairs} |
+                          {('mm',) + tuple(sorted(pair)) for pair in pairs} |
+                          {('dm', p1, p2) for p1, p2 in pairs} | {('dm', p2, p1) for p1, p2 in pairs})
+    tracers = {'dd': (tr_d, tr_d, pk2d_dd), 'dm': (tr_d, tr_l, pk2d_dm), 'mm': (tr_l, tr_l, pk2d_mm)}
+
+    ells = larr if ell_per_decade is None else get_sparse_ells(larr, ell_per_decade)
+    check_ells = None if ell_per_decade is None else get_check_ells(ells)
+
+    def angular_cl(combination):
+        kind, i, j = combination
+        tr_1, tr_2, pk2d = tracers[kind]
+        cl = ccl.angular_cl(cosmo, tr_1[i], tr_2[j], ells, p_of_k_a=pk2d)
+        if check_ells is None or len(check_ells) == 0:
+            return cl, np.zeros(0)
+        return cl, ccl.angular_cl(cosmo, tr_1[i], tr_2[j], check_ells, p_of_k_a=pk2d)
+
+    log.debug(f'Computing { len(combinations) } angular power spectra at { len(ells) } multipoles')
+    results = [angular_cl(combination) for combination in combinations]
+
+    if check_ells is None:
+        matrix = {combination: cl for combination, (cl, _) in zip(combinations, results)}
+        max_rel_error = None
+    else:
+        cls = interpolate_cls(ells, np.array([cl for cl, _ in results]), larr)
+        matrix = dict(zip(combinations, cls))
+
+        # Accuracy of the interpolation at multipoles out of the sparse grid
+        exact = np.array([check for _, check in results])
+        interpolated = interpolate_cls(ells, np.array([cl for cl, _ in results]), check_ells)
+        nonzero = exact != 0
+        max_rel_error = np.max(np.abs(interpolated[nonzero]/exact[nonzero] - 1), initial=0)
+        log.info(f'Theory computed at { len(ells) } multipoles. Max relative error of the interpolation: { max_rel_error }')
+
+    values = {
+        'cl_dd_t': np.array([matrix[('dd',) + tuple(sorted((p1, p2)))] for p1, p2 in pairs]),
+        'cl_dm_t': np.array([matrix[('dm', p1, p2)] for p1, p2 in pairs]),
+        'cl_mm_t': np.array([matrix[('mm',) + tuple(sorted((p1, p2)))] for p1, p2 in pairs]),
+        'cl_md_t': np.array([matrix[('dm', p2, p1)] for p1, p2 in pairs])
+    }
+    if max_rel_error is not None:
+        values['max_rel_error'] = np.array(max_rel_error)
+
+    if cache_dir is not None:
+        cache.put(key, values)
+    return values
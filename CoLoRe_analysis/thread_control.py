@@ -0,0 +1,36 @@
+'''
+    Module built to control the number of threads used by the compiled libraries (OpenMP in healpy, NaMaster and CCL, and BLAS) in each stage of the computations.
+
+    The limits are set with threadpoolctl, so they only apply to the libraries already loaded when a stage starts.
+'''
+
+import logging
+from contextlib import contextmanager
+
+from threadpoolctl import threadpool_info, threadpool_limits
+
+log = logging.getLogger(__name__)
+
+def get_num_threads():
+    '''Get the number of threads used by the OpenMP and BLAS libraries currently loaded
+
+    Returns:
+        Maximum number of threads of the libraries (1 if none of them is loaded).
+    '''
+    return max([pool['num_threads'] for pool in threadpool_info()], default=1)
+
+@contextmanager
+def limit_threads(threads=None, stage=None, record=None):
+    '''Context to limit the number of threads of the OpenMP and BLAS libraries
+
+    Args:
+        threads (int, optional): Number of threads (default: None, use the library defaults)
+        stage (str, optional): Name of the stage, used as key in record (default: None)
+        record (dict, optional): If given, the number of threads used in the stage is saved in record[stage] (default: None)
+    '''
+    with threadpool_limits(limits=threads):
+        num_threads = get_num_threads()
+        log.debug(f'Running stage { stage } with { num_threads } threads')
+        if record is not None:
+            record[stage] = num_threads
+        yield
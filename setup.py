@@ -21,6 +21,7 @@ setuptools.setup(
     python_requires='>=3.7',
     entry_points={
         'console_scripts' : [
+            'CoLoRe_compact_catalogs = CoLoRe_analysis.scripts.compact_catalogs:main',
             'CoLoRe_compute_correlations = CoLoRe_analysis.scripts.compute_correlations:main',
             'CoLoRe_compute_data = CoLoRe_analysis.scripts.compute_data:main',
             'CoLoRe_compute_data_shear_test = CoLoRe_analysis.scripts.compute_data_shear_test:main',